@@ -0,0 +1,147 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zipfile
+
+from loguru import logger
+
+from const import DOWNLOAD_RES_PATH, IMAGE_TYPE, MUSIC_TYPE, ARCHIVE_INDEX_SUFFIX, ARCHIVE_CHUNK_SIZE
+
+LOCAL_HEADER_SIZE = 30
+
+
+def archive_path(name, base_path=DOWNLOAD_RES_PATH):
+    return os.path.join(base_path, f"{name}.zip")
+
+
+def index_path(zip_path):
+    return zip_path + ARCHIVE_INDEX_SUFFIX
+
+
+def _data_offset(raw_file, info):
+    # 中央目录里的偏移指向本地文件头，文件头后面是变长的文件名和扩展字段
+    raw_file.seek(info.header_offset)
+    header = raw_file.read(LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def build_member_index(zip_path, accept=None):
+    """
+    为压缩包建立成员偏移索引，并保存到压缩包旁边
+    :param zip_path:
+    :param accept: accept(zip_file, info, title) -> bool，过滤不需要的成员
+    :return: {title: member}
+    """
+    members = dict()
+    with zipfile.ZipFile(zip_path) as zip_file, open(zip_path, "rb") as raw_file:
+        for info in zip_file.infolist():
+            title = info.filename.replace(" ", "_")
+            if not title.lower().endswith(IMAGE_TYPE + MUSIC_TYPE):
+                continue
+            if accept is not None and not accept(zip_file, info, title):
+                continue
+            members[title] = {
+                "name": info.filename,
+                "offset": _data_offset(raw_file, info),
+                "size": info.file_size,
+                "compressed_size": info.compress_size,
+                "compress_type": info.compress_type,
+            }
+    # 先写临时文件再替换，崩溃时不会留下半个索引
+    tmp_path = f"{index_path(zip_path)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as index_file:
+        json.dump(members, index_file, ensure_ascii=False)
+    os.replace(tmp_path, index_path(zip_path))
+    return members
+
+
+class ArchiveStore:
+    """
+    直接从保存的 .osz 压缩包里读取图片和音频，不解压到磁盘
+    """
+
+    def __init__(self, base_path=DOWNLOAD_RES_PATH):
+        self.base_path = base_path
+        self.indexes = dict()  # name -> (mtime, members)
+        self.lock = threading.Lock()
+
+    def exists(self, name):
+        return os.path.isfile(archive_path(name, self.base_path))
+
+    def members(self, name):
+        """
+        :return: {title: member}；压缩包或成员索引不存在时返回 None。
+            索引只由下载器按同样的筛选条件建立，这里不重建，否则被筛掉的成员也会被列出、可以访问
+        """
+        zip_path = archive_path(name, self.base_path)
+        try:
+            mtime = os.path.getmtime(zip_path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            cached = self.indexes.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(index_path(zip_path), "r", encoding="utf-8") as index_file:
+                members = json.load(index_file)
+        except FileNotFoundError:
+            # 和目录扫描一致：没有索引的压缩包还没入库
+            logger.warning(f"[archive] index missing: {zip_path}")
+            return None
+        with self.lock:
+            self.indexes[name] = (mtime, members)
+        return members
+
+    def list_members(self, name):
+        """
+        与 utils.show_beatmap 的返回格式一致
+        """
+        res = {
+            "images": [],
+            "songs": []
+        }
+        for title in self.members(name) or {}:
+            if title.lower().endswith(IMAGE_TYPE):
+                res["images"].append(title)
+            if title.lower().endswith(MUSIC_TYPE):
+                res["songs"].append(title)
+        return res
+
+    def member(self, name, title):
+        members = self.members(name)
+        if members is None:
+            return None
+        return members.get(title)
+
+    def iter_member(self, name, title, chunk_size=ARCHIVE_CHUNK_SIZE):
+        """
+        按块读取成员内容；未压缩的成员直接从 mmap 切片，不经过 zipfile 解压
+        :param name:
+        :param title:
+        :param chunk_size:
+        :return: 生成器
+        """
+        member = self.member(name, title)
+        if member is None:
+            raise FileNotFoundError(title)
+        zip_path = archive_path(name, self.base_path)
+        if member["compress_type"] == zipfile.ZIP_STORED:
+            with open(zip_path, "rb") as raw_file, \
+                    mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start, end = member["offset"], member["offset"] + member["size"]
+                for position in range(start, end, chunk_size):
+                    yield mapped[position:min(position + chunk_size, end)]
+            return
+        with zipfile.ZipFile(zip_path) as zip_file, zip_file.open(member["name"]) as member_file:
+            while True:
+                chunk = member_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+archive_store = ArchiveStore()
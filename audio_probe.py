@@ -0,0 +1,120 @@
+import struct
+
+from loguru import logger
+
+from stream_utils import PrefixedStream, read_exact
+
+MP3_SCAN_BYTES = 64 * 1024  # 标签之后在这么多字节内找第一帧
+# MPEG Layer III 码率表，kbps
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = (44100, 48000, 32000)
+WAVPACK_SAMPLE_RATES = (6000, 8000, 9600, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000, 64000, 88200,
+                        96000, 192000)
+
+
+def _skip(stream, size):
+    # ZipExtFile 不一定能 seek，分块读掉
+    while size > 0:
+        size -= len(read_exact(stream, min(size, MP3_SCAN_BYTES)))
+
+
+def _probe_wav(stream):
+    # RIFF 头的 12 字节已经读过，逐个 chunk 找 fmt 和 data
+    byte_rate = None
+    while True:
+        chunk_id, chunk_size = struct.unpack("<4sI", read_exact(stream, 8))
+        if chunk_id == b"fmt ":
+            fmt = read_exact(stream, chunk_size + (chunk_size & 1))
+            byte_rate = struct.unpack("<I", fmt[8:12])[0]
+            continue
+        if chunk_id == b"data":
+            return chunk_size / byte_rate if byte_rate else None
+        _skip(stream, chunk_size + (chunk_size & 1))
+
+
+def _probe_flac(stream):
+    # 第一个元数据块一定是 STREAMINFO
+    block = read_exact(stream, 38)
+    if block[0] & 0x7F != 0:
+        return None
+    bits = int.from_bytes(block[14:22], "big")
+    sample_rate, total_samples = bits >> 44, bits & ((1 << 36) - 1)
+    return total_samples / sample_rate if sample_rate and total_samples else None
+
+
+def _probe_wavpack(head):
+    total_samples, flags = struct.unpack("<I8xI", head[12:28])
+    rate_index = (flags >> 23) & 0xF
+    if total_samples == 0xFFFFFFFF or rate_index >= len(WAVPACK_SAMPLE_RATES):
+        return None
+    return total_samples / WAVPACK_SAMPLE_RATES[rate_index]
+
+
+def _probe_mp3(head, stream, size):
+    offset = 0
+    if head[:3] == b"ID3":
+        tag_size = 10 + sum(byte << (7 * (3 - i)) for i, byte in enumerate(head[6:10]))
+        if head[5] & 0x10:  # 带 footer
+            tag_size += 10
+        if tag_size < len(head):
+            head = head[tag_size:]
+        else:
+            _skip(stream, tag_size - len(head))
+            head = b""
+        offset = tag_size
+    data = head + stream.read(MP3_SCAN_BYTES)
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        version_bits, layer_bits = (data[i + 1] >> 3) & 3, (data[i + 1] >> 1) & 3
+        bitrate_index, rate_index = data[i + 2] >> 4, (data[i + 2] >> 2) & 3
+        if version_bits == 1 or layer_bits != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            continue  # 只支持 Layer III
+        mpeg1 = version_bits == 3
+        sample_rate = MP3_SAMPLE_RATES[rate_index] >> (0 if mpeg1 else 1 if version_bits == 2 else 2)
+        samples_per_frame = 1152 if mpeg1 else 576
+        mono = data[i + 3] >> 6 == 3
+        # VBR 文件的第一帧是 Xing/Info 或 VBRI 头，记录了总帧数
+        xing = i + (21 if mono else 36) if mpeg1 else i + (13 if mono else 21)
+        if data[xing:xing + 4] in (b"Xing", b"Info"):
+            flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+            if flags & 1:
+                frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+                return frames * samples_per_frame / sample_rate
+        if data[i + 36:i + 40] == b"VBRI":
+            frames = struct.unpack(">I", data[i + 50:i + 54])[0]
+            return frames * samples_per_frame / sample_rate
+        # 没有 VBR 头按固定码率估算
+        bitrate = MP3_BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+        return (size - offset - i) * 8 / bitrate if size else None
+    return None
+
+
+def probe_audio(stream, size=None):
+    """
+    只读取文件头部得到音频时长，不解码。mp3 没有 VBR 头时按第一帧的码率估算
+    :param stream: 二进制文件对象，可以是 zip 成员
+    :param size: 文件字节数，固定码率 mp3 需要
+    :return: (时长秒数, 格式)，无法识别返回 None
+    """
+    try:
+        head = stream.read(32)
+        if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+            duration, audio_format = _probe_wav(PrefixedStream(head[12:], stream)), "wav"
+        elif head[:4] == b"fLaC":
+            duration, audio_format = _probe_flac(PrefixedStream(head[4:], stream)), "flac"
+        elif head[:4] == b"wvpk":
+            duration, audio_format = _probe_wavpack(head), "wv"
+        elif head[:3] == b"ID3" or head[:2] and head[0] == 0xFF:
+            duration, audio_format = _probe_mp3(head, stream, size), "mp3"
+        else:
+            return None
+    except (ValueError, IndexError, struct.error, ZeroDivisionError) as e:
+        logger.debug(f"[probe] unable to parse audio header: {e}")
+        return None
+    if duration is None:
+        return None
+    return round(duration, 3), audio_format
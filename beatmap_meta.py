@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+import zipfile
+
+from loguru import logger
+
+from audio_probe import probe_audio
+from const import DOWNLOAD_RES_PATH, IMAGE_TYPE, MUSIC_TYPE, META_SUFFIX
+from image_probe import probe_image
+from pipeline_journal import atomic_write
+
+
+def meta_path(set_path):
+    """
+    :param set_path: 谱面文件夹路径（压缩包存储模式为去掉 .zip 的路径）
+    """
+    return set_path + META_SUFFIX
+
+
+def describe_member(title, size, opener, probed=None):
+    """
+    :param title: 文件名
+    :param size: 字节数
+    :param opener: opener() -> 二进制文件对象
+    :param probed: 筛选时已经探测过的图片 [width, height, format, ...]，不再读取
+    :return: 文件的元数据，不是图片和音频返回 None
+    """
+    entry = {"size": size}
+    if title.lower().endswith(IMAGE_TYPE):
+        if probed is not None:
+            probed = probed[:3]
+        else:
+            with opener() as stream:
+                probed = probe_image(stream)
+        if probed is not None:
+            entry["width"], entry["height"], entry["format"] = probed
+        return "images", entry
+    if title.lower().endswith(MUSIC_TYPE):
+        with opener() as stream:
+            probed = probe_audio(stream, size)
+        if probed is not None:
+            entry["duration"], entry["format"] = probed
+        return "songs", entry
+    return None
+
+
+def build_meta(files, probes=None):
+    """
+    :param files: [(文件名, 字节数, opener)]
+    :param probes: {文件名: [width, height, format, size]}
+    :return: {"images": [文件名], "songs": [文件名], "files": {文件名: 元数据}, "ingested_at": 入库时间戳}
+    """
+    # 入库时间只在这里写入，之后拉回文件、刷新元数据都不改变它，目录按它排序
+    meta = {"images": [], "songs": [], "files": dict(), "ingested_at": int(time.time())}
+    for title, size, opener in files:
+        try:
+            described = describe_member(title, size, opener, (probes or {}).get(title))
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.error(f"[meta] unable to read {title}: {e}")
+            continue
+        if described is None:
+            continue
+        kind, entry = described
+        meta[kind].append(title)
+        meta["files"][title] = entry
+    return meta
+
+
+def build_meta_from_dir(set_dir, titles, probes=None):
+    files = []
+    for title in titles:
+        path = os.path.join(set_dir, title)
+        files.append((title, os.path.getsize(path), lambda path=path: open(path, "rb")))
+    return build_meta(files, probes)
+
+
+def build_meta_from_zip(file_path, members, probes=None):
+    """
+    :param file_path:
+    :param members: {文件名: 压缩包内成员名}
+    :param probes:
+    """
+    with zipfile.ZipFile(file_path) as zip_file:
+        files = [
+            (title, zip_file.getinfo(member_name).file_size, lambda member_name=member_name: zip_file.open(member_name))
+            for title, member_name in members.items()
+        ]
+        return build_meta(files, probes)
+
+
+def write_meta(set_path, meta):
+    atomic_write(meta_path(set_path), json.dumps(meta, ensure_ascii=False, separators=(",", ":")))
+
+
+def read_ingested_at(set_path):
+    """
+    :return: 入库时间戳，没有 sidecar 或者 sidecar 早于这个字段时返回 None
+    """
+    try:
+        with open(meta_path(set_path), "r", encoding="utf-8") as meta_file:
+            return json.load(meta_file).get("ingested_at")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def refresh_meta(set_path, titles):
+    """
+    本地文件被替换后按实际内容重新描述，比如从COS拉回的图片是 webp 版本，格式和大小都与入库时不同
+    :param set_path: 谱面文件夹
+    :param titles: 被替换的文件名，其余条目不变
+    """
+    try:
+        with open(meta_path(set_path), "r", encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+    except (FileNotFoundError, ValueError):
+        return
+    for title in titles:
+        path = os.path.join(set_path, title)
+        try:
+            described = describe_member(title, os.path.getsize(path), lambda path=path: open(path, "rb"))
+        except OSError as e:
+            logger.error(f"[meta] unable to read {title}: {e}")
+            continue
+        if described is not None:
+            meta["files"][title] = described[1]
+    write_meta(set_path, meta)
+
+
+class BeatmapMetaStore:
+    """
+    入库时写好的谱面元数据，接口读一个小文件即可返回文件列表，不再列目录、逐个 stat。
+    读过的保存在内存里，只在 sidecar 的 mtime 变化时重新读取
+    """
+
+    def __init__(self, base_path=DOWNLOAD_RES_PATH):
+        self.base_path = base_path
+        self.metas = dict()  # name -> (mtime, meta)
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """
+        :param name: 相对下载目录的谱面路径 分类/谱面
+        :return: 没有 sidecar（入库早于这个功能）返回 None
+        """
+        path = meta_path(os.path.join(self.base_path, name))
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            cached = self.metas.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path, "r", encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+        except (FileNotFoundError, ValueError) as e:
+            logger.error(f"[meta] unable to read {path}: {e}")
+            return None
+        with self.lock:
+            self.metas[name] = (mtime, meta)
+        return meta
+
+    def exists(self, name):
+        return os.path.exists(meta_path(os.path.join(self.base_path, name)))
+
+
+beatmap_meta_store = BeatmapMetaStore()
@@ -0,0 +1,350 @@
+import base64
+import bisect
+import json
+import os
+import random
+import re
+import time
+from typing import NamedTuple
+
+from loguru import logger
+
+from archive_store import archive_store, index_path
+from beatmap_meta import read_ingested_at
+from const import DOWNLOAD_RES_PATH, BEATMAP_CATALOG_TTL, IMAGE_TYPE, MUSIC_TYPE
+from pipeline_journal import EXTRACTING_SUFFIX
+from search_index import SearchIndex
+from shared_catalog import shared_catalog
+from storage_manager import get_storage_manager
+
+SET_NAME_PATTERN = re.compile(r"^(\d+)-")  # BeatMapSet.__str__: {set_id}-{artist}-{title}
+SORT_FIELDS = ("set_id", "mtime")
+SECTION_NAME = "beatmapset_rows"
+FINGERPRINT_SECTION = "beatmapset_fingerprint"
+
+
+class BeatmapRow(NamedTuple):
+    name: str
+    category: str  # 平铺存放在下载目录下的谱面为空字符串
+    set_id: int
+    mtime: int  # 入库时间，不随文件淘汰、拉回变化
+    has_images: bool
+    has_audio: bool
+
+    @property
+    def path(self):
+        # 相对下载目录的路径
+        return f"{self.category}/{self.name}" if self.category else self.name
+
+    def encode(self):
+        return "\t".join((self.name, self.category, str(self.set_id), str(self.mtime),
+                          str(int(self.has_images)), str(int(self.has_audio))))
+
+    @classmethod
+    def decode(cls, row):
+        name, category, set_id, mtime, has_images, has_audio = row.split("\t")
+        return cls(name, category, int(set_id), int(mtime), has_images == "1", has_audio == "1")
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "category": self.category,
+            "set_id": self.set_id,
+            "mtime": self.mtime,
+            "has_images": self.has_images,
+            "has_audio": self.has_audio,
+        }
+
+
+def scan_row(path, category, previous=None):
+    """
+    :param path: 谱面文件夹或压缩包
+    :param category:
+    :param previous: {(分类, 谱面名): BeatmapRow}
+    :return: BeatmapRow
+    """
+    is_archive = path.endswith(".zip")
+    name = os.path.basename(path)[:-len(".zip")] if is_archive else os.path.basename(path)
+    old = (previous or {}).get((category, name))
+    if old is not None:
+        # 已经登记过的谱面不再列举内容；重新入库的谱面由下载器重新登记
+        return old
+    # 文件夹的 mtime 会随淘汰、拉回变化，排序和游标用 sidecar 里的入库时间；更早入库的谱面没有这个字段
+    ingested_at = read_ingested_at(path[:-len(".zip")] if is_archive else path)
+    mtime = ingested_at if ingested_at is not None else int(os.path.getmtime(path))
+    if is_archive:
+        files = archive_store.members(f"{category}/{name}" if category else name) or {}
+    else:
+        # 已镜像到COS的文件即使本地被淘汰（或流式上传时从未解压）也算在谱面里，访问时再拉回
+        mirrored = get_storage_manager().load_mirrored().get(f"{category}/{name}" if category else name, {})
+        files = set(os.listdir(path)) | set(mirrored)
+    match = SET_NAME_PATTERN.match(name)
+    return BeatmapRow(
+        name, category, int(match.group(1)) if match else -1, mtime,
+        any(file.lower().endswith(IMAGE_TYPE) for file in files),
+        any(file.lower().endswith(MUSIC_TYPE) for file in files),
+    )
+
+
+def _is_beatmapset(entry):
+    # 压缩包只有建立了成员索引才算入库，正在下载或解压的压缩包、文件夹不算
+    if entry.is_dir():
+        return not entry.name.endswith(EXTRACTING_SUFFIX)
+    return (entry.name.endswith(".zip") and os.path.exists(index_path(entry.path)))
+
+
+def scan_beatmapsets(base_path=DOWNLOAD_RES_PATH, previous=None):
+    """
+    扫描下载目录。既支持平铺的 {set_id}-... 文件夹，也支持下载器写出的 分类/{set_id}-... 结构
+    :param base_path:
+    :param previous: 上一次的结果，已经登记过的谱面直接复用
+    :return: [BeatmapRow]
+    """
+    previous = {(row.category, row.name): row for row in previous or []}
+    rows = []
+    for entry in os.scandir(base_path):
+        if not _is_beatmapset(entry):
+            continue
+        if not entry.is_dir() or SET_NAME_PATTERN.match(entry.name):
+            rows.append(scan_row(entry.path, "", previous))
+            continue
+        # 分类文件夹
+        for child in os.scandir(entry.path):
+            if child.name == "imgs" or not _is_beatmapset(child):
+                continue
+            rows.append(scan_row(child.path, entry.name, previous))
+    return rows
+
+
+def encode_cursor(sort, descending, row):
+    raw = json.dumps([sort, descending, getattr(row, sort), row.path], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    :return: (sort, descending, key, path)
+    """
+    try:
+        sort, descending, key, path = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        key = int(key)
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if sort not in SORT_FIELDS:
+        raise ValueError("invalid cursor")
+    return sort, bool(descending), key, str(path)
+
+
+def _row_matches(row, category, has_images, has_audio):
+    return (category is None or row.category == category) \
+        and (has_images is None or row.has_images == has_images) \
+        and (has_audio is None or row.has_audio == has_audio)
+
+
+def _sort_key(row, sort, descending):
+    return (-1 if descending else 1) * getattr(row, sort), row.path
+
+
+class CatalogIndex:
+    """
+    某一代目录数据上的排序索引，按 (排序字段, 方向, 过滤条件) 懒加载并缓存，翻页只需二分查找
+    """
+
+    def __init__(self, rows):
+        # 追加写入的目录里同一个谱面可能出现多次，以最后一次为准
+        self.rows = list({row.path: row for row in rows}.values())
+        self.positions = {row.path: index for index, row in enumerate(self.rows)}
+        self.by_name = {row.name: row for row in self.rows}
+        self.ordered = dict()
+
+    def extend(self, rows):
+        """
+        增量加入新登记的谱面，重复登记的原地替换；已经建好的排序索引用二分查找维护，不整体重建
+        """
+        for row in rows:
+            position = self.positions.get(row.path)
+            if position is None:
+                self.positions[row.path] = len(self.rows)
+                self.rows.append(row)
+            else:
+                old, self.rows[position] = self.rows[position], row
+                for (sort, descending, *filters), (keys, ordered_rows) in self.ordered.items():
+                    if _row_matches(old, *filters):
+                        # 排序键带路径，每行唯一
+                        index = bisect.bisect_left(keys, _sort_key(old, sort, descending))
+                        del keys[index], ordered_rows[index]
+            self.by_name[row.name] = row
+            for (sort, descending, *filters), (keys, ordered_rows) in self.ordered.items():
+                if _row_matches(row, *filters):
+                    key = _sort_key(row, sort, descending)
+                    index = bisect.bisect_right(keys, key)
+                    keys.insert(index, key)
+                    ordered_rows.insert(index, row)
+
+    def ordering(self, sort, descending, category, has_images, has_audio):
+        cache_key = (sort, descending, category, has_images, has_audio)
+        ordered = self.ordered.get(cache_key)
+        if ordered is None:
+            rows = [row for row in self.rows if _row_matches(row, category, has_images, has_audio)]
+            rows.sort(key=lambda row: _sort_key(row, sort, descending))
+            ordered = ([_sort_key(row, sort, descending) for row in rows], rows)
+            self.ordered[cache_key] = ordered
+        return ordered
+
+    def page(self, sort="set_id", descending=False, category=None, has_images=None, has_audio=None,
+             cursor=None, limit=50):
+        """
+        :return: (本页的行, 下一页游标, 满足过滤条件的总数)
+        """
+        if cursor is not None:
+            sort, descending, key, path = decode_cursor(cursor)
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"unsupported sort: {sort}")
+        keys, rows = self.ordering(sort, descending, category, has_images, has_audio)
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(keys, ((-1 if descending else 1) * key, path))
+        page = rows[start:start + limit]
+        next_cursor = None
+        if start + limit < len(rows):
+            next_cursor = encode_cursor(sort, descending, page[-1])
+        return page, next_cursor, len(rows)
+
+
+class BeatmapCatalog:
+    """
+    谱面目录，代替每次请求都 os.listdir 下载目录。保存在共享目录文件里；下载器登记的谱面直接追加，
+    下载目录有其他变化（手动放入、删除谱面）时由一个 worker 在后台重新扫描
+    """
+
+    def __init__(self, base_path=DOWNLOAD_RES_PATH, ttl=BEATMAP_CATALOG_TTL, catalog=shared_catalog):
+        self.base_path = base_path
+        self.ttl = ttl
+        self.catalog = catalog
+        self.section = None
+        self.checked_at = 0
+        self.catalog_index = CatalogIndex([])
+        self.search_index = SearchIndex()
+
+    def fingerprint(self):
+        """
+        下载目录和分类目录的 mtime，增加、删除、改名谱面时才会变化
+        """
+        try:
+            mtimes = [os.stat(self.base_path).st_mtime_ns]
+        except FileNotFoundError:
+            return ""
+        for entry in os.scandir(self.base_path):
+            if entry.is_dir() and not SET_NAME_PATTERN.match(entry.name):
+                mtimes.append(entry.stat().st_mtime_ns)
+        return ",".join(map(str, mtimes))
+
+    def is_stale(self):
+        section = self.catalog.section(FINGERPRINT_SECTION)
+        return self.catalog.section(SECTION_NAME) is None or section is None or section[0] != self.fingerprint()
+
+    def load(self):
+        fingerprint = self.fingerprint()  # 先记下再扫描，扫描过程中的变化留给下一次
+        section = self.catalog.section(SECTION_NAME)
+        previous = [BeatmapRow.decode(row) for row in section] if section is not None else []
+        rows = scan_beatmapsets(self.base_path, previous)
+        # 保持原有的顺序，没有变化的谱面在前、新增的在后，发布时只算作追加，其他 worker 不用重建索引
+        order = {row.path: index for index, row in reversed(list(enumerate(previous)))}
+        rows.sort(key=lambda row: order.get(row.path, len(order)))
+        return {SECTION_NAME: [row.encode() for row in rows], FINGERPRINT_SECTION: [fingerprint]}
+
+    def check(self):
+        """
+        最多每 ttl 秒检查一次下载目录有没有变化，有变化时在后台重新扫描
+        """
+        now = time.time()
+        if now - self.checked_at < self.ttl:
+            return
+        self.checked_at = now
+        if self.is_stale():
+            self.catalog.refresh_in_background(SECTION_NAME, self.ttl, self.load, stale=self.is_stale)
+
+    def warm(self):
+        self.check()
+
+    def index(self):
+        section = self.catalog.section(SECTION_NAME)
+        if section is None:
+            self.catalog.refresh(SECTION_NAME, self.ttl, self.load, blocking=True, stale=self.is_stale)
+            section = self.catalog.section(SECTION_NAME)
+        else:
+            self.check()
+        if section is not None and section is not self.section:
+            if section.extends(self.section):
+                # 下载器只在末尾追加了谱面，只处理新增的行
+                rows = [BeatmapRow.decode(row) for row in section[len(self.section):]]
+                self.catalog_index.extend(rows)
+                for row in rows:
+                    self.search_index.add(row)
+            else:
+                # 共享文件换了新版本，重建本进程的排序索引
+                self.catalog_index = CatalogIndex([BeatmapRow.decode(row) for row in section])
+                self.search_index.sync(self.catalog_index.rows)
+            self.section = section
+        return self.catalog_index
+
+    def register(self, category, path):
+        """
+        下载器写入一个谱面后调用，直接追加到共享目录末尾，不用等下一次全量扫描；
+        重复登记的谱面以最后一行为准，下一次全量扫描时合并
+        :param category: 平铺存放时为空字符串
+        :param path: 谱面文件夹或压缩包
+        :return: 登记的行，路径不存在（没有任何成员通过筛选）时返回 None
+        """
+        try:
+            row = scan_row(path, category)
+        except FileNotFoundError:
+            logger.warning(f"[catalog] skip register, not found: {path}")
+            return None
+        self.catalog.append(SECTION_NAME, [row.encode()])
+        return row
+
+    def random_name(self):
+        rows = self.index().rows
+        return rows[random.randrange(len(rows))].name
+
+    def random_rows(self, n, category=None):
+        """
+        不放回地随机抽取多个谱面，分类过滤复用缓存的排序索引
+        :param n: 不够时返回全部
+        :param category:
+        :return: [BeatmapRow]
+        """
+        catalog_index = self.index()
+        rows = catalog_index.rows
+        if category is not None:
+            rows = catalog_index.ordering("set_id", False, category, None, None)[1]
+        return random.sample(rows, min(n, len(rows)))
+
+    def lookup(self, name):
+        return self.index().by_name.get(name)
+
+    def contains(self, path):
+        """
+        :param path: 相对下载目录的谱面路径
+        """
+        row = self.index().by_name.get(path.rsplit("/", 1)[-1])
+        return row is not None and row.path == path
+
+    def resolve(self, name):
+        """
+        谱面名 -> 相对下载目录的路径；目录里没有时原样返回
+        """
+        row = self.index().by_name.get(name)
+        return row.path if row is not None else name
+
+    def page(self, **kwargs):
+        page, next_cursor, total = self.index().page(**kwargs)
+        return [row.to_dict() for row in page], next_cursor, total
+
+    def search(self, query, limit=20, category=None):
+        self.index()
+        return [{**row.to_dict(), "score": score} for row, score in self.search_index.search(query, limit, category)]
+
+
+beatmap_catalog = BeatmapCatalog()
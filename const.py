@@ -26,4 +26,87 @@ OSU_CATEGORY_LIST = [
     "Aisaka Taiga/", "Hatsune Miku/", "Touhou Project/", "k-on/", "one piece/",
     "日语-上架时间/", "社区喜爱-上架时间/"
 ]
-OSU_IMG_DIR = "imgs/"
\ No newline at end of file
+OSU_IMG_DIR = "imgs/"
+# -----------------------图片缩放-----------------------------------------
+RENDITION_CACHE_DIR = os.path.join(os.getcwd(), "cache/renditions")
+RENDITION_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 缓存目录容量上限，超出后按LRU淘汰
+RENDITION_WIDTHS = (160, 320, 480, 640, 960, 1280, 1920)  # 请求的宽度会向上取整到这些档位
+RENDITION_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "avif": ("AVIF", "image/avif"),  # 需要 Pillow 支持 AVIF 编码
+}
+RENDITION_QUALITY = 80
+RENDITION_WORKERS = 2
+RENDITION_CACHE_MAX_AGE = 7 * 24 * 3600
+# -----------------------图片去重-----------------------------------------
+PHASH_INDEX_PATH = os.path.join(DOWNLOAD_RES_PATH, "phash_index.tsv")
+PHASH_MAX_DISTANCE = 4  # 汉明距离不超过该值视为同一张背景图
+# -----------------------图片尺寸-----------------------------------------
+IMAGE_INDEX_PATH = os.path.join(DOWNLOAD_RES_PATH, "image_index.jsonl")
+IMAGE_MIN_WIDTH = 1024
+IMAGE_MIN_HEIGHT = 576
+IMAGE_MIN_ASPECT = 1.0  # 宽/高，竖图不适合做背景
+IMAGE_MAX_ASPECT = 2.4
+# -----------------------压缩包存储-----------------------------------------
+ARCHIVE_STORAGE = False  # 为True时保留下载的压缩包，接口直接从压缩包读取，不再解压到文件夹
+ARCHIVE_INDEX_SUFFIX = ".idx.json"
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+COS_STREAM_UPLOAD = False  # 为True时直接从压缩包读取成员上传到COS，不先解压到磁盘
+LOCAL_EXTRACT = True  # 流式上传时是否仍解压一份到本地，接口主机需要本地文件时开启
+COS_MULTIPART_THRESHOLD = 20 * 1024 * 1024  # 超过这个大小的成员走分块上传
+# -----------------------磁盘预算-----------------------------------------
+DISK_BUDGET_BYTES = None  # download 目录的磁盘预算，超出后淘汰已上传到COS的文件，比如 50 * 1024 ** 3；None 为不淘汰
+STORAGE_STATE_PATH = os.path.join(DOWNLOAD_RES_PATH, "storage_state.jsonl")  # 只追加，每行一个谱面
+STORAGE_ACCESS_PATH = os.path.join(DOWNLOAD_RES_PATH, "storage_access.json")
+STORAGE_ACCESS_FLUSH_INTERVAL = 60
+STORAGE_USAGE_RESYNC_INTERVAL = 600  # 占用平时增量维护，每隔这么多秒完整统计一次
+# 音频默认只保存在本地；本地副本会被淘汰，或者流式上传不解压到本地时，COS上才需要一份
+MIRROR_AUDIO = DISK_BUDGET_BYTES is not None or (COS_STREAM_UPLOAD and not LOCAL_EXTRACT)
+# -----------------------日志管道-----------------------------------------
+LOG_FILE_PATTERN = os.path.join(os.getcwd(), "logs/%Y-%m-%d.log")  # time.strftime 格式，按天切换文件
+LOG_QUEUE_SIZE = 10000  # 队列满时丢弃新日志
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 0.5  # 秒，凑满一批日志最多等待的时间
+LOG_ACCESS_SAMPLE_RATE = 1.0  # 访问日志采样比例，状态码 >= 400 的总是保留
+LOG_JSON = False  # 为True时输出结构化 JSON 日志
+# -----------------------共享目录-----------------------------------------
+SHARED_CATALOG_PATH = os.path.join(os.getcwd(), "cache/catalog.bin")  # 所有 worker 共享的 mmap 文件，也是启动快照
+SHARED_CATALOG_CHECK_INTERVAL = 1.0  # 检查文件是否有新版本的间隔，秒
+OSU_PIC_TTL = 3600  # 图片池刷新间隔，秒
+BEATMAP_CATALOG_TTL = 60  # 多久检查一次下载目录有没有变化，有变化时才重新扫描谱面目录，秒
+# -----------------------批量接口-----------------------------------------
+BATCH_MAX_SIZE = 50  # 批量接口单次最多返回的数量
+# -----------------------分段下载-----------------------------------------
+DOWNLOAD_SEGMENTS = 4  # 单个谱面最多并发连接数
+DOWNLOAD_MIN_SEGMENT_SIZE = 4 * 1024 * 1024  # 每段至少 4MB，小文件直接单连接
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_SEGMENT_RETRIES = 3
+DOWNLOAD_TIMEOUT = 30  # 秒，连接和两次读之间的超时
+# -----------------------上传清单-----------------------------------------
+# 记录每个 cos key 的源文件 md5，没变的文件不再请求COS
+UPLOAD_MANIFEST_PATH = os.path.join(DOWNLOAD_RES_PATH, "upload_manifest.jsonl")  # 只追加，每行一个 cos key
+HASH_WORKERS = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+# -----------------------上传服务-----------------------------------------
+UPLOAD_WORKERS = 8  # 同时也是 COS 客户端连接池的大小
+UPLOAD_QUEUE_SIZE = 256  # 队列满时提交方阻塞
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_BACKOFF = 1.0  # 秒，第 n 次重试等待 backoff * 2^(n-1)
+# -----------------------多尺寸编码---------------------------------------
+LADDER_ENCODE = False  # 为True时在本地编码多尺寸图片并作为普通对象上传，不再依赖COS上传时的图片处理
+LADDER_WIDTHS = {"thumb": 320, "medium": 1280, "full": None}  # None 为原始尺寸
+LADDER_FORMATS = ("webp", "avif")  # Pillow 不支持的格式自动跳过，webp 的 full 档替代原来转换后的原图
+LADDER_WORKERS = 2
+LADDER_INDEX_SUFFIX = ".renditions.json"  # 保存在谱面文件夹旁边，记录每张图各个尺寸的 cos key
+# -----------------------性能分析-----------------------------------------
+PROFILE_DIR = os.path.join(os.getcwd(), "logs/profile")  # 折叠格式的调用栈，可直接生成火焰图
+PROFILE_INTERVAL = 0.005  # 采样间隔，秒
+PROFILE_SAMPLE_RATE = 0.0  # 接口请求的采样比例，为 0 且没有设置 PROFILE_TOKEN 时不挂载中间件
+PROFILE_HEADER = "X-Profile"  # 带上这个请求头且值等于 PROFILE_TOKEN 的请求一定会被分析
+PROFILE_TOKEN = ""  # 为空时不接受请求头触发
+# -----------------------处理日志-----------------------------------------
+JOURNAL_SUFFIX = ".journal.json"  # 保存在压缩包旁边，记录谱面已完成的处理阶段，全部完成后删除
+# -----------------------谱面元数据-----------------------------------------
+META_SUFFIX = ".meta.json"  # 保存在谱面文件夹旁边，入库时写入成员名、类型、大小、图片尺寸和音频时长
@@ -1,10 +1,15 @@
 import logging
+import os
+import queue
+import random
+import threading
+import time
 from pprint import pformat
 
 from loguru import logger
 from loguru._defaults import LOGURU_FORMAT
 
-from const import LOG_FORMAT
+from const import LOG_FORMAT, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_ACCESS_SAMPLE_RATE
 
 
 class InterceptHandler(logging.Handler):
@@ -15,17 +20,131 @@ class InterceptHandler(logging.Handler):
         except ValueError:
             level = record.levelno
 
-        # Find caller from where originated the logged message
-        frame, depth = logging.currentframe(), 2
-        while frame.f_code.co_filename == logging.__file__:
-            frame = frame.f_back
-            depth += 1
+        # 调用位置直接取标准库 record 里的字段，不再逐帧回溯
+        def patcher(loguru_record):
+            loguru_record.update(name=record.name, function=record.funcName, line=record.lineno)
 
-        logger.opt(depth=depth, exception=record.exc_info).log(
+        logger.patch(patcher).opt(exception=record.exc_info).log(
             level, record.getMessage()
         )
 
 
+class AccessLogSampler(logging.Filter):
+    """
+    按比例采样 uvicorn 的访问日志，状态码 >= 400 的请求总是保留
+    """
+
+    def __init__(self, rate=LOG_ACCESS_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1.0:
+            return True
+        args = record.args
+        if isinstance(args, tuple) and len(args) >= 5 and isinstance(args[4], int) and args[4] >= 400:
+            return True
+        return random.random() < self.rate
+
+
+class BatchedSink:
+    """
+    loguru 的 sink：写日志只是入队，由后台线程批量写出，请求路径上不做 I/O。
+    队列满时丢弃新日志并计数，保证单条日志的开销有上限
+    """
+
+    def __init__(self, stream=None, path_pattern=None, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL):
+        """
+        :param stream: 输出流，比如 sys.stdout
+        :param path_pattern: 日志文件路径，可包含 time.strftime 格式，按日期切换文件
+        :param queue_size:
+        :param batch_size:
+        :param flush_interval: 秒，收到一批的第一条日志后最多再等这么久凑满一批
+        """
+        self.stream = stream
+        self.path_pattern = path_pattern
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.file = None
+        self.file_path = None
+        self.stats = {"enqueued": 0, "written": 0, "dropped": 0, "batches": 0, "write_seconds": 0.0}
+        self.stats_lock = threading.Lock()  # 请求线程和写日志线程都会更新统计
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, message):
+        try:
+            self.queue.put_nowait(message)
+            self.count(enqueued=1)
+        except queue.Full:
+            self.count(dropped=1)
+
+    def count(self, **deltas):
+        with self.stats_lock:
+            for key, delta in deltas.items():
+                self.stats[key] += delta
+
+    def snapshot(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self.write_batch(batch)
+            if item is None:
+                break
+
+    def write_batch(self, batch):
+        start = time.perf_counter()
+        data = "".join(batch)
+        try:
+            if self.stream is not None:
+                self.stream.write(data)
+                self.stream.flush()
+            if self.path_pattern is not None:
+                self.target_file().write(data)
+                self.file.flush()
+        except Exception as e:
+            # 写日志失败不能影响业务，只记到统计里
+            with self.stats_lock:
+                self.stats["dropped"] += len(batch)
+                self.stats["error"] = repr(e)
+            return
+        self.count(written=len(batch), batches=1, write_seconds=time.perf_counter() - start)
+
+    def target_file(self):
+        path = time.strftime(self.path_pattern)
+        if path != self.file_path:
+            if self.file is not None:
+                self.file.close()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+            self.file_path = path
+        return self.file
+
+    def stop(self):
+        # loguru 移除 sink 时调用，写完队列里剩余的日志
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 def format_record(record: dict) -> str:
     format_string = LOG_FORMAT
 
@@ -1,21 +1,37 @@
 import argparse
+import atexit
 import base64
 import json
 import os
 import re
 import shutil
 import sys
+import tempfile
+import threading
 import time
 import zipfile
+from concurrent.futures import Future
 from typing import Dict
 
 import requests
 from InquirerPy import prompt
 from loguru import logger
 
-from const import IMAGE_TYPE, MUSIC_TYPE, PROJECT_PATH
+from archive_store import build_member_index, archive_store
+from beatmap_meta import build_meta_from_dir, build_meta_from_zip, write_meta
+from catalog import beatmap_catalog
+from const import IMAGE_TYPE, MUSIC_TYPE, PROJECT_PATH, ARCHIVE_STORAGE, LOG_JSON, COS_STREAM_UPLOAD, LOCAL_EXTRACT
+from constom_log import BatchedSink
+from image_hash import get_phash_index
+from image_probe import probe_image, passes_quality, get_image_index
+from pipeline_journal import PipelineJournal, find_journals, atomic_write, atomic_copy, replace_dir, \
+    EXTRACTING_SUFFIX, STAGE_STARTED, STAGE_DOWNLOADED, STAGE_SELECTED, STAGE_INDEXED, STAGE_EXTRACTED, STAGE_UPLOADED
+from profiler import SamplingProfiler
+from segmented_download import download_file, DownloadError
 from tc_config import COS_OSU_PATH
-from tencent_cloud import tencent_cos_upload
+from storage_manager import get_storage_manager
+from tencent_cloud import tencent_cos_upload, tencent_cos_upload_archive
+from upload_service import then
 
 DOWNLOAD_PATH = os.curdir
 # Windows
@@ -26,7 +42,7 @@ else:
     USERPROFILE = os.getenv("HOME")
 HOME_DIR = os.path.join(USERPROFILE, ".osu-beatmap-downloader")
 CREDS_FILEPATH = os.path.join(HOME_DIR, "credentials.json")
-LOGS_FILEPATH = os.path.join(PROJECT_PATH, "logs", f'downloader/{time.strftime("%Y-%m-%d")}.log')
+LOGS_FILEPATH = os.path.join(PROJECT_PATH, "logs", "downloader/%Y-%m-%d.log")  # time.strftime 格式
 ILLEGAL_CHARS = re.compile(r"[\<\>:\"\/\\\|\?*]")
 
 FORMAT_TIME = "<cyan>{time:YYYY-MM-DD HH:mm:ss}</cyan>"
@@ -35,16 +51,21 @@ FORMAT_MESSAGE = "<level>{message}</level>"
 LOGGER_CONFIG = {
     "handlers": [
         {
-            "sink": sys.stdout,
+            "sink": BatchedSink(stream=sys.stdout),
             "format": " | ".join((FORMAT_TIME, FORMAT_LEVEL, FORMAT_MESSAGE)),
+            "colorize": sys.stdout.isatty(),
+            "serialize": LOG_JSON,
         },
         {
-            "sink": LOGS_FILEPATH,
+            "sink": BatchedSink(path_pattern=LOGS_FILEPATH),
             "format": " | ".join((FORMAT_TIME, FORMAT_LEVEL, FORMAT_MESSAGE)),
+            "colorize": False,
+            "serialize": LOG_JSON,
         },
     ]
 }
 logger.configure(**LOGGER_CONFIG)
+atexit.register(logger.remove)  # 退出前写完日志队列
 
 OSU_URL = "https://osu.ppy.sh/home"
 OSU_SESSION_URL = "https://osu.ppy.sh/session"
@@ -115,71 +136,374 @@ class BeatMapSet:
         return ILLEGAL_CHARS.sub("_", string)
 
 
-def write_beatmapset_file(category, filename, data):
+def beatmapset_file_path(category, filename):
     target_path = DOWNLOAD_PATH + "/download" + "/" + category
     folder = os.path.exists(target_path)
     if not folder:  # 判断是否存在文件夹如果不存在则创建为文件夹
         os.makedirs(target_path)
     filename = filename.replace(" ", "_")
-    file_path = os.path.join(target_path, f"{filename}.zip")
-    logger.info(f"Writing file: {file_path}")
-    with open(file_path, "wb") as outfile:
-        outfile.write(data)
-    logger.success("File write successful")
+    return os.path.join(target_path, f"{filename}.zip")
+
+
+def write_beatmapset_file(category, filename, data=None):
+    """
+    :param category:
+    :param filename:
+    :param data: 压缩包内容；为 None 时压缩包已经由分段下载写到了 beatmapset_file_path
+    :return: 上传的 Future，不需要等它完成就可以处理下一个谱面
+    """
+    file_path = beatmapset_file_path(category, filename)
+    journal = PipelineJournal(file_path)
+    if data is not None:
+        logger.info(f"Writing file: {file_path}")
+        atomic_write(file_path, data)
+        logger.success("File write successful")
+    journal.mark(STAGE_DOWNLOADED)
+    return process_beatmapset_file(category, filename.replace(" ", "_"), journal)
+
+
+def process_beatmapset_file(category, filename, journal):
+    """
+    执行下载之后的各个阶段，日志里已完成的阶段直接跳过，启动时恢复中断的谱面也走这里
+    :param category:
+    :param filename: 空格替换后的谱面名
+    :param journal: PipelineJournal，至少已完成 downloaded
+    :return: 上传的 Future，上传成功后日志被删除
+    """
+    file_path = journal.zip_path
+    target_path = os.path.dirname(file_path)
+    if ARCHIVE_STORAGE:
+        upload = store_beatmapset_archive(category, file_path, filename, journal)
+        beatmap_catalog.register(category, file_path)
+        return then(upload, lambda mirrored: finish_journal(journal, mirrored))
     target_dir = os.path.join(target_path, filename)
     total_imags_dir = os.path.join(target_path, "imgs")
     total_imags_dir_exists = os.path.exists(total_imags_dir)
     if not total_imags_dir_exists:  # 判断是否存在文件夹如果不存在则创建为文件夹
         os.makedirs(total_imags_dir)
-    unzip_beatmapset_file(total_imags_dir, file_path, target_dir, filename)
-    tencent_cos_upload(COS_OSU_PATH, category, target_dir, filename)
+    if COS_STREAM_UPLOAD:
+        upload = stream_beatmapset_file(category, file_path, target_dir, total_imags_dir, filename, journal)
+        return then(upload, lambda mirrored: finish_journal(journal, mirrored))
+    if not journal.has(STAGE_EXTRACTED):
+        duplicates = unzip_beatmapset_file(total_imags_dir, file_path, target_dir, filename)
+        journal.mark(STAGE_EXTRACTED, duplicates=sorted(duplicates))
+    # 解压结果已经记录，压缩包不再需要
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        logger.success(f"Delete {file_path} successful")
+    duplicates = set(journal.data(STAGE_EXTRACTED)["duplicates"])
+    upload = tencent_cos_upload(COS_OSU_PATH, category, target_dir, filename, skip_files=duplicates)
+    beatmap_catalog.register(category, target_dir)
+    get_storage_manager().enforce(added=target_dir)
+    return then(upload, lambda mirrored: finish_journal(journal, mirrored))
+
+
+def finish_journal(journal, mirrored):
+    # 上传失败时保留日志，下次启动重新上传（上传清单保证已成功的文件不会重复上传）
+    if mirrored is not None:
+        journal.finish()
+    return mirrored
+
+
+def accept_beatmapset_member(zip_file, info, title, probes):
+    """
+    解压前根据大小和文件头判断压缩包成员是否保留
+    :param zip_file:
+    :param info: ZipInfo
+    :param title: 空格替换后的文件名
+    :param probes: 保留的图片的 [width, height, format, size] 记录在这里，
+        成员真正解压或上传后才由 index_beatmapset_images 写入尺寸索引
+    :return:
+    """
+    if title.lower().endswith(IMAGE_TYPE):
+        if info.file_size / 1024 < 400.0:
+            # 小于400kb的图片无用
+            return False
+        with zip_file.open(info) as member:
+            probed = probe_image(member)
+        if probed is None or not passes_quality(probed[0], probed[1]):
+            logger.info(f"Skip low quality image: {info.filename} {probed}")
+            return False
+        probes[title] = [probed[0], probed[1], probed[2], info.file_size]
+        return True
+    if title.lower().endswith(MUSIC_TYPE):
+        # 小于1MB的音频无用
+        return info.file_size / 1024 / 1024 >= 1.0
+    return False
 
 
-def unzip_beatmapset_file(total_imags_dir, origin_file, target_dir, map_name):
-    zip_file = zipfile.ZipFile(origin_file)
-    zip_list = zip_file.namelist()  # 压缩文件清单，可以直接看到压缩包内的各个文件的明细
-    for f in zip_list:
-        title = f.replace(" ", "_")
-        if title.lower().endswith(IMAGE_TYPE + MUSIC_TYPE):
+def index_beatmapset_images(index_prefix, probes, titles):
+    """
+    :param index_prefix: 尺寸索引的键前缀 "分类/谱面/"
+    :param probes: accept_beatmapset_member 记录的图片尺寸
+    :param titles: 已经解压或上传成功的文件名，解压失败的成员不会留在索引里
+    """
+    image_index = get_image_index()
+    for title in titles:
+        if title in probes:
+            image_index.add(index_prefix + title, *probes[title])
+
+
+def filter_duplicate_images(kept_images, map_name):
+    """
+    同一张背景图常被多个谱面、多个分类复用
+    :param kept_images: 本次保留的图片路径
+    :param map_name:
+    :return: 与已有背景图重复的文件名集合，这些文件不需要再复制和上传
+    """
+    duplicates = get_phash_index().filter_duplicates(
+        kept_images, key_func=lambda path: f"{map_name}/{os.path.basename(path)}"
+    )
+    return {os.path.basename(path) for path in duplicates}
+
+
+def filter_duplicate_members(file_path, members, map_name):
+    """
+    直接读取压缩包成员做感知哈希去重
+    :param file_path:
+    :param members: {文件名: 压缩包内成员名}
+    :param map_name:
+    :return: 与已有背景图重复的文件名集合
+    """
+    images = [title for title in members if title.lower().endswith(IMAGE_TYPE)]
+    with zipfile.ZipFile(file_path) as zip_file:
+        duplicates = get_phash_index().filter_duplicates(
+            images, key_func=lambda title: f"{map_name}/{os.path.basename(title)}",
+            opener=lambda title: zip_file.open(members[title])
+        )
+    return {os.path.basename(title) for title in duplicates}
+
+
+def select_beatmapset_members(file_path):
+    """
+    :return: (保留的成员 {文件名: 压缩包内成员名}, 保留的图片尺寸 {文件名: [width, height, format, size]})
+    """
+    members, probes = dict(), dict()
+    with zipfile.ZipFile(file_path) as zip_file:
+        for info in zip_file.infolist():
+            title = info.filename.replace(" ", "_")
+            if title.lower().endswith(IMAGE_TYPE + MUSIC_TYPE) \
+                    and accept_beatmapset_member(zip_file, info, title, probes):
+                members[title] = info.filename
+    return members, probes
+
+
+def extract_beatmapset_members(file_path, members, target_dir):
+    """
+    把选中的成员解压到临时文件夹，全部写完后整体替换 target_dir，中途崩溃不会留下半个谱面文件夹
+    :param file_path:
+    :param members: {文件名: 压缩包内成员名}
+    :param target_dir:
+    :return: 实际解压的文件名列表
+    """
+    tmp_dir = target_dir + EXTRACTING_SUFFIX
+    shutil.rmtree(tmp_dir, ignore_errors=True)  # 上次崩溃留下的
+    os.makedirs(tmp_dir)
+    extracted = []
+    with zipfile.ZipFile(file_path) as zip_file:
+        for title, member_name in members.items():
+            local_path = os.path.normpath(os.path.join(tmp_dir, title))
+            if not local_path.startswith(os.path.normpath(tmp_dir) + os.sep):
+                logger.error(f"Skip member outside of target dir: {member_name}")
+                continue
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
             try:
-                zip_file.extract(f, target_dir)
+                with zip_file.open(member_name) as src, open(local_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
             except Exception as e:
                 logger.error(f"[zip_file.extract] error: {target_dir}, {e}")
                 continue
-            origin_item = target_dir + "/" + f
-            rename_item = target_dir + "/" + title
-            try:
-                os.rename(origin_item, rename_item)
-            except Exception:
-                logger.error("--remove--")
-                os.remove(origin_item)
-                # shutil.rmtree(target_dir)
-                # 本地保存
-                logger.error(f"{origin_item}\n{rename_item}\n{target_dir}")
-                logger.error("==remove==")
-                break
-            if title.lower().endswith(IMAGE_TYPE):
-                kbSize = os.path.getsize(rename_item) / 1024
-                if kbSize < 400.0:
-                    # 小于400kb的图片无用
-                    os.remove(rename_item)
-                else:
-                    try:
-                        shutil.copy(rename_item, total_imags_dir + "/" + map_name + "-" + title)
-                    except IOError as e:
-                        logger.error("Unable to copy file. %s" % e)
-                    except Exception:
-                        logger.error("Unexpected error:", sys.exc_info())
-            if title.lower().endswith(MUSIC_TYPE):
-                mbSize = os.path.getsize(rename_item) / 1024 / 1024
-                if mbSize < 1.0:
-                    # 小于1MB的音频无用
-                    os.remove(rename_item)
-
-    zip_file.close()
-    logger.success(f"Unzip {origin_file} successful")
-    os.remove(origin_file)
-    logger.success(f"Delete {origin_file} successful")
+            extracted.append(title)
+    replace_dir(tmp_dir, target_dir)
+    logger.success(f"Unzip {file_path} successful")
+    return extracted
+
+
+def copy_beatmapset_images(target_dir, titles, total_imags_dir, map_name, duplicates):
+    for title in titles:
+        if not title.lower().endswith(IMAGE_TYPE) or os.path.basename(title) in duplicates:
+            continue
+        try:
+            atomic_copy(os.path.join(target_dir, title),
+                        total_imags_dir + "/" + map_name + "-" + os.path.basename(title))
+        except IOError as e:
+            logger.error("Unable to copy file. %s" % e)
+        except Exception:
+            logger.error("Unexpected error:", sys.exc_info())
+
+
+def stream_beatmapset_file(category, file_path, target_dir, total_imags_dir, map_name, journal):
+    """
+    流式上传模式：选中的成员直接从压缩包上传到COS。LOCAL_EXTRACT 时再解压一份到本地供接口使用，
+    否则上传后删除压缩包，本地只保留空的谱面文件夹，文件（图片和音频）在接口访问时从COS拉回
+    :param category:
+    :param file_path:
+    :param target_dir:
+    :param total_imags_dir:
+    :param map_name:
+    :param journal:
+    :return: 上传的 Future，上传成功后才删除压缩包
+    """
+    index_prefix = f"{category}/{map_name}/"
+    selected = journal.data(STAGE_SELECTED)
+    if selected is None:
+        members, probes = select_beatmapset_members(file_path)
+        duplicates = filter_duplicate_members(file_path, members, map_name)
+        journal.mark(STAGE_SELECTED, members=members, probes=probes, duplicates=sorted(duplicates))
+    else:
+        members, probes, duplicates = selected["members"], selected.get("probes", {}), set(selected["duplicates"])
+    if journal.has(STAGE_UPLOADED):
+        # 上传已经成功，只差删除压缩包
+        upload = Future()
+        upload.set_result(journal.data(STAGE_UPLOADED)["mirrored"])
+    else:
+        upload = tencent_cos_upload_archive(COS_OSU_PATH, category, file_path, members, map_name,
+                                            skip_files=duplicates)
+    if LOCAL_EXTRACT and not journal.has(STAGE_EXTRACTED):
+        # 上传在后台进行，同时解压本地副本
+        extracted = extract_beatmapset_members(file_path, members, target_dir)
+        index_beatmapset_images(index_prefix, probes, extracted)
+        write_meta(target_dir, build_meta_from_dir(target_dir, extracted, probes))
+        copy_beatmapset_images(target_dir, extracted, total_imags_dir, map_name, duplicates)
+        journal.mark(STAGE_EXTRACTED)
+        beatmap_catalog.register(category, target_dir)
+        get_storage_manager().enforce(added=target_dir)
+
+    def finish(mirrored):
+        if mirrored is None:
+            # 保留压缩包，下次启动从压缩包重新上传
+            return mirrored
+        if not journal.has(STAGE_UPLOADED):
+            if not LOCAL_EXTRACT:
+                # 不解压时谱面一开始就处于"已淘汰"状态：保留空的谱面文件夹，接口访问时再从COS拉回
+                os.makedirs(target_dir, exist_ok=True)
+                # 只列出真正上传成功的文件（重复的图片不在其中），压缩包删除前写好
+                write_meta(target_dir, build_meta_from_zip(file_path, {title: members[title] for title in mirrored},
+                                                           probes))
+            get_storage_manager().confirm_upload(target_dir, mirrored)
+            if not LOCAL_EXTRACT:
+                index_beatmapset_images(index_prefix, probes, mirrored)
+                # 目录按已镜像的文件登记，不依赖本地副本
+                beatmap_catalog.register(category, target_dir)
+            journal.mark(STAGE_UPLOADED, mirrored=mirrored)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logger.success(f"Delete {file_path} successful")
+        return mirrored
+
+    return then(upload, finish)
+
+
+def store_beatmapset_archive(category, file_path, map_name, journal):
+    """
+    压缩包存储模式：保留压缩包并建立成员偏移索引，接口直接从压缩包读取。
+    要上传的图片解压到临时目录，上传后删除
+    :param category:
+    :param file_path:
+    :param map_name:
+    :param journal:
+    :return: 上传的 Future
+    """
+    index_prefix = f"{category}/{map_name}/"
+    members = archive_store.members(f"{category}/{map_name}") if journal.has(STAGE_INDEXED) else None
+    if members is None:
+        # 第一次处理，或者索引丢失，按同样的筛选条件重建
+        probes = dict()
+        members = build_member_index(
+            file_path,
+            accept=lambda zip_file, info, title: accept_beatmapset_member(zip_file, info, title, probes)
+        )
+        # 接口直接从压缩包读取，索引建好后成员就可以访问了
+        index_beatmapset_images(index_prefix, probes, members)
+        write_meta(os.path.splitext(file_path)[0],
+                   build_meta_from_zip(file_path, {title: member["name"] for title, member in members.items()}, probes))
+        journal.mark(STAGE_INDEXED)
+        logger.success(f"Index {file_path} successful, {len(members)} members")
+    if COS_STREAM_UPLOAD:
+        members = {title: member["name"] for title, member in members.items()}
+        duplicates = filter_duplicate_members(file_path, members, map_name)
+        return tencent_cos_upload_archive(COS_OSU_PATH, category, file_path, members, map_name, skip_files=duplicates)
+    upload_dir = tempfile.mkdtemp(prefix="osu-upload-")
+    try:
+        kept_images = []
+        with zipfile.ZipFile(file_path) as zip_file:
+            for title, member in members.items():
+                if not title.lower().endswith(IMAGE_TYPE):
+                    continue
+                local_path = os.path.join(upload_dir, os.path.basename(title))
+                with zip_file.open(member["name"]) as src, open(local_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                kept_images.append(local_path)
+        duplicates = filter_duplicate_images(kept_images, map_name)
+        upload = tencent_cos_upload(COS_OSU_PATH, category, upload_dir, map_name, skip_files=duplicates)
+    except Exception:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
+    # 临时目录等上传结束再删除
+    upload.add_done_callback(lambda _: shutil.rmtree(upload_dir, ignore_errors=True))
+    return upload
+
+
+def unzip_beatmapset_file(total_imags_dir, origin_file, target_dir, map_name):
+    """
+    解压谱面中的图片和音频，图片经过感知哈希去重后才复制到分类的 imgs 目录。
+    压缩包由调用方在记录解压完成后删除
+    :param total_imags_dir:
+    :param origin_file:
+    :param target_dir:
+    :param map_name:
+    :return: 与已有背景图重复的文件名集合，这些文件不需要再上传
+    """
+    index_prefix = f"{os.path.basename(os.path.dirname(target_dir))}/{map_name}/"
+    # 解压前判断，不合格的文件不落盘
+    members, probes = select_beatmapset_members(origin_file)
+    extracted = extract_beatmapset_members(origin_file, members, target_dir)
+    index_beatmapset_images(index_prefix, probes, extracted)
+    write_meta(target_dir, build_meta_from_dir(target_dir, extracted, probes))
+    kept_images = [os.path.join(target_dir, title) for title in extracted if title.lower().endswith(IMAGE_TYPE)]
+    duplicates = filter_duplicate_images(kept_images, map_name)
+    copy_beatmapset_images(target_dir, extracted, total_imags_dir, map_name, duplicates)
+    return duplicates
+
+
+_recovered_categories = set()  # 本进程已经恢复过的分类
+_recover_lock = threading.Lock()
+
+
+def recover_beatmapsets(category, in_flight=(), base_path=DOWNLOAD_PATH + "/download"):
+    """
+    按日志恢复上次中断的谱面，只重放没有完成的阶段。
+    每个分类在一个进程里只恢复一次：本进程后来留下的日志属于正在上传的谱面，不能再重放一遍
+    :param category: 只恢复这个分类
+    :param in_flight: 已经有上传 Future 的谱面名，跳过
+    :param base_path:
+    :return: {谱面: 上传的 Future}
+    """
+    uploads = dict()
+    with _recover_lock:
+        if category in _recovered_categories:
+            return uploads
+        _recovered_categories.add(category)
+    in_flight = {name.replace(" ", "_") for name in in_flight}  # 日志按空格替换后的文件名保存
+    for journal_category, journal in find_journals(base_path):
+        name = os.path.splitext(os.path.basename(journal.zip_path))[0]
+        if journal_category != category or name in in_flight:
+            continue
+        if not journal.has(STAGE_DOWNLOADED):
+            # 下载没完成，.part 和进度文件还在，再次下载时接着下载
+            continue
+        can_replay = os.path.isfile(journal.zip_path) or (
+                journal.has(STAGE_EXTRACTED) and not COS_STREAM_UPLOAD and not ARCHIVE_STORAGE)
+        if not can_replay and not journal.has(STAGE_UPLOADED):
+            logger.error(f"[journal] {category}/{name}: archive missing, download again")
+            journal.finish()
+            continue
+        logger.info(f"[journal] recover {category}/{name}, done: {list(journal.stages)}")
+        try:
+            uploads[name] = process_beatmapset_file(category, name, journal)
+        except Exception as e:
+            logger.error(f"[journal] recover {category}/{name} error: {e}")
+    return uploads
 
 
 def get_file_duration(path):
@@ -203,6 +527,7 @@ def get_file_duration(path):
 class Downloader:
     def __init__(self, limit, no_video, params, certification, category, no_cmd=False):
         self.beatmapsets = set()
+        self.uploads = dict()  # 谱面 -> 上传的 Future
         self.limit = limit
         self.no_video = no_video
         self.category = category
@@ -216,6 +541,7 @@ class Downloader:
         else:
             self.cred_helper.load_credentials()
         self.session = requests.Session()
+        self.uploads.update(recover_beatmapsets(self.category, self.uploads))  # 先补完上次中断的谱面
 
         self.login()  # 登录，获取登录态
         self.scrape_beatmapsets(params)  # 获取top谱图
@@ -271,13 +597,25 @@ class Downloader:
             num_beatmapsets = len(self.beatmapsets)
         logger.success(f"Scraped {num_beatmapsets} beatmapsets")
 
+    @staticmethod
+    def is_mirrored(dir_path):
+        # 流式上传且不解压时本地没有文件夹，只在 storage_manager 里有记录
+        storage_manager = get_storage_manager()
+        return storage_manager.key(dir_path) in storage_manager.load_mirrored()
+
     def remove_existing_beatmapsets(self):
         filtered_set = set()
         for beatmapset in self.beatmapsets:
             name = str(beatmapset).replace(" ", "_")
             dir_path = os.path.join(DOWNLOAD_PATH + "/download/" + self.category, name)
             file_path = dir_path + ".zip"
-            if os.path.isdir(dir_path) or os.path.isfile(file_path):
+            journal = PipelineJournal(file_path)
+            if journal.exists() and not journal.has(STAGE_DOWNLOADED):
+                # 上次没下载完，文件夹或压缩包可能只是半成品，接着下载
+                filtered_set.add(beatmapset)
+                continue
+            # 已下载但没处理完的谱面由启动时的恢复继续处理
+            if journal.exists() or os.path.isdir(dir_path) or os.path.isfile(file_path) or self.is_mirrored(dir_path):
                 logger.error(f"BeatMapSet already downloaded: {beatmapset}")
                 continue
             filtered_set.add(beatmapset)
@@ -289,37 +627,58 @@ class Downloader:
         download_url = beatmapset.url + "/download"
         if self.no_video:
             download_url += "?noVideo=1"  # 不下载视频
-        resp = self.session.get(download_url, headers=headers)
-        if resp.status_code == requests.codes.ok:
-            logger.success(f"{str(beatmapset)} - {resp.status_code} - Download successful")
-            write_beatmapset_file(self.category, str(beatmapset), resp.content)
-            return True
-        else:
-            logger.warning(f"{resp.status_code} - Download failed")
+        file_path = beatmapset_file_path(self.category, str(beatmapset))
+        PipelineJournal(file_path).mark(STAGE_STARTED)
+        try:
+            # 分段并发下载，中断后下次只补没下完的部分
+            size = download_file(self.session, download_url, file_path, headers=headers)
+        except (requests.RequestException, DownloadError) as e:
+            logger.warning(f"{e} - Download failed")
             return False
+        logger.success(f"{str(beatmapset)} - {size} bytes - Download successful")
+        # 上传交给常驻的上传服务，不等上传完成就开始下载下一个谱面
+        self.uploads[str(beatmapset)] = write_beatmapset_file(self.category, str(beatmapset))
+        return True
 
     def run(self):
         tries = 0
-        while self.beatmapsets:
-            next_set = self.beatmapsets.pop()
-            # 开始下载
-            download_success = self.download_beatmapset_file(next_set)
-            if download_success:
-                tries = 0
-                time.sleep(2)
-            else:
-                self.beatmapsets.add(next_set)
-                tries += 1
-                if tries > 4:
-                    logger.error("Failed 5 times in a row")
-                    logger.info("Website download limit reached")
-                    logger.info("Try again later")
-                    logger.info(" DOWNLOADER TERMINATED ".center(50, "#") + "\n")
-                    # sys.exit()
-                    raise ValueError("DOWNLOADER TERMINATED")
-
+        try:
+            while self.beatmapsets:
+                next_set = self.beatmapsets.pop()
+                # 开始下载
+                download_success = self.download_beatmapset_file(next_set)
+                if download_success:
+                    tries = 0
+                    time.sleep(2)
+                else:
+                    self.beatmapsets.add(next_set)
+                    tries += 1
+                    if tries > 4:
+                        logger.error("Failed 5 times in a row")
+                        logger.info("Website download limit reached")
+                        logger.info("Try again later")
+                        logger.info(" DOWNLOADER TERMINATED ".center(50, "#") + "\n")
+                        # sys.exit()
+                        raise ValueError("DOWNLOADER TERMINATED")
+        finally:
+            # 中途终止也要等已提交的上传结束，否则下一个分类的下载器会和它们同时处理同一批谱面
+            self.wait_uploads()
         logger.info(" DOWNLOADER FINISHED ".center(50, "#") + "\n")
 
+    def wait_uploads(self):
+        logger.info(f"Waiting for {len(self.uploads)} beatmapset uploads")
+        failed = []
+        for name, upload in self.uploads.items():
+            try:
+                if upload.result() is None:
+                    failed.append(name)
+            except Exception as e:
+                logger.error(f"Upload {name} error: {e}")
+                failed.append(name)
+        if failed:
+            logger.error(f"Upload failed: {failed}")
+        self.uploads.clear()
+
 
 def main():
     parser = argparse.ArgumentParser("osu-beatmap-downloader")
@@ -341,6 +700,11 @@ def main():
         help="Downloads beatmaps without video files",
         action="store_true",
     )
+    parser_downloader.add_argument(
+        "--profile",
+        help="Sample all threads during the run and write folded stacks to logs/profile",
+        action="store_true",
+    )
 
     parser_credentials = subparsers.add_parser(
         "credentials", help="Manage your login credentials"
@@ -355,8 +719,7 @@ def main():
 
     args = parser.parse_args()
     if args.command == "download":
-        loader = Downloader(args.limit, args.no_video, None, None, "none")
-        loader.run()
+        run_downloader(lambda: Downloader(args.limit, args.no_video, None, None, "none"), args.profile)
     elif args.command == "credentials":
         if args.check:
             if os.path.exists(CREDS_FILEPATH):
@@ -371,9 +734,29 @@ def main():
                 print("There is no credential file to delete")
 
 
-def no_cmd_download(limit: int, category: str, params: Dict[str, str], certification: Dict[str, str]):
-    loader = Downloader(limit, "store_true", params, certification, category, True)
-    loader.run()
+def run_downloader(create_loader, profile=False, name="downloader"):
+    """
+    :param create_loader: 登录和抓取列表在 Downloader 构造时进行，也要计入分析
+    :param profile: 采样整个运行过程，折叠格式的调用栈写到 logs/profile
+    :param name: 分析结果的文件名前缀
+    :return:
+    """
+    if not profile:
+        create_loader().run()
+        return
+    # 分段下载、哈希、上传都在其他线程，采样所有线程，调用栈以线程名开头
+    profiler = SamplingProfiler(all_threads=True).start()
+    try:
+        create_loader().run()
+    finally:
+        profiler.stop()
+        profiler.write(name)
+
+
+def no_cmd_download(limit: int, category: str, params: Dict[str, str], certification: Dict[str, str],
+                    profile: bool = False):
+    run_downloader(lambda: Downloader(limit, "store_true", params, certification, category, True), profile,
+                   name=f"downloader-{category}")
 
 
 def update_daywise():
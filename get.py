@@ -1,23 +1,86 @@
-import datetime
 import random
 
-from tencent_cloud import tencent_cos_imag_list
 from loguru import logger
 
+from const import OSU_PIC_TTL
+from shared_catalog import shared_catalog
+
 
 class OsuPic:
-    def __init__(self):
-        self.img_table = dict()
-        self.img_list = list()
-        self.last_update = datetime.datetime.now()
+    """
+    图片池保存在共享目录文件里，所有 worker 共用一份，只有一个 worker 负责从COS刷新
+    """
+
+    def __init__(self, catalog=shared_catalog):
+        self.catalog = catalog
+
+    @property
+    def img_list(self):
+        return self.catalog.section("osu_pic") or []
+
+    @property
+    def img_table(self):
+        img_list = self.img_list
+        return {category: img_list[start:end] for category, (start, end) in self.category_ranges().items()}
+
+    def category_ranges(self):
+        """
+        :return: {分类: (起始下标, 结束下标)}，分类内的图片在 img_list 中是连续的
+        """
+        ranges = dict()
+        for row in self.catalog.section("osu_pic_categories") or []:
+            category, start, end = row.split("\t")
+            # COS 列出的分类是以 "/" 结尾的前缀，对外用不带 "/" 的分类名，与 /random_beatmaps 一致
+            ranges[category.rstrip("/")] = (int(start), int(end))
+        return ranges
+
+    @staticmethod
+    def load():
+        from tencent_cloud import tencent_cos_imag_list
+
+        logger.info("update OsuPic")
+        img_table, img_list = tencent_cos_imag_list()
+        # img_list 按分类顺序拼接，分类表记录每个分类的区间
+        rows, start = [], 0
+        for category, urls in img_table.items():
+            rows.append(f"{category}\t{start}\t{start + len(urls)}")
+            start += len(urls)
+        return {"osu_pic": img_list, "osu_pic_categories": rows}
+
+    def warm(self):
+        if self.catalog.is_stale("osu_pic", OSU_PIC_TTL):
+            self.catalog.refresh_in_background("osu_pic", OSU_PIC_TTL, self.load)
+
+    def pool(self):
+        img_list = self.img_list
+        if len(img_list) < 1:
+            # 没有任何可用数据时只能同步等待
+            self.catalog.refresh("osu_pic", OSU_PIC_TTL, self.load, blocking=True)
+            img_list = self.img_list
+        elif self.catalog.is_stale("osu_pic", OSU_PIC_TTL):
+            # 过期的图片池先继续用，后台刷新
+            self.catalog.refresh_in_background("osu_pic", OSU_PIC_TTL, self.load)
+        return img_list
 
     def random_pic(self):
-        now_time = datetime.datetime.now()
-        if now_time > self.last_update + datetime.timedelta(hours=1) or len(self.img_list) < 1:
-            logger.info("update OsuPic")
-            self.img_table, self.img_list = tencent_cos_imag_list()
-            self.last_update = now_time
-        return random.choice(self.img_list)
+        img_list = self.pool()
+        return img_list[random.randrange(len(img_list))]
+
+    def random_pics(self, n, category=None):
+        """
+        一次取多张不重复的图片，只按下标抽样，不复制整个图片池
+        :param n: 图片池不够时返回全部
+        :param category: 只在该分类下抽取
+        :return:
+        """
+        img_list = self.pool()
+        start, end = 0, len(img_list)
+        if category is not None:
+            ranges = self.category_ranges()
+            if category not in ranges:
+                raise KeyError(category)
+            start, end = ranges[category]
+        return [img_list[i] for i in random.sample(range(start, end), min(n, end - start))]
 
 
 osu_pic = OsuPic()
@@ -0,0 +1,186 @@
+import os
+import threading
+
+import numpy as np
+from loguru import logger
+
+from const import PHASH_INDEX_PATH, PHASH_MAX_DISTANCE
+
+HASH_SIZE = 8  # 8x8 低频系数 -> 64bit
+SAMPLE_SIZE = 32  # 缩小到 32x32 再做DCT
+
+
+def _dct_matrix(n):
+    # DCT-II 正交矩阵，D @ X @ D.T 即二维DCT
+    k = np.arange(n).reshape(-1, 1)
+    i = np.arange(n).reshape(1, -1)
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0, :] = np.sqrt(1.0 / n)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(SAMPLE_SIZE)[:HASH_SIZE]  # 只需要前 HASH_SIZE 行
+BIT_WEIGHTS = (np.uint64(1) << np.arange(HASH_SIZE * HASH_SIZE, dtype=np.uint64)[::-1])
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def load_gray_sample(path):
+    """
+    读取并缩小为 SAMPLE_SIZE x SAMPLE_SIZE 灰度矩阵
+    :param path: 文件路径或文件对象
+    :return:
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        # JPEG 在解码阶段直接降采样，大图只解码一小部分像素
+        img.draft("L", (SAMPLE_SIZE * 4, SAMPLE_SIZE * 4))
+        img = img.convert("L").resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.BILINEAR)
+        return np.asarray(img, dtype=np.float64)
+
+
+def phash_batch(samples):
+    """
+    一次性计算多张图的感知哈希
+    :param samples: N x SAMPLE_SIZE x SAMPLE_SIZE 的灰度矩阵
+    :return: N 个 uint64 哈希
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.ndim == 2:
+        samples = samples[np.newaxis]
+    low = np.einsum("ij,njk,lk->nil", DCT_MATRIX, samples, DCT_MATRIX)
+    low = low.reshape(len(samples), -1)
+    # 去掉直流分量后取中位数，系数大于中位数记为1
+    medians = np.median(low[:, 1:], axis=1, keepdims=True)
+    bits = (low > medians).astype(np.uint64)
+    return (bits * BIT_WEIGHTS).sum(axis=1, dtype=np.uint64)
+
+
+def phash_files(paths, opener=None):
+    """
+    :param paths:
+    :param opener: opener(path) -> 文件对象，比如直接读取压缩包成员；默认按本地路径读取
+    :return: {path: hash}，读取失败的图片不在结果里
+    """
+    loaded_paths, samples = [], []
+    for path in paths:
+        try:
+            samples.append(load_gray_sample(path if opener is None else opener(path)))
+            loaded_paths.append(path)
+        except Exception as e:
+            logger.error(f"[phash] unable to read {path}: {e}")
+    if not samples:
+        return {}
+    return dict(zip(loaded_paths, (int(h) for h in phash_batch(np.stack(samples)))))
+
+
+def hamming_distances(hashes, target):
+    """
+    向量化计算 target 与所有哈希的汉明距离
+    :param hashes: uint64 数组
+    :param target:
+    :return: uint8 数组
+    """
+    xor = np.bitwise_xor(hashes, np.uint64(target))
+    if hasattr(np, "bitwise_count"):  # numpy>=2.0 自带popcount
+        return np.bitwise_count(xor)
+    return POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+class PHashIndex:
+    """
+    持久化的感知哈希索引，文件每行 `哈希(16位十六进制)\\t键`，只追加不重写
+    """
+
+    def __init__(self, index_path=PHASH_INDEX_PATH):
+        self.index_path = index_path
+        self.hashes = np.empty(1024, dtype=np.uint64)
+        self.keys = []
+        self.known_hashes = dict()  # 键 -> 最后一次写入的哈希
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+        hashes = []
+        with open(self.index_path, "r", encoding="utf-8") as index_file:
+            for line in index_file:
+                hex_hash, _, key = line.rstrip("\n").partition("\t")
+                if not key:
+                    continue
+                hashes.append(int(hex_hash, 16))
+                self.keys.append(key)
+        self.hashes = np.empty(max(1024, len(hashes) * 2), dtype=np.uint64)
+        self.hashes[:len(hashes)] = np.array(hashes, dtype=np.uint64)
+        self.known_hashes = dict(zip(self.keys, hashes))
+        logger.info(f"[phash] loaded {len(self.keys)} hashes from {self.index_path}")
+
+    def find(self, image_hash, max_distance=PHASH_MAX_DISTANCE, exclude=None):
+        """
+        :param image_hash:
+        :param max_distance:
+        :param exclude: exclude(键) -> 是否跳过，比如同一个谱面里的图片
+        :return: 距离最近的 (键, 距离)，没有足够接近的返回 None
+        """
+        with self.lock:
+            count = len(self.keys)
+            if count == 0:
+                return None
+            distances = hamming_distances(self.hashes[:count], image_hash)
+            # 足够接近的一般只有几个，按距离从近到远跳过被排除的键
+            candidates = np.flatnonzero(distances <= max_distance)
+            for best in candidates[np.argsort(distances[candidates], kind="stable")]:
+                if exclude is None or not exclude(self.keys[best]):
+                    return self.keys[best], int(distances[best])
+            return None
+
+    def add(self, image_hash, key):
+        image_hash = int(image_hash)
+        with self.lock:
+            count = len(self.keys)
+            if count == len(self.hashes):
+                grown = np.empty(count * 2, dtype=np.uint64)
+                grown[:count] = self.hashes
+                self.hashes = grown
+            self.hashes[count] = image_hash
+            self.keys.append(key)
+            self.known_hashes[key] = image_hash
+            index_dir = os.path.dirname(self.index_path)
+            if index_dir:
+                os.makedirs(index_dir, exist_ok=True)
+            with open(self.index_path, "a", encoding="utf-8") as index_file:
+                index_file.write(f"{image_hash:016x}\t{key}\n")
+
+    def filter_duplicates(self, paths, key_func=os.path.basename, opener=None):
+        """
+        对一批图片去重：与索引或本批中已出现的其他谱面的图片足够接近的视为重复，其余写入索引
+        :param paths:
+        :param key_func: 由路径生成索引中保存的键，`谱面名/文件名` 形式的键不和同一个谱面里的图片比较
+        :param opener: 见 phash_files
+        :return: {重复图片路径: 已存在的键}
+        """
+        duplicates = dict()
+        for path, image_hash in phash_files(paths, opener).items():
+            key = key_func(path)
+            set_name = key.rpartition("/")[0]
+            # 重新处理同一个谱面时会找到自己，同一个谱面里相似的图片也不算重复
+            found = self.find(image_hash, exclude=lambda other: other == key
+                              or bool(set_name) and other.rpartition("/")[0] == set_name)
+            if found is not None:
+                duplicates[path] = found[0]
+                logger.info(f"[phash] {path} duplicates {found[0]} (distance {found[1]})")
+                continue
+            if self.known_hashes.get(key) != image_hash:
+                self.add(image_hash, key)
+        return duplicates
+
+
+_phash_index = None
+
+
+def get_phash_index():
+    global _phash_index
+    if _phash_index is None:
+        _phash_index = PHashIndex()
+    return _phash_index
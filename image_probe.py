@@ -0,0 +1,163 @@
+import json
+import os
+import struct
+import threading
+
+from loguru import logger
+
+from const import IMAGE_INDEX_PATH, IMAGE_MIN_WIDTH, IMAGE_MIN_HEIGHT, IMAGE_MIN_ASPECT, IMAGE_MAX_ASPECT
+from stream_utils import PrefixedStream, read_exact
+
+# 不带尺寸信息的 JPEG 标记：TEM、RST0-7、SOI、EOI
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9}
+# SOF0-SOF15，除去 DHT(C4)、JPG(C8)、DAC(CC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _probe_jpeg(stream):
+    # 文件头的 FFD8 已经读过，逐段跳过直到 SOF
+    while True:
+        byte = read_exact(stream, 1)
+        while byte != b"\xff":
+            byte = read_exact(stream, 1)
+        marker = read_exact(stream, 1)[0]
+        while marker == 0xFF:  # 填充字节
+            marker = read_exact(stream, 1)[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        length = struct.unpack(">H", read_exact(stream, 2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">xHH", read_exact(stream, 5))
+            return width, height
+        # ZipExtFile 不一定能 seek，直接读掉该段
+        read_exact(stream, length - 2)
+
+
+def probe_image(stream):
+    """
+    只读取文件头部得到图片尺寸和格式，不解码像素
+    :param stream: 二进制文件对象，可以是 zip 成员
+    :return: (width, height, format)，无法识别返回 None
+    """
+    try:
+        head = stream.read(30)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", head[16:24])
+            return width, height, "png"
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            width, height = struct.unpack("<HH", head[6:10])
+            return width, height, "gif"
+        if head[:2] == b"BM":
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height), "bmp"
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            chunk = head[12:16]
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", head[26:30])
+                return width & 0x3FFF, height & 0x3FFF, "webp"
+            if chunk == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, "webp"
+            if chunk == b"VP8X":
+                width = int.from_bytes(head[24:27], "little") + 1
+                height = int.from_bytes(head[27:30], "little") + 1
+                return width, height, "webp"
+            return None
+        if head[:2] == b"\xff\xd8":
+            width, height = _probe_jpeg(PrefixedStream(head[2:], stream))
+            return width, height, "jpeg"
+    except (ValueError, struct.error) as e:
+        logger.debug(f"[probe] unable to parse image header: {e}")
+    return None
+
+
+def passes_quality(width, height, min_width=IMAGE_MIN_WIDTH, min_height=IMAGE_MIN_HEIGHT,
+                   min_aspect=IMAGE_MIN_ASPECT, max_aspect=IMAGE_MAX_ASPECT):
+    """
+    分辨率和长宽比过滤，背景图太小或者比例奇怪的都不要
+    """
+    if width < min_width or height < min_height or height == 0:
+        return False
+    return min_aspect <= width / height <= max_aspect
+
+
+class ImageDimensionIndex:
+    """
+    持久化的图片尺寸索引，jsonl 文件只追加，同一个键以最后一行为准。
+    接口进程查询前检查文件是否变化，只解析下载进程新追加的行
+    """
+
+    def __init__(self, index_path=IMAGE_INDEX_PATH):
+        self.index_path = index_path
+        self.entries = dict()
+        self.loaded = (None, 0)  # (inode, 已读到的位置)
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            inode, position = self.loaded
+            if inode != stat.st_ino or stat.st_size < position:
+                # 文件被替换过，从头读
+                self.entries, position = dict(), 0
+            if stat.st_size == position:
+                return
+            with open(self.index_path, "rb") as index_file:
+                index_file.seek(position)
+                data = index_file.read()
+            # 最后一行可能还没写完，留到下次
+            data = data[:data.rfind(b"\n") + 1]
+            for line in data.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry["key"]] = entry
+            self.loaded = (stat.st_ino, position + len(data))
+
+    def add(self, key, width, height, image_format, size):
+        entry = {"key": key, "width": width, "height": height, "format": image_format, "size": size}
+        with self.lock:
+            self.entries[key] = entry
+            index_dir = os.path.dirname(self.index_path)
+            if index_dir:
+                os.makedirs(index_dir, exist_ok=True)
+            with open(self.index_path, "a", encoding="utf-8") as index_file:
+                index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+    def query(self, prefix="", min_width=0, min_height=0, min_aspect=0.0, max_aspect=float("inf"), limit=100):
+        """
+        :param prefix: 键前缀，比如 "分类/" 或 "分类/谱面/"
+        :param min_width:
+        :param min_height:
+        :param min_aspect:
+        :param max_aspect:
+        :param limit:
+        :return:
+        """
+        self.load()
+        res = []
+        for key, entry in list(self.entries.items()):
+            if not key.startswith(prefix):
+                continue
+            if not passes_quality(entry["width"], entry["height"], min_width, min_height, min_aspect, max_aspect):
+                continue
+            res.append(entry)
+            if len(res) >= limit:
+                break
+        return res
+
+
+_image_index = None
+
+
+def get_image_index():
+    global _image_index
+    if _image_index is None:
+        _image_index = ImageDimensionIndex()
+    return _image_index
@@ -0,0 +1,205 @@
+import asyncio
+import bisect
+import hashlib
+import io
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+from const import RENDITION_CACHE_DIR, RENDITION_CACHE_MAX_BYTES, RENDITION_WIDTHS, RENDITION_FORMATS, \
+    RENDITION_QUALITY, RENDITION_WORKERS
+
+
+def snap_width(width):
+    """
+    把任意宽度向上取整到固定档位，避免缓存被任意宽度撑爆
+    :param width:
+    :return:
+    """
+    index = bisect.bisect_left(RENDITION_WIDTHS, width)
+    if index >= len(RENDITION_WIDTHS):
+        return RENDITION_WIDTHS[-1]
+    return RENDITION_WIDTHS[index]
+
+
+def format_supported(fmt):
+    """
+    当前安装的 Pillow 能否编码该格式，比如 AVIF 需要较新的版本
+    :param fmt: RENDITION_FORMATS 的键
+    :return:
+    """
+    from PIL import Image
+
+    if fmt not in RENDITION_FORMATS:
+        return False
+    Image.init()
+    return RENDITION_FORMATS[fmt][0] in Image.SAVE
+
+
+def render_rendition(src_path, dst_path, width, fmt, quality=RENDITION_QUALITY):
+    """
+    在工作进程中生成缩放图，先写临时文件再重命名，读者不会看到写了一半的文件
+    :param src_path: 原图路径，或者 (压缩包路径, 成员名)
+    :param dst_path: 输出路径
+    :param width: 目标宽度，原图更窄时不放大
+    :param fmt: RENDITION_FORMATS 的键
+    :param quality:
+    :return: 输出文件大小
+    """
+    from PIL import Image
+
+    pil_format = RENDITION_FORMATS[fmt][0]
+    if isinstance(src_path, tuple):
+        with zipfile.ZipFile(src_path[0]) as zip_file:
+            return _render(Image.open(io.BytesIO(zip_file.read(src_path[1]))), dst_path, width, pil_format, quality)
+    return _render(Image.open(src_path), dst_path, width, pil_format, quality)
+
+
+def _render(img, dst_path, width, pil_format, quality):
+    from PIL import Image
+
+    with img:
+        if img.width > width:
+            height = max(1, round(img.height * width / img.width))
+            # JPEG 可以在解码时直接按比例缩小，省掉大部分解码开销
+            img.draft("RGB", (width, height))
+            img = img.resize((width, height), Image.LANCZOS)
+        if pil_format == "JPEG" or img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+        tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+        img.save(tmp_path, pil_format, quality=quality, optimize=pil_format == "JPEG")
+    os.replace(tmp_path, dst_path)
+    return os.path.getsize(dst_path)
+
+
+class RenditionCache:
+    """
+    磁盘上的LRU缓存，按总字节数限制容量
+    """
+
+    def __init__(self, cache_dir=RENDITION_CACHE_DIR, max_bytes=RENDITION_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load()
+
+    def load(self):
+        # 重启后按 mtime 恢复访问顺序，命中时会 touch 文件
+        files = []
+        for file in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file)
+            if file.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, file, stat.st_size))
+        for _, file, size in sorted(files):
+            self.entries[file] = size
+            self.total_bytes += size
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+        return path
+
+    def put(self, key, size):
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(self.path(key))
+                except FileNotFoundError:
+                    pass
+
+
+class RenditionService:
+    """
+    按需生成缩放图：进程池里做解码和编码，不占事件循环；同一份缩放图的并发请求只生成一次
+    """
+
+    def __init__(self, workers=RENDITION_WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.cache = None
+        self.pending = dict()
+
+    def start(self):
+        if self.cache is None:
+            self.cache = RenditionCache()
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    @staticmethod
+    def cache_key(src_path, width, fmt):
+        if isinstance(src_path, tuple):
+            stat = os.stat(src_path[0])
+            source = f"{os.path.abspath(src_path[0])}:{src_path[1]}"
+        else:
+            stat = os.stat(src_path)
+            source = os.path.abspath(src_path)
+        raw = f"{source}|{stat.st_mtime_ns}|{stat.st_size}|{width}|{fmt}|{RENDITION_QUALITY}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest() + "." + RENDITION_FORMATS[fmt][0].lower()
+
+    async def get(self, src_path, width, fmt, key=None):
+        """
+        :param src_path: 原图路径，或者 (压缩包路径, 成员名)
+        :param width: 已经 snap 过的宽度
+        :param fmt:
+        :param key: 调用方已经算好的缓存键
+        :return: (缓存文件路径, 缓存键)
+        """
+        self.start()
+        if key is None:
+            key = self.cache_key(src_path, width, fmt)
+        path = self.cache.get(key)
+        if path is not None:
+            return path, key
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.generate(src_path, width, fmt, key))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(task), key
+
+    async def generate(self, src_path, width, fmt, key):
+        path = self.cache.path(key)
+        loop = asyncio.get_running_loop()
+        size = await loop.run_in_executor(self.executor, render_rendition, src_path, path, width, fmt)
+        self.cache.put(key, size)
+        logger.debug(f"rendition generated: {src_path} {width} {fmt} {size}")
+        return path
+
+
+rendition_service = RenditionService()
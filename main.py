@@ -1,19 +1,28 @@
+import asyncio
 import os
-import random
 import sys
-from typing import Dict, Tuple
+from typing import List
 
 import uvicorn
-from fastapi import FastAPI, Body
-from fastapi.responses import StreamingResponse
-from const import DOWNLOAD_RES_PATH, PROJECT_NAME, DESCRIPTION, VERSION, DEBUG, LOG_DIR
-from constom_log import InterceptHandler, format_record
+from fastapi import FastAPI, Body, Query, Request, HTTPException
+from fastapi.responses import StreamingResponse, FileResponse, Response
+from const import DOWNLOAD_RES_PATH, PROJECT_NAME, DESCRIPTION, VERSION, DEBUG, LOG_FILE_PATTERN, LOG_JSON, \
+    RENDITION_FORMATS, RENDITION_CACHE_MAX_AGE, BATCH_MAX_SIZE
+from constom_log import InterceptHandler, AccessLogSampler, BatchedSink, format_record
+from catalog import beatmap_catalog
 from get import osu_pic
+from image_rendition import rendition_service, snap_width, format_supported
+from image_probe import get_image_index
+from storage_manager import get_storage_manager
 from main_website_pic_bed import get_main_website_pic_bed_categories, get_pic_bed_by_category
-from utils import show_folder_files, show_beatmap
+from archive_store import archive_store, archive_path
+from beatmap_meta import beatmap_meta_store
+from profiler import ProfileMiddleware, profiling_enabled
+from utils import show_beatmap, show_folder_files
 import logging
 from loguru import logger
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 
 def init_app():
@@ -32,38 +41,120 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if profiling_enabled():
+    app.add_middleware(ProfileMiddleware)
 
 
 @app.on_event("startup")
 async def startup_event():
     logging.getLogger("uvicorn").handlers.clear()
     # logging.getLogger().handlers = [InterceptHandler()]
+    # 日志由后台线程批量写出，请求路径上只入队
+    app.log_sinks = [BatchedSink(stream=sys.stdout), BatchedSink(path_pattern=LOG_FILE_PATTERN)]
     logger.configure(
         handlers=[{
-            "sink": sys.stdout,
+            "sink": app.log_sinks[0],
             "level": logging.DEBUG,
-            "format": format_record
+            "format": format_record,
+            "colorize": sys.stdout.isatty(),
+            "serialize": LOG_JSON
+        }, {
+            "sink": app.log_sinks[1],
+            "level": logging.DEBUG,
+            "format": format_record,
+            "colorize": False,
+            "serialize": LOG_JSON
         }]
     )
-    logger.add(LOG_DIR, encoding="utf-8", rotation="9:46")
     logger.debug("日志系统已加载")
-    logging.getLogger("uvicorn.access").handlers = [InterceptHandler()]
+    access_handler = InterceptHandler()
+    access_handler.addFilter(AccessLogSampler())
+    logging.getLogger("uvicorn.access").handlers = [access_handler]
     logging.getLogger("uvicorn").handlers = [InterceptHandler()]
     app.logger = logger
+    # 共享目录文件已经在导入时映射，过期的部分在后台刷新，不阻塞启动
+    osu_pic.warm()
+    beatmap_catalog.warm()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    rendition_service.shutdown()
+    get_storage_manager().flush_access()
+    logger.remove()  # 写完日志队列
+
+
+async def ensure_local(name, listing=False):
+    """
+    记录访问时间，谱面文件已被淘汰时从COS拉回
+    :param name:
+    :param listing: 只需要文件列表时，有元数据 sidecar 的谱面直接读 sidecar，不拉回文件
+    :return:
+    """
+    storage_manager = get_storage_manager()
+    if not beatmap_catalog.contains(name) and name not in storage_manager.load_mirrored():
+        return  # 不存在的谱面，不记录访问时间，否则每个 404 请求都会在访问记录里留下一项
+    storage_manager.touch(name)
+    if listing and beatmap_meta_store.exists(name):
+        return
+    if storage_manager.is_evicted(name):
+        await run_in_threadpool(storage_manager.rehydrate, name)
+
+
+async def show_beatmaps(paths):
+    """
+    批量读取多个谱面的文件列表，被淘汰的谱面并发拉回，列目录合并到一次线程池调用
+    :param paths: 相对下载目录的路径
+    :return:
+    """
+    await asyncio.gather(*(ensure_local(path, listing=True) for path in paths))
+    return await run_in_threadpool(lambda: [show_beatmap(path) for path in paths])
+
+
+def locate_file(folder, file_name):
+    """
+    :return: 本地文件路径；只在压缩包里时为 (压缩包路径, 成员名)；都没有时为 None
+    """
+    file_path = os.path.join(DOWNLOAD_RES_PATH, folder, file_name)
+    if os.path.isfile(file_path):
+        return file_path
+    member = archive_store.member(folder, file_name)
+    if member is None:
+        return None
+    return archive_path(folder), member["name"]
+
+
+@app.get("/log_stats")
+async def log_stats():
+    return {
+        "data": [sink.snapshot() for sink in app.log_sinks]
+    }
 
 
 @app.get("/random_beatmap")
 async def random_beatmap():
-    total_folder = show_folder_files(DOWNLOAD_RES_PATH)
-    random_index = random.randint(0, len(total_folder) - 1)
-
-    random_result = show_beatmap(total_folder[random_index])
+    name = beatmap_catalog.random_name()
+    path = beatmap_catalog.resolve(name)
+    await ensure_local(path, listing=True)
+    random_result = show_beatmap(path)
     return {
-        "name": total_folder[random_index],
+        "name": name,
         "data": random_result
     }
 
 
+@app.get("/random_beatmaps")
+async def random_beatmaps(
+        n: int = Query(10, gt=0, le=BATCH_MAX_SIZE, title='数量，不重复'),
+        category: str = Query(None, title='分类')
+):
+    rows = beatmap_catalog.random_rows(n, category)
+    results = await show_beatmaps([row.path for row in rows])
+    return {
+        "data": [{"name": row.name, "data": result} for row, result in zip(rows, results)]
+    }
+
+
 @app.get("/random_pic")
 async def random_pic():
     return {
@@ -71,14 +162,96 @@ async def random_pic():
     }
 
 
+@app.get("/random_pics")
+async def random_pics(
+        n: int = Query(10, gt=0, le=BATCH_MAX_SIZE, title='数量，不重复'),
+        category: str = Query(None, title='分类')
+):
+    try:
+        data = osu_pic.random_pics(n, category)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"unknown category: {category}")
+    return {
+        "data": data
+    }
+
+
 @app.get("/beatmap_list")
-async def beatmap_list():
-    return show_folder_files(DOWNLOAD_RES_PATH)
+async def beatmap_list(
+        cursor: str = Query(None, title='上一页返回的游标，过滤条件需与上一页一致'),
+        limit: int = Query(None, gt=0, le=500, title='每页数量'),
+        sort: str = Query(None, title='排序 set_id/mtime'),
+        order: str = Query("asc", title='asc/desc'),
+        category: str = Query(None, title='分类'),
+        has_images: bool = Query(None),
+        has_audio: bool = Query(None)
+):
+    if cursor is None and limit is None and sort is None and category is None \
+            and has_images is None and has_audio is None:
+        # 兼容旧的调用方式，和以前一样返回下载目录下的一级文件夹
+        return await run_in_threadpool(show_folder_files, DOWNLOAD_RES_PATH)
+    try:
+        data, next_cursor, total = beatmap_catalog.page(
+            sort=sort or "set_id", descending=order == "desc", category=category,
+            has_images=has_images, has_audio=has_audio, cursor=cursor, limit=limit or 50
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "data": data,
+        "next_cursor": next_cursor,
+        "total": total
+    }
+
+
+@app.get("/search")
+async def search(
+        q: str = Query(..., min_length=1, title='关键词，支持 set id、艺术家、标题、分类'),
+        limit: int = Query(20, gt=0, le=100),
+        category: str = Query(None, title='只在该分类下检索')
+):
+    return {
+        "data": beatmap_catalog.search(q, limit, category)
+    }
 
 
 @app.get("/beatmap/{name}")
 async def beatmap(name: str):
-    return show_beatmap(name)
+    path = beatmap_catalog.resolve(name)
+    await ensure_local(path, listing=True)
+    return show_beatmap(path)
+
+
+@app.post("/beatmaps")
+async def beatmaps(
+        names: List[str] = Body(..., title='谱面名列表', embed=True)
+):
+    """
+    一次取多个谱面的文件列表，目录里没有的谱面返回 null
+    """
+    names = list(dict.fromkeys(names))
+    if len(names) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"at most {BATCH_MAX_SIZE} names")
+    rows = [beatmap_catalog.lookup(name) for name in names]
+    found = [row for row in rows if row is not None]
+    results = dict(zip((row.name for row in found), await show_beatmaps([row.path for row in found])))
+    return {
+        "data": {name: results.get(name) for name in names}
+    }
+
+
+@app.get("/image_index")
+async def image_index(
+        prefix: str = Query("", title='键前缀 分类/谱面/'),
+        min_width: int = Query(0, ge=0),
+        min_height: int = Query(0, ge=0),
+        min_aspect: float = Query(0.0, ge=0),
+        max_aspect: float = Query(float("inf"), gt=0),
+        limit: int = Query(100, gt=0, le=1000)
+):
+    return {
+        "data": get_image_index().query(prefix, min_width, min_height, min_aspect, max_aspect, limit)
+    }
 
 
 @app.get("/main_website_pic/category/total")
@@ -95,7 +268,7 @@ async def get_main_website_pic_bed_by_category(
         marker: str = Body(None, title='marker'),
         size: int = Body(30, title='数量')
 ):
-    print(marker, size)
+    logger.debug(f"pic bed list: {category} {marker} {size}")
     res = get_pic_bed_by_category(category, marker, size)
     return {
         "data": res
@@ -103,14 +276,48 @@ async def get_main_website_pic_bed_by_category(
 
 
 @app.get("/image/{folder}/{image_name}", deprecated=True)
-async def image(folder: str, image_name: str):
-    file_stream = open(os.path.join(DOWNLOAD_RES_PATH, folder, image_name), mode="rb")
-    return StreamingResponse(file_stream, media_type="image")
+async def image(
+        request: Request,
+        folder: str,
+        image_name: str,
+        width: int = Query(None, gt=0, title='缩放宽度'),
+        format: str = Query(None, title='输出格式 webp/jpeg')
+):
+    folder = await run_in_threadpool(beatmap_catalog.resolve, folder)
+    await ensure_local(folder)
+    image_path = os.path.join(DOWNLOAD_RES_PATH, folder, image_name)
+    source = await run_in_threadpool(locate_file, folder, image_name)
+    if width is None and format is None:
+        if isinstance(source, tuple):
+            return StreamingResponse(archive_store.iter_member(folder, image_name), media_type="image")
+        file_stream = open(image_path, mode="rb")
+        return StreamingResponse(file_stream, media_type="image")
+    fmt = (format or "webp").lower()
+    if not format_supported(fmt):
+        raise HTTPException(status_code=400, detail=f"unsupported format: {format}")
+    if source is None:
+        raise HTTPException(status_code=404, detail="image not found")
+    width = snap_width(width or sys.maxsize)
+    # 缓存键只需要 stat 源文件，客户端已有同一版本时不查缓存、不生成
+    key = await run_in_threadpool(rendition_service.cache_key, source, width, fmt)
+    headers = {
+        "Cache-Control": f"public, max-age={RENDITION_CACHE_MAX_AGE}, immutable",
+        "ETag": f'"{key}"',
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    rendition_path, key = await rendition_service.get(source, width, fmt, key)
+    return FileResponse(rendition_path, media_type=RENDITION_FORMATS[fmt][1], headers=headers)
 
 
 @app.get("/music/{folder}/{music_name}", deprecated=True)
 async def music(folder: str, music_name: str):
-    file_stream = open(os.path.join(DOWNLOAD_RES_PATH, folder, music_name), mode="rb")
+    folder = await run_in_threadpool(beatmap_catalog.resolve, folder)
+    await ensure_local(folder)
+    music_path = os.path.join(DOWNLOAD_RES_PATH, folder, music_name)
+    if isinstance(await run_in_threadpool(locate_file, folder, music_name), tuple):
+        return StreamingResponse(archive_store.iter_member(folder, music_name), media_type="music")
+    file_stream = open(music_path, mode="rb")
     return StreamingResponse(file_stream, media_type="music")
 
 
@@ -1,22 +1,13 @@
 import os
-from PIL import Image
 from const import IMAGE_TYPE
-from tc_config import COS_MAIN_WEBSITE_PIC_BED_PATH, COS_REGION, COS_SECRET_ID, COS_SECRET_KEY, COS_SCHEMA, COS_TOKEN, \
-    COS_OSU_BUCKET
-from qcloud_cos import CosConfig, CosServiceError
-from qcloud_cos import CosS3Client
-from qcloud_cos.cos_threadpool import SimpleThreadPool
+from tc_config import COS_MAIN_WEBSITE_PIC_BED_PATH, COS_OSU_BUCKET
+from tencent_cloud import get_client, cos_etag
+from upload_manifest import get_upload_manifest, md5_sources
+from upload_service import get_upload_service
 from datetime import datetime
-import pytz
 
 from loguru import logger
 
-config = CosConfig(
-    Region=COS_REGION, SecretId=COS_SECRET_ID, SecretKey=COS_SECRET_KEY,
-    Token=COS_TOKEN, Scheme=COS_SCHEMA
-)
-client = CosS3Client(config)
-
 
 def get_modification_time(filepath):
     return os.path.getctime(filepath)
@@ -54,24 +45,16 @@ def categorize_images(directory):
     return image_dict
 
 
-def push_obj(cos_object_key, local_file):
-    try:
-        _ = client.head_object(Bucket=COS_OSU_BUCKET, Key=cos_object_key)
-        # logger.info(f"File {cos_object_key} exists in cos.....")
-        return None
-    except CosServiceError as e:
-        if e.get_status_code() == 404:
-            exists = False
-            # logger.info(f"File {cos_object_key} not exists in cos, upload it")
-        else:
-            logger.error("Error happened, reupload it.")
+def push_obj(cos_object_key, local_file, md5=None):
     if local_file.lower().endswith(IMAGE_TYPE):
         # https://cloud.tencent.com/document/product/436/55344
         logger.info(f"Local: {local_file}")
-        ans = client.ci_put_object_from_local_file(
+        ans = get_client().ci_put_object_from_local_file(
             COS_OSU_BUCKET, local_file, cos_object_key,
             PicOperations=f'{{"is_pic_info":1,"rules":[{{"fileid":"{cos_object_key}","rule":"imageMogr2/format/webp"}}]}}'
         )  # 上传时转为webp
+        if md5 is not None:
+            get_upload_manifest().record(cos_object_key, md5)
         return ans
     else:
         # return client.upload_file(COS_OSU_BUCKET, cos_object_key, local_file)
@@ -95,32 +78,34 @@ def decimal_to_26_base(n):
 
 
 def upload_to_cos_bed(directory):
+    from PIL import Image
+
     image_dict = categorize_images(directory)
+    futures = dict()  # 分类 -> 上传的 Future
     # print(image_dict)
     # 遍历分类字典并打印元素
     for category, images in image_dict.items():
         output_directory = os.path.join(directory, category, "compressed")
-        # 创建上传的线程池
-        pool = SimpleThreadPool()
         total = len(images)
         index = 0
+        uploads = []  # (cos key, 本地文件)
         for image_path in images:
             image_name_with_format = os.path.basename(image_path)
             # image_name = os.path.splitext(image_name_with_format)[0]
-            # 加载图片
-            img_obj = Image.open(image_path)
             # 创建输出目录（如果不存在）
             os.makedirs(output_directory, exist_ok=True)
             compressed_path = os.path.join(output_directory, image_name_with_format)
             if not os.path.exists(compressed_path) and ".gif" not in image_path:  # 缩小并压缩图片并保存到输出目录
-                image_size = os.stat(image_path).st_size  # 获取图片大小
-                width, height = img_obj.size  # 调整图片尺寸
-                new_width = 512
-                new_height = int(height * new_width / width)
-                resized_img = img_obj.resize((new_width, new_height))
-                resized_img.save(compressed_path, optimize=True, quality=50)
+                # 只在需要压缩时才打开图片，Image.open 只读文件头，resize 时才解码
+                with Image.open(image_path) as img_obj:
+                    width, height = img_obj.size  # 调整图片尺寸
+                    new_width = 512
+                    new_height = int(height * new_width / width)
+                    resized_img = img_obj.resize((new_width, new_height))
+                    resized_img.save(compressed_path, optimize=True, quality=50)
             if not os.path.exists(compressed_path) and ".gif" in image_path:
-                img_obj.save(compressed_path, optimize=True, quality=50)
+                with Image.open(image_path) as img_obj:
+                    img_obj.save(compressed_path, optimize=True, quality=50)
 
             # cos_page_index = index // 4
             cos_page_index = decimal_to_26_base(int(1e9 - index))
@@ -130,20 +115,30 @@ def upload_to_cos_bed(directory):
             # 存储到cos
             cos_object_key_primitive = f"/{COS_MAIN_WEBSITE_PIC_BED_PATH}/{category}/primitive/{cos_page_index};{update_time};{image_name_with_format}"
             cos_object_key_compressed = f"/{COS_MAIN_WEBSITE_PIC_BED_PATH}/{category}/compressed/{cos_page_index};{update_time};{image_name_with_format}"
-            pool.add_task(push_obj, cos_object_key_primitive, image_path)
-            pool.add_task(push_obj, cos_object_key_compressed, compressed_path)
+            uploads.append((cos_object_key_primitive, image_path))
+            uploads.append((cos_object_key_compressed, compressed_path))
             index += 1
-        pool.wait_completion()
-        result = pool.get_result()
-        if not result['success_all']:
-            logger.error(f"Not all files upload sucessed. you should retry : {result}")
-        else:
+        # 上传清单里 md5 没变的文件不再请求COS
+        manifest = get_upload_manifest()
+        hashes = md5_sources(local_file for _, local_file in uploads)
+        tasks = []
+        for cos_object_key, local_file in uploads:
+            md5 = hashes.get(local_file)
+            if md5 is not None and manifest.needs_upload(cos_object_key, md5, cos_etag):
+                tasks.append((push_obj, (cos_object_key, local_file, md5)))
+        # 提交后直接处理下一个分类，压缩和上传重叠进行
+        futures[category] = get_upload_service().submit(tasks, name=category)
+    for category, future in futures.items():
+        if future.result():
             logger.success(f"{category} upload sucessed.")
+        else:
+            logger.error(f"{category}: not all files upload sucessed. you should retry")
+    get_upload_manifest().save()
 
 
 def tencent_cos_main_website_pic_bed_list(prefix, maker, max_keys=30) -> list:
     if maker is not None:
-        response = client.list_objects(
+        response = get_client().list_objects(
             Bucket=COS_OSU_BUCKET,
             Prefix=prefix,
             Delimiter='/',
@@ -151,7 +146,7 @@ def tencent_cos_main_website_pic_bed_list(prefix, maker, max_keys=30) -> list:
             Marker=maker
         )
     else:
-        response = client.list_objects(
+        response = get_client().list_objects(
             Bucket=COS_OSU_BUCKET,
             Prefix=prefix,
             Delimiter='/',
@@ -172,6 +167,8 @@ def get_main_website_pic_bed_categories(maker=None, max_keys=1000):
 
 
 def get_pic_bed_by_category(category, input_marker=None, max_keys=4):
+    import pytz
+
     prefix = f"{COS_MAIN_WEBSITE_PIC_BED_PATH}/{category}/compressed/"
     response = tencent_cos_main_website_pic_bed_list(prefix, input_marker, max_keys)
     pic_list = []
@@ -0,0 +1,143 @@
+import json
+import os
+import shutil
+import threading
+
+from loguru import logger
+
+from const import JOURNAL_SUFFIX
+
+# 阶段按顺序完成，每个阶段完成后才写入日志
+STAGE_STARTED = "started"  # 开始下载，压缩包还是 .part
+STAGE_DOWNLOADED = "downloaded"  # 压缩包完整落盘
+STAGE_SELECTED = "selected"  # 流式上传：选出了要上传的成员和重复图片
+STAGE_INDEXED = "indexed"  # 压缩包存储：成员偏移索引已保存
+STAGE_EXTRACTED = "extracted"  # 谱面文件夹已整体就位，imgs 已复制
+STAGE_UPLOADED = "uploaded"  # 上传成功并已记录到 storage_manager
+EXTRACTING_SUFFIX = ".extracting"  # 正在解压的谱面文件夹，完成后整体重命名
+
+
+def fsync_dir(dir_path):
+    # 重命名本身也要落盘，Windows 不支持打开目录
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(dir_path or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data):
+    """
+    先写临时文件并 fsync，再重命名覆盖，崩溃时 path 要么是旧内容要么是完整的新内容
+    :param path:
+    :param data: bytes 或 str
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    mode, encoding = ("wb", None) if isinstance(data, bytes) else ("w", "utf-8")
+    try:
+        with open(tmp_path, mode, encoding=encoding) as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(os.path.dirname(path))
+
+
+def atomic_copy(src_path, dst_path):
+    tmp_path = f"{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def replace_dir(tmp_dir, target_dir):
+    """
+    用完整写好的临时文件夹替换 target_dir。替换前删除的旧文件夹只可能是上次崩溃留下的半成品
+    """
+    if os.path.isdir(target_dir):
+        shutil.rmtree(target_dir)
+    os.replace(tmp_dir, target_dir)
+    fsync_dir(os.path.dirname(target_dir))
+
+
+def journal_path(zip_path):
+    return os.path.splitext(zip_path)[0] + JOURNAL_SUFFIX
+
+
+class PipelineJournal:
+    """
+    单个谱面 下载 -> 解压/索引 -> 上传 流程的预写日志，保存在压缩包旁边。
+    每个阶段完成后原子地追加记录，进程崩溃后重启时只重放没有完成的阶段；
+    所有阶段完成后删除日志，没有日志的谱面就是处理完成的谱面
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.path = journal_path(zip_path)
+        self.stages = dict()  # 阶段 -> 阶段数据
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as journal_file:
+                self.stages = json.load(journal_file)["stages"]
+        except FileNotFoundError:
+            self.stages = dict()
+        except (ValueError, KeyError) as e:
+            # 日志本身是原子写入的，读不出来说明被外部改坏了，从头处理
+            logger.error(f"[journal] unable to read {self.path}: {e}")
+            self.stages = dict()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def has(self, stage):
+        return stage in self.stages
+
+    def data(self, stage):
+        return self.stages.get(stage)
+
+    def mark(self, stage, **data):
+        """
+        记录阶段完成，写入磁盘后才返回
+        """
+        with self.lock:
+            self.stages[stage] = data
+            atomic_write(self.path, json.dumps({"zip": os.path.basename(self.zip_path), "stages": self.stages},
+                                               ensure_ascii=False))
+
+    def finish(self):
+        with self.lock:
+            self.stages = dict()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def find_journals(base_path):
+    """
+    :param base_path: 下载目录，下一级是各个分类
+    :return: [(分类, PipelineJournal)]，即所有没处理完的谱面
+    """
+    journals = []
+    if not os.path.isdir(base_path):
+        return journals
+    for category in sorted(os.listdir(base_path)):
+        category_path = os.path.join(base_path, category)
+        if not os.path.isdir(category_path):
+            continue
+        for file_name in sorted(os.listdir(category_path)):
+            if file_name.endswith(JOURNAL_SUFFIX):
+                zip_path = os.path.join(category_path, file_name[:-len(JOURNAL_SUFFIX)] + ".zip")
+                journals.append((category, PipelineJournal(zip_path)))
+    return journals
@@ -0,0 +1,139 @@
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from loguru import logger
+
+from const import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_SAMPLE_RATE, PROFILE_HEADER, PROFILE_TOKEN
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{module}:{name}".replace(";", ":")
+
+
+def fold(frame, root=None):
+    """
+    :return: 从根到叶子用分号连接的调用栈，即 flamegraph.pl / speedscope 使用的折叠格式
+    """
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    if root is not None:
+        names.append(root)
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    采样分析器：后台线程每隔 interval 秒读取一次目标线程的调用栈并计数，
+    不需要 setprofile 之类的钩子，被分析的代码几乎不受影响
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, thread_id=None, all_threads=False):
+        """
+        :param interval: 采样间隔，秒
+        :param thread_id: 只采样这个线程，默认为调用 start 的线程
+        :param all_threads: 采样所有线程，调用栈以线程名开头
+        """
+        self.interval = interval
+        self.thread_id = thread_id
+        self.all_threads = all_threads
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.duration = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self.started_at = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            if self.all_threads:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in frames.items():
+                    if thread_id != own_id:
+                        self.stacks[fold(frame, names.get(thread_id, str(thread_id)))] += 1
+            elif self.thread_id in frames:
+                self.stacks[fold(frames[self.thread_id])] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.duration = time.perf_counter() - self.started_at
+        return self.stacks
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def write(self, name, directory=PROFILE_DIR):
+        """
+        写出折叠格式的调用栈，可以直接交给 flamegraph.pl 或者导入 speedscope
+        :param name: 文件名前缀
+        :param directory:
+        :return: 文件路径
+        """
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r"[^\w.-]+", "_", name).strip("_") or "profile"
+        path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded")
+        with open(path, "w", encoding="utf-8") as folded_file:
+            folded_file.writelines(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        logger.info(f"[profile] {name}: {self.samples} samples in {self.duration:.3f}s -> {path}")
+        return path
+
+
+class ProfileMiddleware:
+    """
+    按比例或者按请求头对接口请求做采样分析。只在开启时才加到应用上，关闭时没有任何开销。
+    请求头的值必须等于 PROFILE_TOKEN，避免任何人都能触发
+    """
+
+    def __init__(self, app, sample_rate=PROFILE_SAMPLE_RATE, header=PROFILE_HEADER, token=PROFILE_TOKEN):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode("latin-1")
+        self.token = token.encode("latin-1") if token else None
+
+    def should_profile(self, scope):
+        if self.token is not None:
+            for key, value in scope["headers"]:
+                if key == self.header:
+                    return value == self.token
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        # 异步接口在事件循环线程上执行，采样这个线程；同一时间的其他请求也会被采到
+        profiler = SamplingProfiler().start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            threading.Thread(target=profiler.write, args=(f"api{scope['path']}",), daemon=True).start()
+
+
+def profiling_enabled():
+    return PROFILE_SAMPLE_RATE > 0 or bool(PROFILE_TOKEN)
@@ -0,0 +1,112 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from loguru import logger
+
+from const import DOWNLOAD_RES_PATH, LADDER_WIDTHS, LADDER_FORMATS, LADDER_WORKERS, LADDER_INDEX_SUFFIX
+from image_rendition import render_rendition, format_supported
+from pipeline_journal import atomic_write
+
+_executor = None
+_executor_lock = threading.Lock()
+_index_lock = threading.Lock()  # 多个谱面的上传回调在不同线程里合并索引
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=LADDER_WORKERS)
+    return _executor
+
+
+def ladder_formats():
+    return [fmt for fmt in LADDER_FORMATS if format_supported(fmt)]
+
+
+def rendition_name(file_name, rung, fmt):
+    return f"{os.path.splitext(os.path.basename(file_name))[0]}-{rung}.{fmt}"
+
+
+def encode_ladder(sources, out_dir):
+    """
+    在进程池里把每张图编码成 LADDER_WIDTHS x LADDER_FORMATS 的多个版本，各张图、各个尺寸并行。
+    提交后立即返回，不等待编码完成
+    :param sources: {文件名: 原图路径或者 (压缩包路径, 成员名)}
+    :param out_dir: 输出目录
+    :return: Future，结果为 {文件名: {(尺寸档, 格式): 本地路径}}，编码失败的图片不在结果里
+    """
+    formats = ladder_formats()
+    executor = get_executor()
+    jobs = []
+    for file_name, source in sources.items():
+        for rung, width in LADDER_WIDTHS.items():
+            for fmt in formats:
+                dst_path = os.path.join(out_dir, rendition_name(file_name, rung, fmt))
+                # render_rendition 不放大，原始尺寸档给一个足够大的宽度即可
+                future = executor.submit(render_rendition, source, dst_path, width or sys.maxsize, fmt)
+                jobs.append((file_name, rung, fmt, dst_path, future))
+    encoded = Future()
+    remaining = [len(jobs)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        encoded.set_result(_collect_ladder(jobs))
+
+    if not jobs:
+        encoded.set_result(dict())
+    for job in jobs:
+        job[-1].add_done_callback(done)
+    return encoded
+
+
+def _collect_ladder(jobs):
+    results, failed = dict(), set()
+    for file_name, rung, fmt, dst_path, future in jobs:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"[ladder] unable to encode {file_name} {rung} {fmt}: {e}")
+            failed.add(file_name)
+            continue
+        results.setdefault(file_name, dict())[(rung, fmt)] = dst_path
+    # 缺了某个版本的图片整张退回到原来的上传方式
+    return {file_name: renditions for file_name, renditions in results.items() if file_name not in failed}
+
+
+def ladder_index_path(name, base_path=DOWNLOAD_RES_PATH):
+    """
+    :param name: 相对下载目录的谱面路径 分类/谱面
+    """
+    return os.path.join(base_path, name + LADDER_INDEX_SUFFIX)
+
+
+def load_ladder_index(name):
+    """
+    :return: {文件名: {尺寸档: {格式: cos key}}}
+    """
+    try:
+        with open(ladder_index_path(name), "r", encoding="utf-8") as index_file:
+            return json.load(index_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def update_ladder_index(name, renditions):
+    """
+    合并本次上传的版本，没有变化而跳过上传的图片保留原来的记录
+    """
+    if not renditions:
+        return
+    path = ladder_index_path(name)
+    with _index_lock:
+        index = {**load_ladder_index(name), **renditions}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, json.dumps(index, ensure_ascii=False))
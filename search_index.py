@@ -0,0 +1,160 @@
+import heapq
+import re
+import threading
+import unicodedata
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def normalize(text):
+    """
+    全角转半角、统一大小写，下划线还原成空格（文件夹名里的空格被替换成了下划线）
+    """
+    text = unicodedata.normalize("NFKC", text).casefold().replace("_", " ")
+    return " ".join(text.split())
+
+
+def _is_ascii(char):
+    return ord(char) < 128
+
+
+def grams(text):
+    """
+    索引用的 n-gram：二元和三元组；非 ASCII 字符（中日文）额外加一元组，单字查询也能命中
+    """
+    result = set()
+    for n in (2, 3):
+        for i in range(len(text) - n + 1):
+            result.add(text[i:i + n])
+    result.update(char for char in text if not _is_ascii(char) and not char.isspace())
+    return result
+
+
+def query_grams(term):
+    # 只用最长的 n-gram 求交集，候选集最小
+    if len(term) >= 3:
+        return {term[i:i + 3] for i in range(len(term) - 2)}
+    if len(term) == 2:
+        return {term}
+    if not _is_ascii(term):
+        return {term}
+    return None  # 单个 ASCII 字符太宽泛，不走倒排
+
+
+class SearchIndex:
+    """
+    谱面名的内存倒排索引，按 set id、艺术家和标题、分类检索，支持增量增删
+    """
+
+    def __init__(self):
+        self.docs = dict()  # doc id -> (path, row, set_id, text, words, category)
+        self.doc_ids = dict()  # path -> doc id
+        self.postings = dict()  # gram -> {doc id}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, row):
+        """
+        :param row: catalog.BeatmapRow
+        :return:
+        """
+        with self.lock:
+            if row.path in self.doc_ids:
+                self._remove(row.path)
+            # 文件夹名是 {set_id}-{artist}-{title}，艺术家和标题都可能含 "-"，整体作为文本索引
+            text = normalize(row.name.partition("-")[2] if row.set_id >= 0 else row.name)
+            category = normalize(row.category)
+            set_id = str(row.set_id) if row.set_id >= 0 else ""
+            doc_id = self.next_id
+            self.next_id += 1
+            self.docs[doc_id] = (row.path, row, set_id, text, WORD_PATTERN.findall(text), category)
+            self.doc_ids[row.path] = doc_id
+            for gram in grams(text) | grams(category) | grams(set_id):
+                self.postings.setdefault(gram, set()).add(doc_id)
+
+    def remove(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def _remove(self, path):
+        doc_id = self.doc_ids.pop(path, None)
+        if doc_id is None:
+            return
+        _, _, set_id, text, _, category = self.docs.pop(doc_id)
+        for gram in grams(text) | grams(category) | grams(set_id):
+            posting = self.postings.get(gram)
+            if posting is not None:
+                posting.discard(doc_id)
+                if not posting:
+                    del self.postings[gram]
+
+    def sync(self, rows):
+        """
+        与最新的目录对齐，只处理新增、删除和变化的谱面
+        """
+        latest = {row.path: row for row in rows}
+        for path in [path for path in self.doc_ids if path not in latest]:
+            self.remove(path)
+        for path, row in latest.items():
+            doc_id = self.doc_ids.get(path)
+            if doc_id is None or self.docs[doc_id][1] != row:
+                self.add(row)
+
+    @staticmethod
+    def _score(term, set_id, text, words, category):
+        if term == set_id:
+            return 100
+        score = 0
+        if set_id.startswith(term):
+            score += 40
+        if text.startswith(term):
+            score += 30
+        if any(word.startswith(term) for word in words):
+            score += 20
+        if term in text:
+            score += 10
+        if term in category:
+            score += 5
+        return score
+
+    def search(self, query, limit=20, category=None):
+        """
+        :param query: 空格分隔的多个词需要同时命中
+        :param limit:
+        :param category: 只在该分类下检索
+        :return: [(row, score)]，按得分降序
+        """
+        terms = normalize(query).split()
+        if not terms:
+            return []
+        with self.lock:
+            candidates = None
+            for term in terms:
+                term_grams = query_grams(term)
+                if term_grams is None:
+                    continue
+                postings = sorted((self.postings.get(gram, set()) for gram in term_grams), key=len)
+                matched = set(postings[0]).intersection(*postings[1:])
+                candidates = matched if candidates is None else candidates & matched
+                if not candidates:
+                    return []
+            if candidates is None:
+                candidates = self.docs.keys()
+            results = []
+            for doc_id in candidates:
+                path, row, set_id, text, words, doc_category = self.docs[doc_id]
+                if category is not None and row.category != category:
+                    continue
+                total = 0
+                for term in terms:
+                    # n-gram 只能保证候选，最终要逐词确认
+                    score = self._score(term, set_id, text, words, doc_category)
+                    if score == 0:
+                        break
+                    total += score
+                else:
+                    results.append((row, total))
+        return heapq.nlargest(limit, results, key=lambda item: (item[1], item[0].set_id))
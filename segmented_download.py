@@ -0,0 +1,181 @@
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from loguru import logger
+
+from const import DOWNLOAD_SEGMENTS, DOWNLOAD_MIN_SEGMENT_SIZE, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_SEGMENT_RETRIES, \
+    DOWNLOAD_TIMEOUT
+
+CONTENT_RANGE_PATTERN = re.compile(r"bytes\s+0-0/(\d+)")
+STATE_FLUSH_BYTES = 4 * 1024 * 1024  # 每个分段每下载这么多字节记录一次进度
+
+
+class DownloadError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def split_segments(total, segments=DOWNLOAD_SEGMENTS, min_size=DOWNLOAD_MIN_SEGMENT_SIZE):
+    """
+    :return: [[起始字节, 结束字节(含), 已下载字节数]]
+    """
+    count = max(1, min(segments, total // min_size))
+    size = -(-total // count)
+    return [[start, min(start + size, total) - 1, 0] for start in range(0, total, size)]
+
+
+class SegmentedDownload:
+    """
+    分段并发下载一个文件：先用 Range: bytes=0-0 探测文件大小和是否支持断点续传，
+    支持时预分配文件、多个连接各自写自己的字节区间；进度记录在旁边的 .json 文件里，
+    失败后再次下载只补未完成的部分。服务器不支持 Range 时退化为单连接流式下载。
+    下载中的文件是 {dst_path}.part，完成后才重命名为 dst_path
+    """
+
+    def __init__(self, session, url, dst_path, headers=None, segments=DOWNLOAD_SEGMENTS):
+        self.session = session
+        self.url = url
+        self.dst_path = dst_path
+        self.part_path = dst_path + ".part"
+        self.state_path = dst_path + ".part.json"
+        self.headers = headers or {}
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 多个分段线程共用一个进度文件
+        self.state = None
+
+    def load_state(self, total, etag):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get("total") != total or state.get("etag") != etag or not os.path.exists(self.part_path):
+            return None  # 服务器上的文件变了，不能接着下载
+        return state
+
+    def save_state(self):
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps(self.state)
+            tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, self.state_path)
+
+    def finish(self):
+        os.replace(self.part_path, self.dst_path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def probe(self):
+        """
+        :return: (响应, 文件大小)，文件大小为 None 表示不支持 Range，响应可以直接用于单连接下载
+        """
+        resp = self.session.get(self.url, headers={**self.headers, "Range": "bytes=0-0"},
+                                stream=True, timeout=DOWNLOAD_TIMEOUT)
+        if resp.status_code == requests.codes.partial_content:
+            match = CONTENT_RANGE_PATTERN.match(resp.headers.get("Content-Range", ""))
+            if match:
+                resp.close()
+                return resp, int(match.group(1))
+        if resp.status_code == requests.codes.ok:
+            return resp, None
+        resp.close()
+        raise DownloadError(f"{resp.status_code} - probe failed", resp.status_code)
+
+    def download(self):
+        """
+        :return: 文件大小
+        """
+        resp, total = self.probe()
+        if total is None or total < DOWNLOAD_MIN_SEGMENT_SIZE:
+            return self.download_stream(resp if total is None else None)
+        # 跳转后的地址（镜像、CDN）直接用于分段请求，不再每段都走一次跳转
+        url = resp.url
+        etag = resp.headers.get("ETag")
+        self.state = self.load_state(total, etag)
+        if self.state is None:
+            self.state = {"total": total, "etag": etag, "segments": split_segments(total, self.segments)}
+            with open(self.part_path, "wb") as part_file:
+                part_file.truncate(total)
+            self.save_state()
+        else:
+            done = sum(segment[2] for segment in self.state["segments"])
+            logger.info(f"Resume {self.dst_path}: {done}/{total} bytes")
+        pending = [segment for segment in self.state["segments"] if segment[2] < segment[1] - segment[0] + 1]
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="segment") as executor:
+                # 任何一段最终失败都会在这里抛出，进度已经保存，下次接着下载
+                list(executor.map(lambda segment: self.download_segment(url, segment), pending))
+        self.finish()
+        return total
+
+    def download_segment(self, url, segment):
+        for attempt in range(DOWNLOAD_SEGMENT_RETRIES + 1):
+            try:
+                self.fetch_range(url, segment)
+                return
+            except (requests.RequestException, DownloadError) as e:
+                self.save_state()
+                if attempt == DOWNLOAD_SEGMENT_RETRIES:
+                    raise
+                logger.warning(f"Segment {segment[0]}-{segment[1]} of {self.dst_path} failed, retry: {e}")
+                time.sleep(2 ** attempt)
+
+    def fetch_range(self, url, segment):
+        start, end, done = segment
+        if done > end - start:
+            return
+        headers = {**self.headers, "Range": f"bytes={start + done}-{end}"}
+        with self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+            if resp.status_code != requests.codes.partial_content:
+                raise DownloadError(f"{resp.status_code} - range request failed", resp.status_code)
+            unsaved = 0
+            # 不带缓冲，记录进度时已计入的字节一定已经写进了文件
+            with open(self.part_path, "r+b", buffering=0) as part_file:
+                part_file.seek(start + done)
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    chunk = chunk[:end - start + 1 - segment[2]]  # 不写到下一段里
+                    part_file.write(chunk)
+                    with self.lock:
+                        segment[2] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= STATE_FLUSH_BYTES:
+                        self.save_state()
+                        unsaved = 0
+                    if segment[2] > end - start:
+                        break
+        if segment[2] <= end - start:
+            raise DownloadError(f"range {start}-{end} ended early at {start + segment[2]}")
+
+    def download_stream(self, resp=None):
+        if resp is None:
+            resp = self.session.get(self.url, headers=self.headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        with resp:
+            if resp.status_code != requests.codes.ok:
+                raise DownloadError(f"{resp.status_code} - download failed", resp.status_code)
+            size = 0
+            with open(self.part_path, "wb") as part_file:
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    part_file.write(chunk)
+                    size += len(chunk)
+        self.finish()
+        return size
+
+
+def download_file(session, url, dst_path, headers=None):
+    """
+    :param session: requests.Session，带登录态
+    :param url:
+    :param dst_path:
+    :param headers:
+    :return: 文件大小
+    """
+    return SegmentedDownload(session, url, dst_path, headers).download()
@@ -0,0 +1,292 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate
+
+from loguru import logger
+
+from const import SHARED_CATALOG_PATH, SHARED_CATALOG_CHECK_INTERVAL
+
+# 文件格式（小端）：
+#   文件头   magic | 格式版本 | 代数 | 发布时间 | 分区数
+#   分区目录 每个分区: 名称 | 保存时间 | 字符串个数 | 偏移表位置 | 数据位置 | 只追加起始代数
+#   每个分区的偏移表 (个数+1 个 uint64，相对数据位置) 和 UTF-8 数据
+# 只追加起始代数：从这一代开始该分区只在末尾追加过，持有这之后任意一代的进程只需处理新增的部分
+MAGIC = b"OSUCATLG"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sIQdI")
+SECTION = struct.Struct("<32sdQQQQ")
+OFFSET = struct.Struct("<Q")
+
+
+class StringSection(Sequence):
+    """
+    直接在 mmap 上按下标读取字符串，不把整个分区复制到进程内存
+    """
+
+    def __init__(self, mapping, count, offsets_pos, blob_pos, saved_at, generation=0, append_since=0):
+        self.mapping = mapping
+        self.count = count
+        self.offsets_pos = offsets_pos
+        self.blob_pos = blob_pos
+        self.saved_at = saved_at
+        self.generation = generation
+        self.append_since = append_since
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        start, end = struct.unpack_from("<QQ", self.mapping, self.offsets_pos + OFFSET.size * index)
+        return self.mapping[self.blob_pos + start:self.blob_pos + end].decode("utf-8")
+
+    def raw(self):
+        # 偏移表和数据的原始字节，重新发布时原样拷贝
+        blob_size = OFFSET.unpack_from(self.mapping, self.offsets_pos + OFFSET.size * self.count)[0]
+        return (self.mapping[self.offsets_pos:self.offsets_pos + OFFSET.size * (self.count + 1)],
+                self.mapping[self.blob_pos:self.blob_pos + blob_size])
+
+    def extends(self, other):
+        """
+        :return: other（同一分区更早的一代）是否是本分区的前缀，是的话只需处理 self[len(other):]
+        """
+        return other is not None and self.append_since <= other.generation and len(other) <= len(self)
+
+
+def _encode_section(strings, base=0):
+    """
+    :param base: 偏移量的起点，追加时为原有数据的长度
+    """
+    encoded = [item.encode("utf-8") for item in strings]
+    offsets = array("Q", accumulate((len(item) for item in encoded), initial=base))
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    return offsets.tobytes(), b"".join(encoded)
+
+
+class InterProcessLock:
+    """
+    基于文件的进程间锁，用来保证多个 worker 中只有一个去刷新
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        try:
+            if sys.platform.startswith("win32"):
+                import msvcrt
+
+                msvcrt.locking(self.fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(self.fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            return False
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        if sys.platform.startswith("win32"):
+            import msvcrt
+
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)  # 关闭文件描述符时 flock 自动释放
+        self.fd = None
+
+
+class SharedCatalog:
+    """
+    多个 uvicorn worker 共享的目录文件：一个 worker 刷新并原子替换文件，其他 worker 通过 mmap 只读共享，
+    内存占用不随 worker 数增长；同时也是重启后的启动快照
+    """
+
+    def __init__(self, path=SHARED_CATALOG_PATH, check_interval=SHARED_CATALOG_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.sections = dict()
+        self.generation = 0
+        self.file_key = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.file_lock = InterProcessLock(path + ".lock")
+        self.check(force=True)
+
+    def check(self, force=False):
+        """
+        文件被替换后重新映射，最多每 check_interval 秒 stat 一次
+        """
+        now = time.time()
+        if not force and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_key == self.file_key:
+            return
+        with self.lock:
+            try:
+                self.open()
+                self.file_key = file_key
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"[catalog] unable to map {self.path}: {e}")
+
+    def open(self):
+        with open(self.path, "rb") as catalog_file:
+            if sys.platform.startswith("win32"):
+                # Windows 上还被映射着的文件不能被 os.replace 覆盖，只能读进内存，不持有文件句柄和映射
+                mapping = catalog_file.read()
+            else:
+                mapping = mmap.mmap(catalog_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, generation, _, section_count = HEADER.unpack_from(mapping, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"unsupported catalog format {magic} {format_version}")
+        sections = dict()
+        for i in range(section_count):
+            name, saved_at, count, offsets_pos, blob_pos, append_since = SECTION.unpack_from(
+                mapping, HEADER.size + SECTION.size * i
+            )
+            sections[name.rstrip(b"\0").decode("utf-8")] = StringSection(
+                mapping, count, offsets_pos, blob_pos, saved_at, generation, append_since
+            )
+        # 旧的 mmap 由还在使用它的分区对象持有，不再引用后自动释放
+        self.sections = sections
+        self.generation = generation
+
+    def section(self, name):
+        self.check()
+        return self.sections.get(name)
+
+    def is_stale(self, name, ttl):
+        section = self.section(name)
+        return section is None or time.time() - section.saved_at > ttl
+
+    def publish(self, updates, appends=None):
+        """
+        写出新版本文件并原子替换，未更新的分区从当前版本原样拷贝
+        :param updates: {分区名: 字符串列表}，整体替换；新数据只是在原有数据末尾多了几项（或者没变）时仍算作追加，
+            其他 worker 不用重建
+        :param appends: {分区名: 字符串列表}，追加到分区末尾，原有数据按字节拷贝、不重新编码，保存时间不变
+        :return:
+        """
+        now = time.time()
+        appends = appends or {}
+        generation = self.generation + 1
+        parts = []  # (name, saved_at, count, offsets, blob, append_since)
+        for name, section in self.sections.items():
+            if name in updates:
+                continue
+            offsets, blob = section.raw()
+            append_since = section.append_since
+            if name in appends:
+                # 旧偏移表的最后一项就是新数据的起点，新偏移表去掉重复的这一项
+                new_offsets, new_blob = _encode_section(appends[name], len(blob))
+                count = len(section) + len(appends[name])
+                parts.append((name, section.saved_at, count, offsets + new_offsets[OFFSET.size:], blob + new_blob,
+                              append_since))
+                continue
+            parts.append((name, section.saved_at, len(section), offsets, blob, append_since))
+        for name, strings in updates.items():
+            offsets, blob = _encode_section(strings)
+            append_since = generation
+            if name in self.sections:
+                old_offsets, old_blob = self.sections[name].raw()
+                if offsets.startswith(old_offsets) and blob.startswith(old_blob):
+                    append_since = self.sections[name].append_since
+            parts.append((name, now, len(strings), offsets, blob, append_since))
+        for name, strings in appends.items():
+            if name not in self.sections and name not in updates:
+                parts.append((name, now, len(strings)) + _encode_section(strings) + (generation,))
+        position = HEADER.size + SECTION.size * len(parts)
+        directory, body = [], []
+        for name, saved_at, count, offsets, blob, append_since in parts:
+            directory.append(SECTION.pack(name.encode("utf-8"), saved_at, count, position, position + len(offsets),
+                                          append_since))
+            body.extend((offsets, blob))
+            position += len(offsets) + len(blob)
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, generation, now, len(parts))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(header)
+            tmp_file.writelines(directory)
+            tmp_file.writelines(body)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.path)
+        self.check(force=True)
+        logger.info(f"[catalog] published generation {self.generation}: {list(updates)} {list(appends)}")
+
+    def refresh(self, name, ttl, loader, blocking=False, stale=None):
+        """
+        分区过期时由一个 worker 刷新，其他 worker 拿不到锁直接返回，等下次 check 读到新版本
+        :param name: 判断是否过期的分区
+        :param ttl: 秒
+        :param loader: loader() -> {分区名: 字符串列表}
+        :param blocking: 没有任何数据时需要同步等待
+        :param stale: stale() -> 是否需要刷新，给出时代替按 ttl 判断
+        :return: 本次是否刷新了
+        """
+        if not self.refresh_lock.acquire(blocking):
+            return False
+        try:
+            if not self.file_lock.acquire(blocking):
+                return False
+            try:
+                self.check(force=True)
+                if not (stale() if stale is not None else self.is_stale(name, ttl)):
+                    return False  # 其他 worker 刚刚刷新过
+                self.publish(loader())
+                return True
+            finally:
+                self.file_lock.release()
+        finally:
+            self.refresh_lock.release()
+
+    def append(self, name, strings):
+        """
+        在分区末尾追加，不读取、不重新编码已有数据
+        """
+        with self.refresh_lock:
+            self.file_lock.acquire()
+            try:
+                self.check(force=True)
+                self.publish({}, {name: strings})
+            finally:
+                self.file_lock.release()
+
+    def refresh_in_background(self, name, ttl, loader, stale=None):
+        def run():
+            try:
+                self.refresh(name, ttl, loader, stale=stale)
+            except Exception as e:
+                logger.error(f"[catalog] refresh {name} failed: {e}")
+
+        if not self.refresh_lock.locked():
+            threading.Thread(target=run, name=f"catalog-refresh-{name}", daemon=True).start()
+
+
+shared_catalog = SharedCatalog()
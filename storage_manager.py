@@ -0,0 +1,296 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from loguru import logger
+
+from beatmap_meta import refresh_meta
+from const import IMAGE_TYPE, DOWNLOAD_RES_PATH, DISK_BUDGET_BYTES, STORAGE_STATE_PATH, STORAGE_ACCESS_PATH, \
+    STORAGE_ACCESS_FLUSH_INTERVAL, STORAGE_USAGE_RESYNC_INTERVAL
+
+
+def _atomic_write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+        json.dump(data, tmp_file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+class StorageManager:
+    """
+    本地磁盘预算管理：已确认上传到COS的谱面，按接口访问时间做LRU淘汰，需要时再从COS拉回来。
+
+    两个文件分开写，避免下载进程和接口进程互相覆盖：
+    - STORAGE_STATE_PATH 只由下载进程追加，每行记录一个谱面已镜像到COS的文件，同一谱面以最后一行为准
+    - STORAGE_ACCESS_PATH 只由接口进程写，记录每个谱面最近一次访问时间
+    文件是否被淘汰直接看本地是否存在，不单独记录
+    """
+
+    def __init__(self, base_path=DOWNLOAD_RES_PATH, budget=DISK_BUDGET_BYTES, state_path=STORAGE_STATE_PATH):
+        self.base_path = base_path
+        self.budget = budget
+        self.state_path = state_path
+        self.mirrored = dict()  # 谱面 -> {文件名: cos key}
+        self.mirrored_file = None  # (inode, 已读到的位置)，文件只追加，每次只解析新增的行
+        self.usage = None  # 下载目录的占用，第一次需要时统计一次，之后增量维护
+        self.usage_synced = 0
+        self.access = _read_json(STORAGE_ACCESS_PATH)
+        self.access_flushed = time.time()
+        self.lock = threading.RLock()
+        self.rehydrating = dict()  # 谱面 -> 正在进行的拉回的 Future
+
+    def key(self, set_dir):
+        return os.path.relpath(set_dir, self.base_path).replace(os.sep, "/")
+
+    def load_mirrored(self):
+        try:
+            stat = os.stat(self.state_path)
+        except FileNotFoundError:
+            return self.mirrored
+        with self.lock:
+            inode, position = self.mirrored_file or (None, 0)
+            if inode != stat.st_ino or stat.st_size < position:
+                # 文件被替换过，从头读
+                self.mirrored, position = dict(), 0
+            if stat.st_size > position:
+                with open(self.state_path, "rb") as state_file:
+                    state_file.seek(position)
+                    data = state_file.read()
+                # 最后一行可能还没写完，留到下次
+                data = data[:data.rfind(b"\n") + 1]
+                for line in data.splitlines():
+                    try:
+                        record = json.loads(line)
+                        self.mirrored[record["name"]] = record["files"]
+                    except (ValueError, KeyError) as e:
+                        logger.error(f"[storage] bad state line in {self.state_path}: {e}")
+                position += len(data)
+            self.mirrored_file = (stat.st_ino, position)
+        return self.mirrored
+
+    def confirm_upload(self, set_dir, files):
+        """
+        上传全部成功后调用
+        :param set_dir: 谱面文件夹
+        :param files: {文件名: cos key}
+        :return:
+        """
+        if self.key(set_dir).startswith(".."):
+            # 压缩包存储模式从临时目录上传，本地没有可淘汰的文件
+            return
+        line = json.dumps({"name": self.key(set_dir), "files": files}, ensure_ascii=False) + "\n"
+        with self.lock:
+            # 只追加一行，不重写整个文件
+            with open(self.state_path, "ab") as state_file:
+                state_file.write(line.encode("utf-8"))
+            self.load_mirrored()
+
+    def touch(self, name):
+        """
+        接口访问谱面时调用，访问时间按间隔批量落盘
+        :param name: 相对 base_path 的谱面路径
+        :return:
+        """
+        now = time.time()
+        self.access[name] = now
+        if now - self.access_flushed >= STORAGE_ACCESS_FLUSH_INTERVAL:
+            self.flush_access()
+
+    def flush_access(self):
+        with self.lock:
+            merged = _read_json(STORAGE_ACCESS_PATH)
+            for name, accessed in self.access.items():
+                merged[name] = max(accessed, merged.get(name, 0))
+            self.access = merged
+            _atomic_write_json(STORAGE_ACCESS_PATH, merged)
+            self.access_flushed = time.time()
+
+    def missing_files(self, name):
+        files = self.load_mirrored().get(name, {})
+        set_dir = os.path.join(self.base_path, name)
+        return {file: key for file, key in files.items() if not os.path.exists(os.path.join(set_dir, file))}
+
+    def is_evicted(self, name):
+        return bool(self.missing_files(name))
+
+    def disk_usage(self):
+        """
+        完整统计一次下载目录的占用，比较慢，平时用 current_usage
+        """
+        total = 0
+        for path, dir_list, file_list in os.walk(self.base_path):
+            for file_name in file_list:
+                try:
+                    total += os.path.getsize(os.path.join(path, file_name))
+                except OSError:
+                    pass
+        return total
+
+    def current_usage(self, added=None):
+        """
+        :param added: 刚入库的谱面文件夹，增量计入占用
+        :return: 下载目录的占用。每隔 STORAGE_USAGE_RESYNC_INTERVAL 完整统计一次，
+            以计入其他进程（接口拉回的文件）和手动的改动
+        """
+        if self.usage is None or time.time() - self.usage_synced > STORAGE_USAGE_RESYNC_INTERVAL:
+            usage = self.disk_usage()  # 已经包含 added
+            with self.lock:
+                self.usage, self.usage_synced = usage, time.time()
+        elif added is not None:
+            self.add_usage(self.footprint(added))
+        return self.usage
+
+    def add_usage(self, delta):
+        with self.lock:
+            if self.usage is not None:
+                self.usage += delta
+
+    def local_copies(self, set_dir, file):
+        """
+        :return: 一个已镜像文件在本地的所有副本：谱面文件夹里的文件，图片还有分类 imgs 目录下的一份
+        """
+        paths = [os.path.join(set_dir, file)]
+        if file.lower().endswith(IMAGE_TYPE):
+            # 与下载器复制到 imgs 时的命名一致，COS上分类 imgs 目录下也有一份
+            imgs_dir = os.path.join(os.path.dirname(set_dir), "imgs")
+            paths.append(os.path.join(imgs_dir, os.path.basename(set_dir) + "-" + os.path.basename(file)))
+        return paths
+
+    def footprint(self, set_dir):
+        """
+        :return: 一个谱面在本地占用的字节数，包括分类 imgs 目录下的图片副本
+        """
+        total = 0
+        for path, dir_list, file_list in os.walk(set_dir):
+            for file_name in file_list:
+                local_paths = [os.path.join(path, file_name)]
+                if file_name.lower().endswith(IMAGE_TYPE):
+                    local_paths = self.local_copies(set_dir, os.path.relpath(local_paths[0], set_dir))
+                for local_path in local_paths:
+                    try:
+                        total += os.path.getsize(local_path)
+                    except OSError:
+                        pass
+        return total
+
+    def evict(self, name):
+        """
+        删除已镜像到COS的文件（图片、音频）以及图片在分类 imgs 目录下的副本，未上传的文件保留。
+        谱面文件夹即使删空了也保留，目录据此知道谱面还在，访问时再拉回
+        :param name:
+        :return: 释放的字节数
+        """
+        freed = 0
+        set_dir = os.path.join(self.base_path, name)
+        with self.lock:
+            # 上传线程会同时 confirm_upload，在锁内取快照
+            files = list(self.load_mirrored().get(name, {}))
+        for file in files:
+            for local_path in self.local_copies(set_dir, file):
+                try:
+                    freed += os.path.getsize(local_path)
+                    os.remove(local_path)
+                except FileNotFoundError:
+                    continue
+        self.add_usage(-freed)
+        if freed:
+            logger.info(f"[storage] evict {name}, {freed} bytes freed")
+        return freed
+
+    def enforce(self, added=None):
+        """
+        超出磁盘预算时按最近访问时间从旧到新淘汰
+        :param added: 刚入库的谱面文件夹
+        :return: 释放的字节数
+        """
+        if self.budget is None:
+            return 0  # 没有设置预算，不淘汰
+        usage = self.current_usage(added)
+        if usage <= self.budget:
+            return 0
+        self.access = {**_read_json(STORAGE_ACCESS_PATH), **self.access}
+        with self.lock:
+            names = list(self.load_mirrored())
+        candidates = sorted(names, key=lambda name: self.access.get(name, 0))
+        freed = 0
+        for name in candidates:
+            if usage - freed <= self.budget:
+                break
+            freed += self.evict(name)
+        logger.info(f"[storage] usage {usage} budget {self.budget} freed {freed}")
+        if usage - freed > self.budget:
+            # 剩下的都是没有镜像到COS的文件，不能淘汰
+            logger.warning(f"[storage] still over budget after evicting every mirrored set: {usage - freed}")
+        return freed
+
+    def rehydrate(self, name):
+        """
+        从COS拉回被淘汰的文件。COS上的图片是上传时转成 webp 的版本，文件名不变，
+        元数据 sidecar 里这些文件的格式和大小按拉回的实际内容更新。
+        同一个谱面的并发请求只拉回一次，后来的请求等待同一个结果
+        :param name:
+        :return: 拉回的文件数
+        """
+        with self.lock:
+            pending = self.rehydrating.get(name)
+            owner = pending is None
+            if owner:
+                pending = self.rehydrating[name] = Future()
+        if not owner:
+            return pending.result()
+        try:
+            pending.set_result(self._rehydrate(name))
+        except BaseException as e:
+            pending.set_exception(e)
+        finally:
+            with self.lock:
+                self.rehydrating.pop(name, None)
+        return pending.result()
+
+    def _rehydrate(self, name):
+        from tencent_cloud import get_client
+        from tc_config import COS_OSU_BUCKET
+
+        missing = self.missing_files(name)
+        set_dir = os.path.join(self.base_path, name)
+        for file, cos_key in missing.items():
+            local_path = os.path.join(set_dir, file)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # 先下载到临时文件再重命名，中途失败不会留下被当作已存在的半个文件
+            tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                get_client().download_file(Bucket=COS_OSU_BUCKET, Key=cos_key, DestFilePath=tmp_path)
+                os.replace(tmp_path, local_path)
+                self.add_usage(os.path.getsize(local_path))
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        if missing:
+            refresh_meta(set_dir, missing)
+            logger.info(f"[storage] rehydrate {name}, {len(missing)} files")
+        return len(missing)
+
+
+_storage_manager = None
+
+
+def get_storage_manager():
+    global _storage_manager
+    if _storage_manager is None:
+        _storage_manager = StorageManager()
+    return _storage_manager
+
+
+if __name__ == '__main__':
+    get_storage_manager().enforce()
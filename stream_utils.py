@@ -0,0 +1,24 @@
+def read_exact(stream, size):
+    """
+    :raise ValueError: 数据不够，文件头被截断
+    """
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("unexpected end of header")
+    return data
+
+
+class PrefixedStream:
+    """
+    把已经读出来的头部和剩余数据拼成一个流，解析文件头时不需要 seek，zip 成员也能用
+    """
+
+    def __init__(self, prefix, rest):
+        self.prefix = prefix
+        self.rest = rest
+
+    def read(self, size):
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.rest.read(size - len(data))
+        return data
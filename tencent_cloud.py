@@ -1,73 +1,255 @@
 import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import Future
 
 from loguru import logger
-from qcloud_cos import CosConfig, CosServiceError
-from qcloud_cos import CosS3Client
-from qcloud_cos.cos_threadpool import SimpleThreadPool
 
 from tc_config import COS_REGION, COS_SECRET_ID, COS_SECRET_KEY, COS_TOKEN, COS_SCHEMA, COS_OSU_BUCKET, COS_OSU_PATH
-from const import IMAGE_TYPE, OSU_DIR, OSU_IMG_DIR
+from const import IMAGE_TYPE, MUSIC_TYPE, MIRROR_AUDIO, OSU_DIR, OSU_IMG_DIR, COS_MULTIPART_THRESHOLD, UPLOAD_WORKERS, LADDER_ENCODE, \
+    RENDITION_FORMATS
+from rendition_ladder import encode_ladder, rendition_name, update_ladder_index
+from storage_manager import get_storage_manager
+from upload_manifest import get_upload_manifest, md5_sources, response_etag
+from upload_service import get_upload_service, then, then_future
 
 # pip install -U cos-python-sdk-v5
 
-config = CosConfig(
-    Region=COS_REGION, SecretId=COS_SECRET_ID, SecretKey=COS_SECRET_KEY,
-    Token=COS_TOKEN, Scheme=COS_SCHEMA
-)
-client = CosS3Client(config)
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    第一次使用时才导入SDK并创建客户端，接口进程启动时不需要它
+    :return: CosS3Client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            from qcloud_cos import CosConfig, CosS3Client
+
+            # 所有上传线程共用一个客户端，连接池与上传线程数一致，保持长连接
+            config = CosConfig(
+                Region=COS_REGION, SecretId=COS_SECRET_ID, SecretKey=COS_SECRET_KEY,
+                Token=COS_TOKEN, Scheme=COS_SCHEMA, PoolConnections=UPLOAD_WORKERS, PoolMaxSize=UPLOAD_WORKERS
+            )
+            _client = CosS3Client(config)
+    return _client
+
+
+def cos_etag(key):
+    """
+    :return: COS 上对象的 ETag，不存在时为 None
+    """
+    from qcloud_cos import CosServiceError
+
+    try:
+        return response_etag(get_client().head_object(Bucket=COS_OSU_BUCKET, Key=key)) or ""
+    except CosServiceError as e:
+        if e.get_status_code() != 404:
+            logger.error("Error happened, reupload it.")
+        return None
 
 
 def push_obj(category_key, cos_object_key, local_file, single_save=False):
     if local_file.lower().endswith(IMAGE_TYPE):
         # https://cloud.tencent.com/document/product/436/55344
         if not single_save:
-            ans = client.ci_put_object_from_local_file(
+            ans = get_client().ci_put_object_from_local_file(
                 COS_OSU_BUCKET, local_file, cos_object_key,
                 PicOperations=f'{{"is_pic_info":1,"rules":[{{"fileid":"{cos_object_key}","rule":"imageMogr2/format/webp"}}]}}'
             )  # 上传时转为webp
         # 图片存两份，在主目录也需要一份
-        ans = client.ci_put_object_from_local_file(
+        ans = get_client().ci_put_object_from_local_file(
             COS_OSU_BUCKET, local_file, category_key,
             PicOperations=f'{{"is_pic_info":1,"rules":[{{"fileid":"{category_key}","rule":"imageMogr2/format/webp"}}]}}'
         )  # 上传时转为webp
         return ans
     else:
-        # return client.upload_file(COS_OSU_BUCKET, cos_object_key, local_file)
-        # 只上传图片
-        pass
+        # 音频只存谱面目录一份，不做处理，本地淘汰后原样拉回
+        return get_client().upload_file(Bucket=COS_OSU_BUCKET, Key=cos_object_key, LocalFilePath=local_file)
 
 
-def tencent_cos_upload(root, category, upload_dir, beatMap_name, single_save=False):
-    g = os.walk(upload_dir)
-    # 创建上传的线程池
-    pool = SimpleThreadPool()
-    for path, dir_list, file_list in g:
-        for file_name in file_list:
-            local_src_path = os.path.join(path, file_name)
-            cos_object_key = f"/{root}/{category}/{beatMap_name}/{file_name.strip('/')}"
-            category_key = f"/{root}/{category}/imgs/{beatMap_name}{file_name.strip('/')}"  # 存放到某个分类下
-            # 判断 COS 上文件是否存在
-            exists = False
-            try:
-                _ = client.head_object(Bucket=COS_OSU_BUCKET, Key=cos_object_key)
-                exists = True
-            except CosServiceError as e:
-                if e.get_status_code() == 404:
-                    exists = False
+def push_member(category_key, cos_object_key, source, single_save=False):
+    """
+    从压缩包读取成员直接上传，不落盘
+    :param category_key:
+    :param cos_object_key:
+    :param source: (压缩包路径, 成员名)
+    :param single_save:
+    :return:
+    """
+    zip_path, member_name = source
+    is_image = member_name.lower().endswith(IMAGE_TYPE)
+    if is_image:
+        keys = [category_key] if single_save else [cos_object_key, category_key]
+    else:
+        # 音频只存谱面目录一份，不做处理
+        keys = [cos_object_key]
+    ans = None
+    with zipfile.ZipFile(zip_path) as zip_file:
+        info = zip_file.getinfo(member_name)
+        for key in keys:
+            with zip_file.open(info) as body:
+                if not is_image and info.file_size <= COS_MULTIPART_THRESHOLD:
+                    ans = get_client().put_object(
+                        Bucket=COS_OSU_BUCKET, Body=body, Key=key, ContentLength=str(info.file_size)
+                    )
+                elif info.file_size > COS_MULTIPART_THRESHOLD:
+                    # 分块上传边读边传，但不支持上传时的图片处理，保存原图
+                    ans = get_client().upload_file_from_buffer(COS_OSU_BUCKET, key, body)
                 else:
-                    logger.error("Error happened, reupload it.")
-            if not exists:
-                logger.info(f"File {local_src_path} not exists in cos, upload it")
-                # push_obj(cos_object_key, local_src_path)
-                pool.add_task(push_obj, category_key, cos_object_key, local_src_path, single_save)
-
-    pool.wait_completion()
-    result = pool.get_result()
-    if not result['success_all']:
-        logger.error("Not all files upload sucessed. you should retry")
+                    ans = get_client().ci_put_object(
+                        COS_OSU_BUCKET, body, key, ContentLength=str(info.file_size),
+                        PicOperations=f'{{"is_pic_info":1,"rules":[{{"fileid":"{key}","rule":"imageMogr2/format/webp"}}]}}'
+                    )  # 上传时转为webp
+    return ans
+
+
+def push_ladder(category_key, cos_object_key, renditions, single_save=False):
+    """
+    上传本地编码好的多尺寸版本，都是普通对象，不经过COS上传时的图片处理
+    :param category_key:
+    :param cos_object_key:
+    :param renditions: {(尺寸档, 格式): (本地路径, cos key)}
+    :param single_save:
+    :return: 原图位置的上传结果
+    """
+    ans = None
+    for (rung, fmt), (local_file, key) in renditions.items():
+        keys = [key]
+        if (rung, fmt) == ("full", "webp"):
+            # 原图的两份（谱面目录和分类 imgs 目录）直接用本地转好的 webp，代替原来的 imageMogr2/format/webp
+            keys = [category_key] if single_save else [cos_object_key, category_key]
+        for target in keys:
+            with open(local_file, "rb") as body:
+                result = get_client().put_object(
+                    Bucket=COS_OSU_BUCKET, Body=body, Key=target, ContentType=RENDITION_FORMATS[fmt][1]
+                )
+            if target == keys[0] and (rung, fmt) == ("full", "webp"):
+                ans = result
+    return ans
+
+
+def _push_and_record(push, category_key, cos_object_key, source, single_save, md5):
+    ans = push(category_key, cos_object_key, source, single_save)
+    get_upload_manifest().record(cos_object_key, md5)
+    return ans
+
+
+def _upload_files(root, category, beatMap_name, files, push, single_save=False, skip_files=None):
+    """
+    是否上传由本地的上传清单决定：源文件 md5 没变的不发请求，变了的提交给上传服务
+    :param files: [(相对谱面目录的文件名, 上传源)]
+    :param push: push(category_key, cos_object_key, 上传源, single_save)
+    :return: Future，全部成功时结果为 {文件名: cos key}，否则为 None
+    """
+    # 上传图片；音频只在 MIRROR_AUDIO 时上传，本地副本被淘汰后才能从COS拉回
+    upload_types = IMAGE_TYPE + MUSIC_TYPE if MIRROR_AUDIO else IMAGE_TYPE
+    files = [(relative_name, source) for relative_name, source in files
+             if relative_name.lower().endswith(upload_types)
+             and not (skip_files and os.path.basename(relative_name) in skip_files)]  # 感知哈希判定为已上传过的背景图
+    hashes = md5_sources(source for _, source in files)
+    manifest = get_upload_manifest()
+    changed = []
+    mirrored = dict()
+    for relative_name, source in files:
+        file_name = os.path.basename(relative_name)
+        cos_object_key = f"/{root}/{category}/{beatMap_name}/{file_name.strip('/')}"
+        category_key = f"/{root}/{category}/imgs/{beatMap_name}{file_name.strip('/')}"  # 存放到某个分类下
+        md5 = hashes.get(source)
+        if md5 is None:
+            continue
+        mirrored[relative_name] = cos_object_key
+        if manifest.needs_upload(cos_object_key, md5, cos_etag,
+                                 comparable=not relative_name.lower().endswith(IMAGE_TYPE)):
+            logger.info(f"File {source} changed or not exists in cos, upload it")
+            changed.append((relative_name, source, category_key, cos_object_key, md5))
+    ladder_dir, ladder_index = None, dict()
+    if LADDER_ENCODE and changed:
+        ladder_dir = tempfile.mkdtemp(prefix="osu-ladder-")
+        # 编码在进程池里进行，编码完成后再提交上传，下载线程不等待
+        encoding = encode_ladder({item[0]: item[1] for item in changed if item[0].lower().endswith(IMAGE_TYPE)},
+                                 ladder_dir)
     else:
-        logger.success(f"{upload_dir} upload sucessed.")
-        # shutil.rmtree(upload_dir)
+        encoding = Future()
+        encoding.set_result(dict())
+
+    def submit(encoded):
+        tasks = []
+        for relative_name, source, category_key, cos_object_key, md5 in changed:
+            renditions = encoded.get(relative_name)
+            if renditions is None or ("full", "webp") not in renditions:
+                # 没开启或者本地编码失败，仍由COS在上传时转换
+                tasks.append((_push_and_record, (push, category_key, cos_object_key, source, single_save, md5)))
+                continue
+            keys = dict()
+            for (rung, fmt), local_file in renditions.items():
+                key = f"/{root}/{category}/{beatMap_name}/renditions/{rendition_name(relative_name, rung, fmt)}"
+                if (rung, fmt) == ("full", "webp"):
+                    key = category_key if single_save else cos_object_key
+                keys[(rung, fmt)] = (local_file, key)
+                ladder_index.setdefault(relative_name, dict()).setdefault(rung, dict())[fmt] = key
+            tasks.append((_push_and_record, (push_ladder, category_key, cos_object_key, keys, single_save, md5)))
+        return get_upload_service().submit(tasks, name=f"{category}/{beatMap_name}")
+
+    def finish(success):
+        manifest.save()
+        if ladder_dir is not None:
+            shutil.rmtree(ladder_dir, ignore_errors=True)
+        if not success:
+            return None
+        update_ladder_index(f"{category}/{beatMap_name}", ladder_index)
+        return mirrored
+
+    return then(then_future(encoding, submit), finish)
+
+
+def tencent_cos_upload(root, category, upload_dir, beatMap_name, single_save=False, skip_files=None):
+    """
+    提交到上传服务后立即返回，全部成功后把本地文件交给 storage_manager
+    :return: Future，全部成功时结果为 {文件名: cos key}，否则为 None
+    """
+    files = []
+    for path, dir_list, file_list in os.walk(upload_dir):
+        for file_name in file_list:
+            local_src_path = os.path.join(path, file_name)
+            files.append((os.path.relpath(local_src_path, upload_dir).replace(os.sep, "/"), local_src_path))
+
+    def finish(mirrored):
+        if mirrored is not None:
+            logger.success(f"{upload_dir} upload sucessed.")
+            # shutil.rmtree(upload_dir)
+            # 本地文件由 storage_manager 按磁盘预算淘汰
+            get_storage_manager().confirm_upload(upload_dir, mirrored)
+        return mirrored
+
+    return then(_upload_files(root, category, beatMap_name, files, push_obj, single_save, skip_files), finish)
+
+
+def tencent_cos_upload_archive(root, category, zip_path, members, beatMap_name, single_save=False, skip_files=None):
+    """
+    直接从压缩包流式上传选中的成员，不解压到磁盘。上传完成前不能删除压缩包
+    :param root:
+    :param category:
+    :param zip_path:
+    :param members: {文件名: 压缩包内成员名}
+    :param beatMap_name:
+    :param single_save:
+    :param skip_files:
+    :return: Future，全部成功时结果为 {文件名: cos key}，由调用方交给 storage_manager；否则为 None
+    """
+    files = [(title, (zip_path, member_name)) for title, member_name in members.items()]
+
+    def finish(mirrored):
+        if mirrored is not None:
+            logger.success(f"{zip_path} upload sucessed.")
+        return mirrored
+
+    return then(_upload_files(root, category, beatMap_name, files, push_member, single_save, skip_files), finish)
 
 
 def tencent_cos_imag_list() -> tuple[dict, list]:
@@ -76,7 +258,7 @@ def tencent_cos_imag_list() -> tuple[dict, list]:
     for category in tencent_cos_osu_list():
         cur_urls = list()
         # 列举 osu/分类/ 目录下的文件：COS中的目录是'/'结尾的前缀名
-        response = client.list_objects(
+        response = get_client().list_objects(
             Bucket=COS_OSU_BUCKET,
             Prefix=OSU_DIR + category + OSU_IMG_DIR
         )
@@ -84,7 +266,7 @@ def tencent_cos_imag_list() -> tuple[dict, list]:
         if 'Contents' in response:
             for content in response['Contents']:
                 # 生成URL
-                url = client.get_object_url(
+                url = get_client().get_object_url(
                     Bucket=COS_OSU_BUCKET,
                     Key=content['Key']
                 )
@@ -95,7 +277,7 @@ def tencent_cos_imag_list() -> tuple[dict, list]:
 
 
 def tencent_cos_osu_list() -> list:
-    response = client.list_objects(
+    response = get_client().list_objects(
         Bucket=COS_OSU_BUCKET,
         Prefix=OSU_DIR,
         Delimiter='/'
@@ -111,4 +293,4 @@ def tencent_cos_osu_list() -> list:
 if __name__ == '__main__':
     tencent_cos_upload(
         COS_OSU_PATH, "Aisaka Taiga", "E:\code\PycharmProjects\osu-api\download\Aisaka Taiga\imgs", "", True
-    )
+    ).result()
@@ -0,0 +1,55 @@
+import os
+import zipfile
+
+import pytest
+
+from archive_store import ArchiveStore, archive_path, build_member_index, index_path
+
+BACKGROUND = bytes(range(256)) * 40
+SONG = b"ID3" + b"\x00" * 5000
+
+
+@pytest.fixture
+def store(tmp_path):
+    zip_path = archive_path("cat/1-a", str(tmp_path))
+    os.makedirs(os.path.dirname(zip_path))
+    with zipfile.ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("bg image.jpg", BACKGROUND, compress_type=zipfile.ZIP_STORED)
+        zip_file.writestr("audio.mp3", SONG, compress_type=zipfile.ZIP_DEFLATED)
+        zip_file.writestr("map.osu", b"osu file format v14")
+        zip_file.writestr("skip.png", b"\x89PNG")
+    return ArchiveStore(str(tmp_path))
+
+
+def test_index_keeps_media_members_that_pass_the_filter(store):
+    zip_path = archive_path("cat/1-a", store.base_path)
+    members = build_member_index(zip_path, accept=lambda zip_file, info, title: title != "skip.png")
+    assert set(members) == {"bg_image.jpg", "audio.mp3"}
+    assert store.list_members("cat/1-a") == {"images": ["bg_image.jpg"], "songs": ["audio.mp3"]}
+    assert store.member("cat/1-a", "skip.png") is None
+
+
+def test_stored_members_are_sliced_at_their_data_offset(store):
+    build_member_index(archive_path("cat/1-a", store.base_path))
+    chunks = list(store.iter_member("cat/1-a", "bg_image.jpg", chunk_size=1000))
+    assert b"".join(chunks) == BACKGROUND
+    assert [len(chunk) for chunk in chunks] == [1000] * 10 + [240]
+
+
+def test_deflated_members_are_decompressed(store):
+    build_member_index(archive_path("cat/1-a", store.base_path))
+    assert b"".join(store.iter_member("cat/1-a", "audio.mp3", chunk_size=512)) == SONG
+
+
+def test_missing_index_is_not_rebuilt(store):
+    zip_path = archive_path("cat/1-a", store.base_path)
+    assert store.members("cat/1-a") is None
+    assert not os.path.exists(index_path(zip_path))
+    with pytest.raises(FileNotFoundError):
+        list(store.iter_member("cat/1-a", "bg_image.jpg"))
+    assert store.list_members("cat/1-a") == {"images": [], "songs": []}
+
+
+def test_missing_archive(store):
+    assert store.members("cat/404-missing") is None
+    assert not store.exists("cat/404-missing")
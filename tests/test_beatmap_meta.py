@@ -0,0 +1,131 @@
+import io
+import json
+import os
+import struct
+import wave
+import zipfile
+
+import pytest
+from PIL import Image
+
+from audio_probe import probe_audio
+from beatmap_meta import BeatmapMetaStore, build_meta_from_dir, build_meta_from_zip, meta_path, read_ingested_at, \
+    refresh_meta, write_meta
+
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x00"  # MPEG1 Layer III, 128kbps, 44100Hz, 立体声
+
+
+def make_wav(seconds=0.5, rate=44100, extra_chunk=False):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(b"\x00\x00" * int(rate * seconds))
+    data = buffer.getvalue()
+    if extra_chunk:
+        # fmt 前面插入一个奇数长度的 LIST 块，需要按 2 字节对齐跳过
+        data = data[:12] + b"LIST" + struct.pack("<I", 3) + b"abc\x00" + data[12:]
+    return data
+
+
+def make_flac(rate=44100, total_samples=88200):
+    bits = (rate << 44) | (1 << 41) | (15 << 36) | total_samples
+    streaminfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6 + bits.to_bytes(8, "big") + b"\x00" * 16
+    return b"fLaC" + b"\x80" + len(streaminfo).to_bytes(3, "big") + streaminfo
+
+
+def make_cbr_mp3(seconds=1.0, id3=True):
+    tag = b"ID3\x04\x00\x00" + bytes([0, 0, 0, 20]) + b"\x00" * 20 if id3 else b""
+    body = MP3_FRAME_HEADER + b"\x00" * (int(16000 * seconds) - len(MP3_FRAME_HEADER))
+    return tag + body
+
+
+def make_vbr_mp3(frames=100):
+    xing = b"Xing" + struct.pack(">II", 1, frames)
+    return MP3_FRAME_HEADER + b"\x00" * 32 + xing + b"\x00" * 400
+
+
+@pytest.mark.parametrize("data, expected", [
+    (make_wav(), (0.5, "wav")),
+    (make_wav(extra_chunk=True), (0.5, "wav")),
+    (make_flac(), (2.0, "flac")),
+    (make_cbr_mp3(), (1.0, "mp3")),
+    (make_cbr_mp3(id3=False), (1.0, "mp3")),
+    (make_vbr_mp3(), (round(100 * 1152 / 44100, 3), "mp3")),
+], ids=["wav", "wav-list-chunk", "flac", "mp3-id3", "mp3", "mp3-xing"])
+def test_probe_audio_reads_duration_from_the_header(data, expected):
+    assert probe_audio(io.BytesIO(data), len(data)) == expected
+
+
+@pytest.mark.parametrize("data", [make_wav(), make_flac(), make_cbr_mp3()], ids=["wav", "flac", "mp3"])
+def test_probe_audio_rejects_truncated_headers(data):
+    for cut in (0, 3, 12, 30):
+        assert probe_audio(io.BytesIO(data[:cut]), len(data)) is None
+
+
+def test_probe_audio_rejects_unknown_formats():
+    assert probe_audio(io.BytesIO(b"OggS" + b"\x00" * 100), 104) is None
+
+
+def write_set(set_dir):
+    os.makedirs(set_dir)
+    Image.new("RGB", (1280, 720)).save(os.path.join(set_dir, "bg.jpg"))
+    with open(os.path.join(set_dir, "audio.wav"), "wb") as audio_file:
+        audio_file.write(make_wav())
+    with open(os.path.join(set_dir, "map.osu"), "wb") as map_file:
+        map_file.write(b"osu file format v14")
+    return ["bg.jpg", "audio.wav", "map.osu"]
+
+
+def test_meta_from_a_folder_and_a_zip_agree(tmp_path):
+    set_dir = str(tmp_path / "1-a")
+    titles = write_set(set_dir)
+    from_dir = build_meta_from_dir(set_dir, titles)
+    archive = str(tmp_path / "1-a.osz")
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        for title in titles:
+            zip_file.write(os.path.join(set_dir, title), f"sub/{title}")
+    from_zip = build_meta_from_zip(archive, {title: f"sub/{title}" for title in titles})
+    assert from_dir["images"] == from_zip["images"] == ["bg.jpg"]
+    assert from_dir["songs"] == from_zip["songs"] == ["audio.wav"]
+    assert from_dir["files"] == from_zip["files"]
+    assert from_dir["files"]["bg.jpg"]["width"] == 1280
+    assert from_dir["files"]["audio.wav"]["duration"] == 0.5
+    assert "map.osu" not in from_dir["files"]
+
+
+def test_probed_dimensions_are_not_read_again(tmp_path):
+    set_dir = str(tmp_path / "1-a")
+    write_set(set_dir)
+    meta = build_meta_from_dir(set_dir, ["bg.jpg"], probes={"bg.jpg": [1920, 1080, "png", 5]})
+    assert meta["files"]["bg.jpg"]["format"] == "png"
+
+
+def test_refresh_keeps_ingest_time_and_other_entries(tmp_path):
+    set_dir = str(tmp_path / "1-a")
+    titles = write_set(set_dir)
+    meta = build_meta_from_dir(set_dir, titles)
+    meta["ingested_at"] = 1234
+    write_meta(set_dir, meta)
+    # 从COS拉回的是 webp 版本
+    Image.new("RGB", (1280, 720)).save(os.path.join(set_dir, "bg.jpg"), "WEBP")
+    refresh_meta(set_dir, ["bg.jpg"])
+    with open(meta_path(set_dir), encoding="utf-8") as meta_file:
+        refreshed = json.load(meta_file)
+    assert refreshed["files"]["bg.jpg"]["format"] == "webp"
+    assert refreshed["files"]["audio.wav"] == meta["files"]["audio.wav"]
+    assert read_ingested_at(set_dir) == 1234
+    assert read_ingested_at(str(tmp_path / "2-missing")) is None
+
+
+def test_store_rereads_only_changed_sidecars(tmp_path):
+    store = BeatmapMetaStore(str(tmp_path))
+    assert store.get("cat/1-a") is None and not store.exists("cat/1-a")
+    os.makedirs(tmp_path / "cat")
+    write_meta(str(tmp_path / "cat/1-a"), {"images": ["bg.jpg"], "songs": [], "files": {}})
+    first = store.get("cat/1-a")
+    assert first["images"] == ["bg.jpg"] and store.get("cat/1-a") is first
+    write_meta(str(tmp_path / "cat/1-a"), {"images": [], "songs": ["audio.mp3"], "files": {}})
+    os.utime(meta_path(str(tmp_path / "cat/1-a")), (1, 1))
+    assert store.get("cat/1-a")["songs"] == ["audio.mp3"]
@@ -0,0 +1,156 @@
+import base64
+import json
+import os
+import shutil
+
+import pytest
+
+import catalog
+from beatmap_meta import write_meta
+from catalog import BeatmapCatalog, BeatmapRow, CatalogIndex, decode_cursor, encode_cursor, scan_beatmapsets
+from shared_catalog import SharedCatalog
+from storage_manager import StorageManager
+
+
+def row(set_id, category="cat", mtime=0, has_images=True, has_audio=True):
+    return BeatmapRow(f"{set_id}-artist-title", category, set_id, mtime, has_images, has_audio)
+
+
+@pytest.fixture
+def base(tmp_path, monkeypatch):
+    base = tmp_path / "download"
+    base.mkdir()
+    manager = StorageManager(str(base), None, str(tmp_path / "state.jsonl"))
+    monkeypatch.setattr(catalog, "get_storage_manager", lambda: manager)
+    return base
+
+
+def make_set(base, path, files=("bg.jpg", "audio.mp3"), ingested_at=None):
+    set_dir = base / path
+    set_dir.mkdir(parents=True)
+    for file in files:
+        (set_dir / file).write_bytes(b"x")
+    if ingested_at is not None:
+        write_meta(str(set_dir), {"images": [], "songs": [], "files": {}, "ingested_at": ingested_at})
+    return str(set_dir)
+
+
+def test_row_encoding_round_trip():
+    original = row(42, category="")
+    assert BeatmapRow.decode(original.encode()) == original
+    assert original.path == original.name
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("mtime", True, row(7, mtime=123))
+    assert decode_cursor(cursor) == ("mtime", True, 123, "cat/7-artist-title")
+
+
+@pytest.mark.parametrize("raw", [
+    b"not json",
+    json.dumps(["name", False, 1, "cat/1"]).encode(),  # 不支持的排序字段
+    json.dumps(["set_id", False, 1]).encode(),
+    json.dumps(["set_id", False, "abc", "cat/1"]).encode(),
+    json.dumps(["set_id", False, None, "cat/1"]).encode(),
+    json.dumps({"sort": "set_id"}).encode(),
+])
+def test_tampered_cursors_are_rejected(raw):
+    with pytest.raises(ValueError):
+        decode_cursor(base64.urlsafe_b64encode(raw).decode("ascii"))
+    with pytest.raises(ValueError):
+        decode_cursor("%%%not-base64%%%")
+
+
+def test_paging_with_cursors_visits_every_row_once():
+    rows = [row(set_id, category="ab"[set_id % 2], mtime=set_id % 5) for set_id in range(1, 24)]
+    index = CatalogIndex(rows)
+    for sort, descending in (("set_id", False), ("mtime", True)):
+        seen, cursor = [], None
+        while True:
+            page, cursor, total = index.page(sort=sort, descending=descending, cursor=cursor, limit=5)
+            seen.extend(page)
+            if cursor is None:
+                break
+        assert total == len(rows) and len(seen) == len(rows) and set(seen) == set(rows)
+        keys = [getattr(item, sort) for item in seen]
+        assert keys == sorted(keys, reverse=descending)
+
+
+def test_filters_and_cursor_keep_the_ordering():
+    index = CatalogIndex([row(1, "a"), row(2, "b", has_audio=False), row(3, "a", has_images=False), row(4, "a")])
+    page, cursor, total = index.page(category="a", has_images=True, limit=1)
+    assert [item.set_id for item in page] == [1] and total == 2
+    page, cursor, _ = index.page(category="a", has_images=True, cursor=cursor, limit=1)
+    assert [item.set_id for item in page] == [4] and cursor is None
+    assert [item.set_id for item in index.page(has_audio=False)[0]] == [2]
+    with pytest.raises(ValueError):
+        index.page(sort="name")
+
+
+def test_scan_sorts_by_ingest_time_not_folder_mtime(base):
+    late = make_set(base, "cat/1-late", ingested_at=2000)
+    make_set(base, "cat/2-early", ingested_at=1000)
+    make_set(base, "3-flat", files=("bg.png",))
+    os.utime(late, (1, 1))  # 淘汰、拉回会改变文件夹的 mtime
+    rows = {item.name: item for item in scan_beatmapsets(str(base))}
+    assert rows["1-late"].mtime == 2000 and rows["2-early"].mtime == 1000
+    assert rows["3-flat"].category == "" and rows["3-flat"].has_images and not rows["3-flat"].has_audio
+    ordered = CatalogIndex(list(rows.values())).page(sort="mtime", category="cat")[0]
+    assert [item.name for item in ordered] == ["2-early", "1-late"]
+
+
+def test_scan_reuses_registered_rows(base):
+    set_dir = make_set(base, "cat/1-a", ingested_at=5)
+    first = scan_beatmapsets(str(base))
+    os.remove(os.path.join(set_dir, "audio.mp3"))
+    assert scan_beatmapsets(str(base), first) == first
+
+
+def test_extracting_folders_are_not_listed(base):
+    make_set(base, "cat/1-a")
+    make_set(base, "cat/2-b.extracting")
+    assert [item.name for item in scan_beatmapsets(str(base))] == ["1-a"]
+
+
+def test_register_resolve_and_contains(base, tmp_path):
+    beatmaps = BeatmapCatalog(str(base), catalog=SharedCatalog(str(tmp_path / "catalog.bin"), check_interval=0))
+    make_set(base, "cat/1-a")
+    assert beatmaps.resolve("1-a") == "cat/1-a"
+    registered = beatmaps.register("cat", make_set(base, "cat/2-b"))
+    assert registered.path == "cat/2-b"
+    assert beatmaps.contains("cat/2-b") and not beatmaps.contains("other/2-b")
+    assert beatmaps.resolve("404-missing") == "404-missing"
+    assert beatmaps.register("cat", str(base / "cat/404-missing")) is None
+    assert beatmaps.page()[2] == 2
+
+
+def test_extend_replaces_reregistered_rows_in_cached_orderings():
+    index = CatalogIndex([row(1, mtime=10), row(2, mtime=20), row(3, mtime=30)])
+    by_time = index.ordering("mtime", True, None, None, None)
+    with_audio = index.ordering("set_id", False, "cat", None, True)
+    index.extend([row(1, mtime=40, has_audio=False), row(4, mtime=5)])
+    assert [item.set_id for item in by_time[1]] == [1, 3, 2, 4]
+    assert [key for key, _ in by_time[0]] == [-40, -30, -20, -5]
+    assert [item.set_id for item in with_audio[1]] == [2, 3, 4]
+    assert [item.set_id for item in index.rows] == [1, 2, 3, 4]
+    assert index.by_name[row(1).name].mtime == 40
+    rebuilt = CatalogIndex(index.rows)
+    assert rebuilt.ordering("mtime", True, None, None, None) == by_time
+
+
+def test_catalog_rescans_only_when_the_download_directory_changes(base, tmp_path):
+    shared = SharedCatalog(str(tmp_path / "catalog.bin"), check_interval=0)
+    beatmaps = BeatmapCatalog(str(base), ttl=3600, catalog=shared)
+    make_set(base, "cat/1-a")
+    first = beatmaps.index()
+    assert not beatmaps.is_stale()
+    make_set(base, "cat/2-b")
+    assert beatmaps.is_stale()
+    assert shared.refresh(catalog.SECTION_NAME, beatmaps.ttl, beatmaps.load, blocking=True, stale=beatmaps.is_stale)
+    # 只多了一个谱面，发布后其他 worker 增量追加，不重建索引
+    assert beatmaps.index() is first
+    assert [item.name for item in first.rows] == ["1-a", "2-b"]
+    assert not shared.refresh(catalog.SECTION_NAME, beatmaps.ttl, beatmaps.load, stale=beatmaps.is_stale)
+    shutil.rmtree(base / "cat/1-a")
+    assert shared.refresh(catalog.SECTION_NAME, beatmaps.ttl, beatmaps.load, blocking=True, stale=beatmaps.is_stale)
+    assert [item.name for item in beatmaps.index().rows] == ["2-b"]
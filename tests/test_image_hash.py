@@ -0,0 +1,49 @@
+import numpy as np
+from PIL import Image
+
+from const import PHASH_MAX_DISTANCE
+from image_hash import PHashIndex, hamming_distances, phash_files
+
+
+def make_image(path, seed=0, size=(320, 240)):
+    # 随机色块放大后的图片，缩放、重新压缩后感知哈希基本不变
+    blocks = np.random.default_rng(seed).integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    Image.fromarray(blocks).resize(size, Image.BILINEAR).save(path)
+    return str(path)
+
+
+def test_hamming_distances_count_differing_bits():
+    hashes = np.array([0, 0b1011, 2 ** 64 - 1], dtype=np.uint64)
+    assert hamming_distances(hashes, 0b0011).tolist() == [2, 1, 62]
+
+
+def test_resized_copy_hashes_close_and_different_image_far(tmp_path):
+    original = make_image(tmp_path / "a.png")
+    resized = make_image(tmp_path / "b.jpg", size=(160, 120))
+    other = make_image(tmp_path / "c.png", seed=1)
+    hashes = phash_files([original, resized, other])
+    near = hamming_distances(np.array([hashes[resized]], dtype=np.uint64), hashes[original])[0]
+    far = hamming_distances(np.array([hashes[other]], dtype=np.uint64), hashes[original])[0]
+    assert near <= PHASH_MAX_DISTANCE < far
+
+
+def test_filter_duplicates_across_sets_only(tmp_path):
+    index = PHashIndex(str(tmp_path / "phash.txt"))
+    set_a = [make_image(tmp_path / "a1.png"), make_image(tmp_path / "a2.jpg", size=(160, 120))]
+    # 同一个谱面里的两张相似图片都保留
+    assert index.filter_duplicates(set_a, key_func=lambda path: f"A/{path.rsplit('/', 1)[-1]}") == {}
+    copy = make_image(tmp_path / "b1.png", size=(200, 150))
+    duplicates = index.filter_duplicates([copy], key_func=lambda path: f"B/{path.rsplit('/', 1)[-1]}")
+    assert duplicates[copy] in ("A/a1.png", "A/a2.jpg")
+    assert index.keys == ["A/a1.png", "A/a2.jpg"]
+
+
+def test_reprocessing_a_set_finds_nothing_and_appends_nothing(tmp_path):
+    path = str(tmp_path / "phash.txt")
+    image = make_image(tmp_path / "a1.png")
+    PHashIndex(path).filter_duplicates([image], key_func=lambda _: "A/a1.png")
+    reloaded = PHashIndex(path)
+    assert reloaded.keys == ["A/a1.png"]
+    assert reloaded.filter_duplicates([image], key_func=lambda _: "A/a1.png") == {}
+    with open(path, encoding="utf-8") as index_file:
+        assert len(index_file.readlines()) == 1
@@ -0,0 +1,89 @@
+import io
+import zipfile
+
+import pytest
+from PIL import Image
+
+from image_probe import ImageDimensionIndex, passes_quality, probe_image
+
+
+def encode(image_format, size=(1920, 1080), **params):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (10, 120, 200)).save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("image_format, params, expected", [
+    ("PNG", {}, "png"),
+    ("GIF", {}, "gif"),
+    ("BMP", {}, "bmp"),
+    ("JPEG", {}, "jpeg"),
+    ("JPEG", {"progressive": True}, "jpeg"),
+    ("WEBP", {}, "webp"),
+    ("WEBP", {"lossless": True}, "webp"),
+])
+def test_probe_reads_dimensions_from_the_header(image_format, params, expected):
+    assert probe_image(io.BytesIO(encode(image_format, (1366, 768), **params))) == (1366, 768, expected)
+
+
+def test_probe_jpeg_skips_exif_before_the_frame_header():
+    exif = Image.Exif()
+    exif[0x010F] = "camera" * 200
+    assert probe_image(io.BytesIO(encode("JPEG", exif=exif.tobytes()))) == (1920, 1080, "jpeg")
+
+
+@pytest.mark.parametrize("image_format, cuts", [
+    ("PNG", (0, 1, 8, 20)),
+    ("GIF", (0, 3, 6, 9)),
+    ("BMP", (0, 2, 18, 25)),
+    ("JPEG", (0, 2, 20, 100)),  # SOF 在量化表、霍夫曼表之后
+    ("WEBP", (0, 4, 12, 25)),
+])
+def test_probe_rejects_truncated_headers(image_format, cuts):
+    data = encode(image_format)
+    for cut in cuts:
+        assert probe_image(io.BytesIO(data[:cut])) is None
+
+
+def test_probe_rejects_unknown_formats():
+    assert probe_image(io.BytesIO(b"not an image at all, just some text")) is None
+
+
+def test_probe_reads_zip_members_without_extracting():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("bg.jpg", encode("JPEG", (1280, 720)))
+    with zipfile.ZipFile(buffer) as zip_file, zip_file.open("bg.jpg") as member:
+        assert probe_image(member) == (1280, 720, "jpeg")
+
+
+def test_passes_quality():
+    assert passes_quality(1920, 1080)
+    assert not passes_quality(320, 180)
+    assert not passes_quality(1920, 200)
+
+
+def test_index_reloads_lines_appended_by_another_process(tmp_path):
+    path = str(tmp_path / "image_index.jsonl")
+    writer, reader = ImageDimensionIndex(path), ImageDimensionIndex(path)
+    writer.add("cat/1-a/bg.jpg", 1920, 1080, "jpeg", 1000)
+    assert [entry["key"] for entry in reader.query()] == ["cat/1-a/bg.jpg"]
+    # 还没写完的最后一行留到下次
+    with open(path, "a", encoding="utf-8") as index_file:
+        index_file.write('{"key": "cat/2-b/bg.png", "width": 1280, "height": 72')
+    assert len(reader.query()) == 1
+    with open(path, "a", encoding="utf-8") as index_file:
+        index_file.write('0, "format": "png", "size": 10}\n')
+    assert [entry["key"] for entry in reader.query(prefix="cat/2-b/")] == ["cat/2-b/bg.png"]
+    writer.add("cat/1-a/bg.jpg", 800, 600, "jpeg", 500)
+    assert reader.query(prefix="cat/1-a/", min_width=1000) == []
+
+
+def test_index_rereads_a_replaced_file(tmp_path):
+    path = tmp_path / "image_index.jsonl"
+    index = ImageDimensionIndex(str(path))
+    index.add("a/bg.jpg", 1920, 1080, "jpeg", 1)
+    replacement = tmp_path / "replacement.jsonl"
+    replacement.write_text('{"key": "b/bg.jpg", "width": 1920, "height": 1080, "format": "jpeg", "size": 1}\n')
+    replacement.replace(path)
+    assert [entry["key"] for entry in index.query()] == ["b/bg.jpg"]
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from const import RENDITION_WIDTHS
+from image_rendition import RenditionCache, RenditionService, render_rendition, snap_width
+
+
+def make_image(path, width=400, height=300):
+    Image.new("RGB", (width, height), (200, 30, 30)).save(path, "PNG")
+    return path
+
+
+def test_snap_width_rounds_up_to_a_fixed_rung():
+    assert snap_width(1) == RENDITION_WIDTHS[0]
+    assert snap_width(RENDITION_WIDTHS[0] + 1) == RENDITION_WIDTHS[1]
+    assert snap_width(10 ** 9) == RENDITION_WIDTHS[-1]
+
+
+def test_render_rendition_shrinks_but_never_upscales(tmp_path):
+    src = make_image(str(tmp_path / "bg.png"))
+    small, large = str(tmp_path / "small.webp"), str(tmp_path / "large.webp")
+    assert render_rendition(src, small, 200, "webp") == os.path.getsize(small)
+    render_rendition(src, large, 4000, "webp")
+    with Image.open(small) as img:
+        assert img.size == (200, 150)
+    with Image.open(large) as img:
+        assert img.size == (400, 300)
+
+
+def test_render_rendition_reads_zip_members(tmp_path):
+    src = make_image(str(tmp_path / "bg.png"))
+    archive = str(tmp_path / "set.osz")
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.write(src, "bg.png")
+    dst = str(tmp_path / "out.jpg")
+    render_rendition((archive, "bg.png"), dst, 100, "jpeg")
+    with Image.open(dst) as img:
+        assert img.format == "JPEG" and img.width == 100
+
+
+def test_cache_key_tracks_source_width_and_format(tmp_path):
+    src = make_image(str(tmp_path / "bg.png"))
+    key = RenditionService.cache_key(src, 320, "webp")
+    assert key == RenditionService.cache_key(src, 320, "webp")
+    assert key != RenditionService.cache_key(src, 640, "webp")
+    assert key != RenditionService.cache_key(src, 320, "jpeg")
+    make_image(src, 401, 300)
+    os.utime(src, ns=(1, 1))
+    assert key != RenditionService.cache_key(src, 320, "webp")
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = RenditionCache(str(tmp_path), max_bytes=10)
+    for key in ("a", "b", "c"):
+        (tmp_path / key).write_bytes(b"x" * 4)
+        cache.put(key, 4)
+        if key == "b":
+            assert cache.get("a") is not None  # a 变成最近使用
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.total_bytes == 8
+    assert not (tmp_path / "b").exists()
+
+
+def test_cache_reload_drops_leftover_tmp_files(tmp_path):
+    (tmp_path / "a").write_bytes(b"x" * 4)
+    (tmp_path / "a.123.tmp").write_bytes(b"x")
+    cache = RenditionCache(str(tmp_path), max_bytes=100)
+    assert list(cache.entries) == ["a"] and cache.total_bytes == 4
+    assert not (tmp_path / "a.123.tmp").exists()
+
+
+def test_service_generates_each_rendition_once(tmp_path):
+    src = make_image(str(tmp_path / "bg.png"))
+    service = RenditionService()
+    service.cache = RenditionCache(str(tmp_path / "cache"))
+    service.executor = ThreadPoolExecutor(max_workers=2)
+    generated = []
+    generate = service.generate
+
+    async def counting_generate(*args):
+        generated.append(args)
+        return await generate(*args)
+
+    service.generate = counting_generate
+
+    async def run():
+        first = await asyncio.gather(*(service.get(src, 320, "webp") for _ in range(3)))
+        again = await service.get(src, 320, "webp", RenditionService.cache_key(src, 320, "webp"))
+        return first, again
+
+    try:
+        first, again = asyncio.run(run())
+    finally:
+        service.shutdown()
+    assert len(generated) == 1
+    assert len({result for result in first}) == 1
+    assert again == first[0]
+    assert os.path.isfile(again[0])
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import pipeline_journal
+from const import JOURNAL_SUFFIX
+from pipeline_journal import PipelineJournal, atomic_copy, atomic_write, find_journals, journal_path, replace_dir, \
+    STAGE_STARTED, STAGE_DOWNLOADED, STAGE_EXTRACTED, STAGE_UPLOADED
+
+STAGES = [STAGE_STARTED, STAGE_DOWNLOADED, STAGE_EXTRACTED, STAGE_UPLOADED]
+
+
+@pytest.fixture
+def zip_path(tmp_path):
+    category = tmp_path / "download" / "cat"
+    category.mkdir(parents=True)
+    return str(category / "1-a.zip")
+
+
+@pytest.mark.parametrize("crashed_after", range(len(STAGES)))
+def test_restart_sees_exactly_the_stages_completed_before_the_crash(zip_path, crashed_after):
+    journal = PipelineJournal(zip_path)
+    for stage in STAGES[:crashed_after + 1]:
+        journal.mark(stage, at=stage)
+    # 进程崩溃后重新启动，从磁盘读取
+    (category, recovered), = find_journals(os.path.dirname(os.path.dirname(zip_path)))
+    assert category == "cat" and recovered.zip_path == zip_path
+    assert [stage for stage in STAGES if recovered.has(stage)] == STAGES[:crashed_after + 1]
+    assert recovered.data(STAGES[crashed_after]) == {"at": STAGES[crashed_after]}
+    remaining = [stage for stage in STAGES if not recovered.has(stage)]
+    assert remaining == STAGES[crashed_after + 1:]
+
+
+def test_finished_sets_leave_no_journal(zip_path):
+    journal = PipelineJournal(zip_path)
+    journal.mark(STAGE_STARTED)
+    journal.finish()
+    assert not journal.exists()
+    assert find_journals(os.path.dirname(os.path.dirname(zip_path))) == []
+
+
+def test_corrupt_journal_starts_over(zip_path):
+    with open(journal_path(zip_path), "w", encoding="utf-8") as journal_file:
+        journal_file.write("{not json")
+    assert PipelineJournal(zip_path).stages == {}
+
+
+def test_journals_are_found_per_category(tmp_path):
+    base = tmp_path / "download"
+    for category in ("b", "a"):
+        (base / category).mkdir(parents=True)
+        PipelineJournal(str(base / category / "1-x.zip")).mark(STAGE_STARTED)
+    (base / "a" / "2-y.zip").write_bytes(b"")  # 没有日志的是处理完的谱面
+    assert [(category, os.path.basename(journal.path)) for category, journal in find_journals(str(base))] == [
+        ("a", "1-x" + JOURNAL_SUFFIX), ("b", "1-x" + JOURNAL_SUFFIX)]
+    assert find_journals(str(tmp_path / "missing")) == []
+
+
+def test_atomic_write_keeps_the_old_content_when_writing_fails(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.json")
+    atomic_write(path, "old")
+
+    def failing_fsync(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(pipeline_journal.os, "fsync", failing_fsync)
+    with pytest.raises(OSError):
+        atomic_write(path, b"new")
+    monkeypatch.undo()
+    with open(path, encoding="utf-8") as state_file:
+        assert state_file.read() == "old"
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_atomic_copy_and_replace_dir(tmp_path):
+    src = tmp_path / "bg.jpg"
+    src.write_bytes(b"image")
+    atomic_copy(str(src), str(tmp_path / "copy.jpg"))
+    assert (tmp_path / "copy.jpg").read_bytes() == b"image"
+    target = tmp_path / "1-a"
+    target.mkdir()
+    (target / "half.osu").write_bytes(b"left by a crash")
+    staging = tmp_path / "1-a.extracting"
+    staging.mkdir()
+    (staging / "map.osu").write_bytes(b"complete")
+    replace_dir(str(staging), str(target))
+    assert os.listdir(target) == ["map.osu"] and not staging.exists()
@@ -0,0 +1,64 @@
+from catalog import BeatmapRow
+from search_index import SearchIndex, normalize
+
+
+def row(name, category="cat"):
+    set_id = int(name.partition("-")[0]) if name[0].isdigit() else -1
+    return BeatmapRow(name, category, set_id, 0, True, True)
+
+
+ROWS = [
+    row("1001-Camellia-Ghost"),
+    row("1002-Camellia-Exit_This_Earth's_Atomosphere"),
+    row("2003-ZUTOMAYO-Byoushin_wo_Kamu", category="jpop"),
+    row("3004-YOASOBI-夜に駆ける", category="jpop"),
+    row("10010-xi-Blue_Zenith"),
+]
+
+
+def index():
+    search_index = SearchIndex()
+    for item in ROWS:
+        search_index.add(item)
+    return search_index
+
+
+def names(results):
+    return [item.name for item, _ in results]
+
+
+def test_normalize_folds_width_case_and_underscores():
+    assert normalize("Ｂｌｕｅ_ZENITH  ") == "blue zenith"
+
+
+def test_exact_set_id_ranks_first():
+    assert names(index().search("1001"))[:2] == ["1001-Camellia-Ghost", "10010-xi-Blue_Zenith"]
+
+
+def test_word_prefix_and_all_terms_must_match():
+    search_index = index()
+    assert set(names(search_index.search("camel"))) == {ROWS[0].name, ROWS[1].name}
+    assert names(search_index.search("camellia earth")) == [ROWS[1].name]
+    assert search_index.search("camellia zenith") == []
+
+
+def test_candidates_are_confirmed_term_by_term():
+    # 单个 ASCII 字符不走倒排，只在确认时检查；三元组都命中但顺序不对的词也会被排除
+    assert names(index().search("zenith x")) == [ROWS[4].name]
+    assert index().search("zenthi") == []
+
+
+def test_cjk_single_character_and_category_filter():
+    search_index = index()
+    assert names(search_index.search("夜")) == [ROWS[3].name]
+    assert set(names(search_index.search("jpop"))) == {ROWS[2].name, ROWS[3].name}
+    assert names(search_index.search("o", category="jpop", limit=1)) == [ROWS[3].name]
+
+
+def test_sync_applies_removals_and_changes():
+    search_index = index()
+    renamed = row("1001-Camellia-Ghost", category="other")
+    search_index.sync([renamed] + ROWS[1:4])
+    assert len(search_index) == 4
+    assert search_index.search("blue") == []
+    assert {item.path for item, _ in search_index.search("ghost")} == {"other/1001-Camellia-Ghost"}
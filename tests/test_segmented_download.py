@@ -0,0 +1,157 @@
+import json
+import os
+import re
+
+import pytest
+import requests
+
+import segmented_download
+from const import DOWNLOAD_MIN_SEGMENT_SIZE
+from segmented_download import DownloadError, SegmentedDownload, split_segments
+
+DATA = bytes(range(256)) * (DOWNLOAD_MIN_SEGMENT_SIZE * 4 // 256 + 7)
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b"", headers=None, fail_after=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.url = "https://mirror.example/1.osz"
+        self.fail_after = fail_after
+
+    def iter_content(self, chunk_size):
+        sent = 0
+        for position in range(0, len(self.body), chunk_size):
+            chunk = self.body[position:position + chunk_size]
+            if self.fail_after is not None and sent + len(chunk) > self.fail_after:
+                yield chunk[:self.fail_after - sent]
+                raise requests.ConnectionError("connection reset")
+            sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeSession:
+    """
+    按 Range 返回 DATA 的一段；fail_once 里的起始位置第一次请求时只返回一部分就断开
+    """
+
+    def __init__(self, data=DATA, etag='"v1"', ranges=True, fail_once=()):
+        self.data = data
+        self.etag = etag
+        self.ranges = ranges
+        self.fail_once = set(fail_once)
+        self.requested = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        requested = (headers or {}).get("Range")
+        self.requested.append(requested)
+        if not self.ranges or requested is None:
+            return FakeResponse(200, self.data)
+        start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", requested).groups())
+        headers = {"Content-Range": f"bytes {start}-{end}/{len(self.data)}", "ETag": self.etag}
+        fail_after = None
+        if start in self.fail_once:
+            self.fail_once.discard(start)
+            fail_after = 1000
+        return FakeResponse(206, self.data[start:end + 1], headers, fail_after)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(segmented_download.time, "sleep", lambda seconds: None)
+
+
+def test_split_segments_cover_the_file_exactly():
+    segments = split_segments(10 ** 7 + 3, segments=4, min_size=10 ** 6)
+    assert segments[0][0] == 0 and segments[-1][1] == 10 ** 7 + 2
+    assert all(left[1] + 1 == right[0] for left, right in zip(segments, segments[1:]))
+    assert split_segments(100, segments=4, min_size=1000) == [[0, 99, 0]]
+
+
+def test_parallel_ranges_reassemble_the_file(tmp_path):
+    dst = str(tmp_path / "1.osz")
+    session = FakeSession()
+    assert SegmentedDownload(session, "https://osu.example/d/1", dst).download() == len(DATA)
+    with open(dst, "rb") as result:
+        assert result.read() == DATA
+    assert not os.path.exists(dst + ".part") and not os.path.exists(dst + ".part.json")
+    assert len(session.requested) == 1 + 4
+
+
+def test_dropped_connection_resumes_from_the_written_offset(tmp_path):
+    dst = str(tmp_path / "1.osz")
+    first = split_segments(len(DATA))[1]
+    session = FakeSession(fail_once={first[0]})
+    SegmentedDownload(session, "https://osu.example/d/1", dst).download()
+    with open(dst, "rb") as result:
+        assert result.read() == DATA
+    assert f"bytes={first[0] + 1000}-{first[1]}" in session.requested
+
+
+def write_partial_state(dst, etag='"v1"'):
+    """
+    模拟上次下载到一半退出：第一段完成，第二段下了一部分，其他没开始
+    """
+    segments = split_segments(len(DATA))
+    segments[0][2] = segments[0][1] + 1
+    segments[1][2] = 5000
+    with open(dst + ".part", "wb") as part_file:
+        part_file.truncate(len(DATA))
+        part_file.write(DATA[:segments[0][1] + 1])
+        part_file.seek(segments[1][0])
+        part_file.write(DATA[segments[1][0]:segments[1][0] + 5000])
+    with open(dst + ".part.json", "w", encoding="utf-8") as state_file:
+        json.dump({"total": len(DATA), "etag": etag, "segments": segments}, state_file)
+    return segments
+
+
+def test_resume_fetches_only_the_missing_ranges(tmp_path):
+    dst = str(tmp_path / "1.osz")
+    segments = write_partial_state(dst)
+    session = FakeSession()
+    SegmentedDownload(session, "https://osu.example/d/1", dst).download()
+    with open(dst, "rb") as result:
+        assert result.read() == DATA
+    assert sorted(session.requested[1:]) == sorted(
+        [f"bytes={segments[1][0] + 5000}-{segments[1][1]}"]
+        + [f"bytes={start}-{end}" for start, end, _ in segments[2:]]
+    )
+
+
+def test_changed_file_on_the_server_restarts_from_scratch(tmp_path):
+    dst = str(tmp_path / "1.osz")
+    write_partial_state(dst, etag='"old"')
+    session = FakeSession()
+    SegmentedDownload(session, "https://osu.example/d/1", dst).download()
+    assert len(session.requested) == 1 + 4
+    with open(dst, "rb") as result:
+        assert result.read() == DATA
+
+
+def test_falls_back_to_a_single_stream_without_range_support(tmp_path):
+    dst = str(tmp_path / "1.osz")
+    session = FakeSession(data=b"small file", ranges=False)
+    assert SegmentedDownload(session, "https://osu.example/d/1", dst).download() == len(b"small file")
+    assert session.requested == ["bytes=0-0"]
+    with open(dst, "rb") as result:
+        assert result.read() == b"small file"
+
+
+def test_failed_probe_raises_with_the_status_code(tmp_path):
+    class Missing(FakeSession):
+        def get(self, url, headers=None, stream=False, timeout=None):
+            return FakeResponse(404)
+
+    with pytest.raises(DownloadError) as error:
+        SegmentedDownload(Missing(), "https://osu.example/d/1", str(tmp_path / "1.osz")).download()
+    assert error.value.status_code == 404
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from shared_catalog import InterProcessLock, SharedCatalog
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "catalog.bin")
+
+
+def test_published_sections_are_visible_to_other_workers(path):
+    writer, reader = SharedCatalog(path, check_interval=0), SharedCatalog(path, check_interval=0)
+    assert reader.section("rows") is None
+    writer.publish({"rows": ["a", "b", "中文"], "pics": []})
+    rows = reader.section("rows")
+    assert list(rows) == ["a", "b", "中文"] and rows[-1] == "中文" and rows[1:] == ["b", "中文"]
+    assert len(reader.section("pics")) == 0
+    with pytest.raises(IndexError):
+        rows[3]
+
+
+def test_untouched_sections_are_copied_as_is(path):
+    catalog = SharedCatalog(path, check_interval=0)
+    catalog.publish({"rows": ["a"], "pics": ["x", "y"]})
+    saved_at = catalog.section("pics").saved_at
+    catalog.publish({"rows": ["b"]})
+    assert list(catalog.section("pics")) == ["x", "y"]
+    assert catalog.section("pics").saved_at == saved_at
+    assert list(catalog.section("rows")) == ["b"]
+
+
+def test_appends_extend_the_previous_generation(path):
+    writer, reader = SharedCatalog(path, check_interval=0), SharedCatalog(path, check_interval=0)
+    writer.publish({"rows": ["a", "b"]})
+    before = reader.section("rows")
+    writer.append("rows", ["c"])
+    after = reader.section("rows")
+    assert list(after) == ["a", "b", "c"]
+    assert after.extends(before)
+    assert list(before) == ["a", "b"]  # 旧版本的映射仍然可读
+
+
+def test_updates_that_only_add_rows_count_as_appends(path):
+    catalog = SharedCatalog(path, check_interval=0)
+    catalog.publish({"rows": ["a", "b"]})
+    first = catalog.section("rows")
+    catalog.publish({"rows": ["a", "b", "c"]})
+    second = catalog.section("rows")
+    assert second.extends(first)
+    catalog.publish({"rows": ["a", "c"]})
+    assert not catalog.section("rows").extends(second)
+
+
+def test_refresh_only_when_stale(path):
+    catalog = SharedCatalog(path, check_interval=0)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {"rows": [str(len(loads))]}
+
+    assert catalog.refresh("rows", 60, loader, blocking=True)
+    assert not catalog.refresh("rows", 60, loader, blocking=True)
+    assert catalog.refresh("rows", 60, loader, blocking=True, stale=lambda: True)
+    assert list(catalog.section("rows")) == ["2"] and len(loads) == 2
+
+
+def test_refresh_is_skipped_while_another_process_holds_the_lock(path):
+    catalog = SharedCatalog(path, check_interval=0)
+    other = InterProcessLock(path + ".lock")
+    assert other.acquire()
+    try:
+        assert not catalog.refresh("rows", 60, lambda: {"rows": ["a"]})
+    finally:
+        other.release()
+    assert catalog.refresh("rows", 60, lambda: {"rows": ["a"]})
+
+
+def test_unreadable_file_keeps_the_previous_version(path):
+    catalog = SharedCatalog(path, check_interval=0)
+    catalog.publish({"rows": ["a"]})
+    with open(path + ".new", "wb") as catalog_file:
+        catalog_file.write(b"garbage")
+    os.replace(path + ".new", path)
+    catalog.check(force=True)
+    assert list(catalog.section("rows")) == ["a"]
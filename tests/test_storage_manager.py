@@ -0,0 +1,142 @@
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+import storage_manager
+from storage_manager import StorageManager
+
+
+@pytest.fixture
+def base(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_manager, "STORAGE_ACCESS_PATH", str(tmp_path / "access.json"))
+    base = tmp_path / "download"
+    base.mkdir()
+    return base
+
+
+def make_set(base, name, size=100):
+    """
+    分类/谱面 文件夹：一张背景图（分类 imgs 目录下还有一份）、一首歌、一个谱面文件
+    """
+    set_dir = base / name
+    set_dir.mkdir(parents=True)
+    (set_dir / "bg.jpg").write_bytes(b"i" * size)
+    (set_dir / "audio.mp3").write_bytes(b"a" * size)
+    (set_dir / "map.osu").write_bytes(b"o" * 10)
+    imgs = set_dir.parent / "imgs"
+    imgs.mkdir(exist_ok=True)
+    (imgs / f"{set_dir.name}-bg.jpg").write_bytes(b"i" * size)
+    return str(set_dir)
+
+
+def mirror(manager, set_dir):
+    manager.confirm_upload(set_dir, {"bg.jpg": f"/osu/{set_dir}/bg.jpg", "audio.mp3": f"/osu/{set_dir}/audio.mp3"})
+
+
+def test_mirrored_records_are_appended_and_read_incrementally(base):
+    state_path = str(base.parent / "state.jsonl")
+    writer, reader = StorageManager(str(base), None, state_path), StorageManager(str(base), None, state_path)
+    mirror(writer, make_set(base, "cat/1-a"))
+    assert list(reader.load_mirrored()) == ["cat/1-a"]
+    with open(state_path, "a", encoding="utf-8") as state_file:
+        state_file.write('{"name": "cat/2-b", "files": {')  # 还没写完
+    assert list(reader.load_mirrored()) == ["cat/1-a"]
+    with open(state_path, "a", encoding="utf-8") as state_file:
+        state_file.write('"bg.jpg": "k"}}\n')
+    assert reader.load_mirrored()["cat/2-b"] == {"bg.jpg": "k"}
+    with open(state_path, encoding="utf-8") as state_file:
+        assert len(state_file.readlines()) == 2
+
+
+def test_enforce_evicts_least_recently_accessed_mirrored_sets(base):
+    manager = StorageManager(str(base), 700, str(base.parent / "state.jsonl"))
+    old, recent, unmirrored = make_set(base, "cat/1-old"), make_set(base, "cat/2-recent"), make_set(base, "cat/3-new")
+    mirror(manager, old)
+    mirror(manager, recent)
+    manager.access = {"cat/1-old": 1, "cat/2-recent": 2}
+    assert manager.current_usage() == 3 * 310
+    assert manager.enforce() == 300
+    assert manager.is_evicted("cat/1-old") and not manager.is_evicted("cat/2-recent")
+    assert sorted(os.listdir(old)) == ["map.osu"]  # 没有上传的文件保留，文件夹也保留
+    assert not os.path.exists(os.path.join(base, "cat/imgs/1-old-bg.jpg"))
+    assert os.listdir(unmirrored)
+    assert manager.current_usage() == 3 * 310 - 300
+
+
+def test_enforce_counts_added_sets_incrementally(base):
+    manager = StorageManager(str(base), 10 ** 6, str(base.parent / "state.jsonl"))
+    assert manager.current_usage() == 0
+    set_dir = make_set(base, "cat/1-a")
+    assert manager.enforce(added=set_dir) == 0
+    assert manager.usage == 310
+
+
+def test_no_budget_never_evicts(base):
+    manager = StorageManager(str(base), None, str(base.parent / "state.jsonl"))
+    mirror(manager, make_set(base, "cat/1-a"))
+    assert manager.enforce() == 0
+    assert not manager.is_evicted("cat/1-a")
+
+
+def test_concurrent_rehydrates_of_one_set_download_once(base):
+    manager = StorageManager(str(base), None, str(base.parent / "state.jsonl"))
+    calls = []
+
+    def slow_rehydrate(name):
+        calls.append(name)
+        time.sleep(0.1)
+        return 2
+
+    manager._rehydrate = slow_rehydrate
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.rehydrate("cat/1-a"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ["cat/1-a"] and results == [2] * 4
+    assert manager.rehydrating == {}
+
+
+def fake_cos(monkeypatch, download_file):
+    client = types.SimpleNamespace(download_file=download_file)
+    monkeypatch.setitem(sys.modules, "tencent_cloud", types.SimpleNamespace(get_client=lambda: client))
+    monkeypatch.setitem(sys.modules, "tc_config", types.SimpleNamespace(COS_OSU_BUCKET="bucket"))
+
+
+def test_rehydrate_restores_evicted_files(base, monkeypatch):
+    manager = StorageManager(str(base), 0, str(base.parent / "state.jsonl"))
+    set_dir = make_set(base, "cat/1-a")
+    mirror(manager, set_dir)
+    manager.evict("cat/1-a")
+
+    def download_file(Bucket, Key, DestFilePath):
+        with open(DestFilePath, "wb") as dest:
+            dest.write(Key.encode("utf-8"))
+
+    fake_cos(monkeypatch, download_file)
+    assert manager.rehydrate("cat/1-a") == 2
+    assert not manager.is_evicted("cat/1-a")
+    assert sorted(os.listdir(set_dir)) == ["audio.mp3", "bg.jpg", "map.osu"]
+
+
+def test_failed_rehydrate_leaves_no_partial_file(base, monkeypatch):
+    manager = StorageManager(str(base), 0, str(base.parent / "state.jsonl"))
+    set_dir = make_set(base, "cat/1-a")
+    mirror(manager, set_dir)
+    manager.evict("cat/1-a")
+
+    def download_file(Bucket, Key, DestFilePath):
+        with open(DestFilePath, "wb") as dest:
+            dest.write(b"half")
+        raise ConnectionError("reset")
+
+    fake_cos(monkeypatch, download_file)
+    with pytest.raises(ConnectionError):
+        manager.rehydrate("cat/1-a")
+    assert sorted(os.listdir(set_dir)) == ["map.osu"]
+    assert manager.is_evicted("cat/1-a")
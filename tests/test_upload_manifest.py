@@ -0,0 +1,91 @@
+import hashlib
+import zipfile
+
+import pytest
+
+from upload_manifest import UploadManifest, md5_source, md5_sources, response_etag
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return UploadManifest(str(tmp_path / "upload_manifest.jsonl"))
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def head_returning(etag):
+    calls = []
+
+    def head(key):
+        calls.append(key)
+        return etag
+
+    head.calls = calls
+    return head
+
+
+def test_md5_of_files_and_zip_members(tmp_path):
+    path = tmp_path / "audio.mp3"
+    path.write_bytes(b"song" * 1000)
+    archive = str(tmp_path / "set.osz")
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.write(path, "audio.mp3")
+    assert md5_source(str(path)) == md5_source((archive, "audio.mp3")) == md5(b"song" * 1000)
+    assert md5_sources([str(path), str(tmp_path / "missing.jpg")]) == {str(path): md5(b"song" * 1000)}
+
+
+def test_response_etag_handles_plain_and_processed_uploads():
+    assert response_etag({"ETag": '"abc"'}) == "abc"
+    assert response_etag(({"ETag": '"abc"'}, {"ProcessResults": {}})) == "abc"
+    assert response_etag(None) is None
+
+
+def test_recorded_keys_are_decided_locally(manifest):
+    manifest.record("/osu/a/bg.jpg", md5(b"v1"))
+    head = head_returning("whatever")
+    assert not manifest.needs_upload("/osu/a/bg.jpg", md5(b"v1"), head)
+    assert manifest.needs_upload("/osu/a/bg.jpg", md5(b"v2"), head)
+    assert head.calls == []
+
+
+def test_missing_legacy_key_is_uploaded(manifest):
+    assert manifest.needs_upload("/osu/a/bg.jpg", md5(b"v1"), head_returning(None))
+
+
+def test_existing_processed_legacy_key_is_trusted_and_recorded(manifest):
+    # 转成 webp 的图片 ETag 与源文件对不上，只能认为没变
+    head = head_returning("0" * 32)
+    assert not manifest.needs_upload("/osu/a/bg.jpg", md5(b"v1"), head)
+    assert not manifest.needs_upload("/osu/a/bg.jpg", md5(b"v1"), head)
+    assert head.calls == ["/osu/a/bg.jpg"]
+
+
+def test_plain_legacy_key_is_compared_by_etag(manifest):
+    assert not manifest.needs_upload("/osu/a/audio.mp3", md5(b"v1"), head_returning(md5(b"v1")), comparable=True)
+    assert manifest.needs_upload("/osu/b/audio.mp3", md5(b"v2"), head_returning(md5(b"v1")), comparable=True)
+    assert manifest.get("/osu/b/audio.mp3") is None
+    # 分块上传的 ETag 不是内容的 md5
+    assert not manifest.needs_upload("/osu/c/audio.mp3", md5(b"v2"), head_returning("abc-3"), comparable=True)
+
+
+def test_saves_append_only_new_records(manifest):
+    manifest.record("a", "1")
+    manifest.record("b", "2")
+    manifest.save()
+    manifest.record("a", "3")
+    manifest.save()
+    manifest.save()
+    with open(manifest.path, encoding="utf-8") as manifest_file:
+        assert len(manifest_file.readlines()) == 3
+    reloaded = UploadManifest(manifest.path)
+    assert reloaded.is_unchanged("a", "3") and reloaded.is_unchanged("b", "2")
+
+
+def test_partial_last_line_is_ignored(manifest):
+    manifest.record("a", "1")
+    manifest.save()
+    with open(manifest.path, "a", encoding="utf-8") as manifest_file:
+        manifest_file.write('{"key": "b", "md')
+    assert list(UploadManifest(manifest.path).entries) == ["a"]
@@ -0,0 +1,98 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import upload_service
+from upload_service import UploadService, then, then_future
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(upload_service.time, "sleep", lambda seconds: None)
+    service = UploadService(workers=2, queue_size=4, retries=2, backoff=0)
+    yield service
+    service.shutdown()
+
+
+def flaky(failures):
+    """
+    前 failures 次调用失败
+    """
+    calls = []
+
+    def upload(name):
+        calls.append(name)
+        if len(calls) <= failures:
+            raise ConnectionError("reset")
+
+    upload.calls = calls
+    return upload
+
+
+def test_batch_succeeds_after_retries(service):
+    upload = flaky(2)
+    assert service.submit([(upload, ("a",))], name="set").result(timeout=5) is True
+    assert upload.calls == ["a"] * 3
+
+
+def test_batch_fails_when_one_task_exhausts_its_retries(service):
+    upload = flaky(10)
+    tasks = [(upload, ("a",)), (lambda name: None, ("b",))]
+    assert service.submit(tasks, name="set").result(timeout=5) is False
+    assert len(upload.calls) == 3
+
+
+def test_empty_batch_completes_immediately(service):
+    assert service.submit([]).result(timeout=0) is True
+
+
+def test_callbacks_run_off_the_upload_workers(service):
+    release = threading.Event()
+    callback_threads = []
+
+    def slow_callback(success):
+        callback_threads.append(threading.current_thread().name)
+        release.wait(5)
+        return success
+
+    first = then(service.submit([(lambda: None, ())], name="first"), slow_callback)
+    # 第一个回调还没返回，上传线程仍然在处理后面的任务
+    uploaded = []
+    all_uploaded = threading.Event()
+
+    def upload(i):
+        uploaded.append(i)
+        if len(uploaded) == 6:
+            all_uploaded.set()
+
+    second = service.submit([(upload, (i,)) for i in range(6)], name="second")
+    assert all_uploaded.wait(5)
+    release.set()
+    assert first.result(timeout=5) is True and second.result(timeout=5) is True
+    assert callback_threads == ["cos-upload-done"]
+
+
+def test_shutdown_drains_queued_tasks(monkeypatch):
+    service = UploadService(workers=1, queue_size=10, retries=0)
+    done = []
+    futures = [service.submit([(done.append, (i,))]) for i in range(5)]
+    service.shutdown()
+    assert done == list(range(5))
+    assert all(future.done() for future in futures)
+
+
+def test_then_and_then_future_chain_results_and_errors():
+    source = Future()
+    chained = then_future(source, lambda value: then(done_future(value * 2), lambda value: value + 1))
+    failed = then(source, lambda value: 1 / 0)
+    source.set_result(5)
+    assert chained.result(timeout=1) == 11
+    with pytest.raises(ZeroDivisionError):
+        failed.result(timeout=1)
+
+
+def done_future(value):
+    future = Future()
+    future.set_result(value)
+    return future
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from const import UPLOAD_MANIFEST_PATH, HASH_WORKERS, HASH_CHUNK_SIZE
+
+
+def _md5_stream(stream):
+    digest = hashlib.md5()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def md5_source(source):
+    """
+    分块计算 md5，不把整个文件读进内存；hashlib 处理大块数据时会释放 GIL，线程池可以并行
+    :param source: 文件路径，或者 (压缩包路径, 成员名)
+    :return: 十六进制 md5
+    """
+    if isinstance(source, tuple):
+        with zipfile.ZipFile(source[0]) as zip_file, zip_file.open(source[1]) as stream:
+            return _md5_stream(stream)
+    with open(source, "rb") as stream:
+        return _md5_stream(stream)
+
+
+def md5_sources(sources, workers=HASH_WORKERS):
+    """
+    :return: {source: md5}，读取失败的不在结果里
+    """
+    sources = list(dict.fromkeys(sources))
+
+    def run(source):
+        try:
+            return md5_source(source)
+        except (OSError, KeyError, zipfile.BadZipFile) as e:
+            logger.error(f"[manifest] unable to hash {source}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="md5") as executor:
+        hashes = executor.map(run, sources)
+    return {source: md5 for source, md5 in zip(sources, hashes) if md5 is not None}
+
+
+def response_etag(ans):
+    # SDK 返回响应头字典，ci_ 开头的接口返回 (响应头, 处理结果)
+    if isinstance(ans, tuple):
+        ans = ans[0]
+    if isinstance(ans, dict):
+        return (ans.get("ETag") or ans.get("Etag") or "").strip('"') or None
+    return None
+
+
+class UploadManifest:
+    """
+    每个已上传 cos key 对应的源文件 md5。
+    上传前在本地比较 md5 决定是否上传：没变的文件不发任何请求，内容变了的文件重新上传。
+    图片上传时被转为 webp，COS 上的 ETag 与源文件对不上，所以比较的是记录下来的源文件 md5。
+    清单文件只追加，每行一个 key，同一个 key 以最后一行为准
+    """
+
+    def __init__(self, path=UPLOAD_MANIFEST_PATH):
+        self.path = path
+        self.entries = dict()  # cos key -> {"md5"}
+        self.dirty = []
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as manifest_file:
+                data = manifest_file.read()
+        except FileNotFoundError:
+            return
+        # 最后一行可能是其他进程还没写完的
+        for line in data[:data.rfind(b"\n") + 1].splitlines():
+            try:
+                record = json.loads(line)
+                self.entries[record["key"]] = {"md5": record["md5"]}
+            except (ValueError, KeyError) as e:
+                logger.error(f"[manifest] bad line in {self.path}: {e}")
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def is_unchanged(self, key, md5):
+        entry = self.entries.get(key)
+        return entry is not None and entry["md5"] == md5
+
+    def record(self, key, md5):
+        with self.lock:
+            self.entries[key] = {"md5": md5}
+            self.dirty.append((key, md5))
+
+    def save(self):
+        """
+        把新记录追加到清单末尾，只写这次新增的几行，多个上传进程不会互相覆盖
+        """
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                dirty, self.dirty = self.dirty, []
+            data = "".join(json.dumps({"key": key, "md5": md5}, ensure_ascii=False) + "\n" for key, md5 in dirty)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "ab") as manifest_file:
+                manifest_file.write(data.encode("utf-8"))
+
+    def needs_upload(self, key, md5, head, comparable=False):
+        """
+        清单里有的 key 只在本地比较 md5；还没有的 key（清单建立之前上传的）用一次 HEAD 确认。
+        不经处理的单块上传，ETag 就是内容的 md5，和本地不一致时重新上传；
+        转成 webp 的图片和分块上传（ETag 带 "-"）没法和源文件比较，COS 上已存在就视为与本地一致。
+        确认过的 key 记入清单，以后不再 HEAD
+        :param key:
+        :param md5:
+        :param head: head(key) -> COS 上的 ETag，不存在时为 None
+        :param comparable: 这个 key 是否是原样上传的（音频），ETag 能和 md5 比较
+        :return:
+        """
+        if key in self.entries:
+            return not self.is_unchanged(key, md5)
+        etag = head(key)
+        if etag is None:
+            return True
+        if comparable and etag and "-" not in etag and etag.lower() != md5:
+            return True
+        self.record(key, md5)
+        return False
+
+
+_upload_manifest = None
+
+
+def get_upload_manifest():
+    global _upload_manifest
+    if _upload_manifest is None:
+        _upload_manifest = UploadManifest()
+    return _upload_manifest
@@ -0,0 +1,186 @@
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from loguru import logger
+
+from const import UPLOAD_WORKERS, UPLOAD_QUEUE_SIZE, UPLOAD_RETRIES, UPLOAD_RETRY_BACKOFF
+
+
+def then(future, func):
+    """
+    :return: 新的 Future，结果为 func(future.result())
+    """
+    chained = Future()
+
+    def done(source):
+        try:
+            chained.set_result(func(source.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def then_future(future, func):
+    """
+    func 返回的也是 Future 时使用
+    :return: 新的 Future，结果为 func(future.result()).result()，等待期间不占用线程
+    """
+    chained = Future()
+
+    def forward(inner):
+        try:
+            chained.set_result(inner.result())
+        except Exception as e:
+            chained.set_exception(e)
+
+    def done(source):
+        try:
+            inner = func(source.result())
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        inner.add_done_callback(forward)
+
+    future.add_done_callback(done)
+    return chained
+
+
+class _Batch:
+    """
+    一次 submit 的一组上传任务，全部结束后由 UploadService 完成 future：全部成功为 True，否则为 False
+    """
+
+    def __init__(self, name, count):
+        self.name = name
+        self.remaining = count
+        self.failed = 0
+        self.future = Future()
+        self.lock = threading.Lock()
+
+    def task_done(self, success):
+        """
+        :return: 是否是这一批的最后一个任务
+        """
+        with self.lock:
+            self.remaining -= 1
+            if not success:
+                self.failed += 1
+            return not self.remaining
+
+    def finish(self):
+        if self.failed:
+            logger.error(f"[upload] {self.name}: {self.failed} files failed, you should retry")
+        self.future.set_result(not self.failed)
+
+
+class UploadService:
+    """
+    常驻的上传服务，代替每次上传都新建、等待、丢弃的 SimpleThreadPool：
+    有界队列提供背压，固定数量的工作线程共用一个 COS 客户端（连接池保持长连接），
+    每个对象失败后按指数退避重试。调用方提交后立即返回，通过 future 得知这一批是否全部成功。
+    future 的回调（保存清单、清理临时文件等）在单独的线程里执行，不占用上传线程
+    """
+
+    def __init__(self, workers=UPLOAD_WORKERS, queue_size=UPLOAD_QUEUE_SIZE, retries=UPLOAD_RETRIES,
+                 backoff=UPLOAD_RETRY_BACKOFF):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.completions = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.run, name=f"cos-upload-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            thread = threading.Thread(target=self.complete, name="cos-upload-done", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        atexit.register(self.shutdown)
+
+    def submit(self, tasks, name=""):
+        """
+        队列满时阻塞，直到有空位
+        :param tasks: [(func, args)]
+        :param name: 日志中显示的批次名，比如谱面名
+        :return: Future，全部成功时结果为 True
+        """
+        self.start()
+        batch = _Batch(name, len(tasks))
+        if not tasks:
+            batch.future.set_result(True)
+            return batch.future
+        for func, args in tasks:
+            self.queue.put((batch, func, args))
+        return batch.future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch, func, args = item
+            if batch.task_done(self.execute(batch.name, func, args)):
+                self.completions.put(batch)
+
+    def complete(self):
+        while True:
+            batch = self.completions.get()
+            if batch is None:
+                return
+            try:
+                batch.finish()
+            except Exception as e:
+                logger.error(f"[upload] {batch.name}: callback failed: {e}")
+
+    def execute(self, name, func, args):
+        for attempt in range(self.retries + 1):
+            try:
+                func(*args)
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"[upload] {name}: {func.__name__} failed after {attempt + 1} attempts: {e}")
+                    return False
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"[upload] {name}: {func.__name__} failed, retry in {delay}s: {e}")
+                time.sleep(delay)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        if not threads:
+            return
+        workers, completer = threads[:-1], threads[-1]
+        for _ in workers:
+            self.queue.put(None)  # 排在已提交的任务后面，队列里的任务会先执行完
+        if wait:
+            for thread in workers:
+                thread.join()
+            self.completions.put(None)  # 上传线程都退出后，剩下的回调也执行完
+            completer.join()
+        else:
+            self.completions.put(None)
+
+
+_upload_service = None
+_upload_service_lock = threading.Lock()
+
+
+def get_upload_service():
+    global _upload_service
+    with _upload_service_lock:
+        if _upload_service is None:
+            _upload_service = UploadService()
+    return _upload_service
@@ -6,6 +6,9 @@
 import os
 from fastapi.responses import StreamingResponse
 
+from archive_store import archive_store
+from beatmap_meta import beatmap_meta_store
+from rendition_ladder import load_ladder_index
 from const import PROJECT_PATH, DOWNLOAD_RES_PATH, IMAGE_TYPE, MUSIC_TYPE
 
 
@@ -36,7 +39,8 @@ def show_folder_files(base_path, all_files=None, recursion=False):
 
 def show_beatmap(name):
     """
-    遍历当前目录所有文件夹
+    优先读取入库时写好的元数据 sidecar，带有文件大小、图片尺寸和音频时长；
+    没有 sidecar 的旧谱面遍历文件夹
     :param name:
     :return:
     """
@@ -45,13 +49,22 @@ def show_beatmap(name):
         "songs": []
     }
     target_folder = os.path.join(DOWNLOAD_RES_PATH, name) + ""
-    if os.path.isdir(target_folder):
+    meta = beatmap_meta_store.get(name)
+    if meta is not None:
+        res = dict(meta)
+    elif os.path.isdir(target_folder):
         file_list = os.listdir(target_folder)
         for file in file_list:
             if file.title().lower().endswith(IMAGE_TYPE):
                 res["images"].append(file)
             if file.title().lower().endswith(MUSIC_TYPE):
                 res["songs"].append(file)
+    elif archive_store.exists(name):
+        res = archive_store.list_members(name)
+    renditions = load_ladder_index(name)
+    if renditions:
+        # 本地编码上传的多尺寸版本 {文件名: {尺寸档: {格式: cos key}}}
+        res["renditions"] = renditions
     return res
 
 